@@ -1,16 +1,64 @@
 import os
+from datetime import timedelta
+
+from kombu import Queue
 
 # Basic config
-# IMPORTANT: Using pickle exclusively because we are passing objects that are potentially invalid JSON.
+# IMPORTANT: Catalog objects are not passed through the broker. They are stored once in Redis
+# (see thezombies.tasks.payloads) and messages carry only small references, so msgpack is enough
+# and messages are not worth compressing.
 BROKER_URL = os.getenv('BROKER_URL', 'amqp://10.64.7.102:5672//')
 CELERY_DEFAULT_RATE_LIMIT = '100/s'
-CELERY_ACCEPT_CONTENT = ['pickle']
-CELERY_MESSAGE_COMPRESSION = 'gzip'
+CELERY_ACCEPT_CONTENT = ['msgpack']
 # CELERY_DISABLE_RATE_LIMITS = True
 # Tasks
-CELERY_TASK_SERIALIZER = 'pickle'
+CELERY_TASK_SERIALIZER = 'msgpack'
 CELERYD_TASK_TIME_LIMIT = 10 * 60
 # Results
 CELERY_TASK_RESULT_EXPIRES = 7200  # 2 hours.
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://10.64.7.102:6379//')
-CELERY_RESULT_SERIALIZER = 'pickle'
+CELERY_RESULT_SERIALIZER = 'msgpack'
+# Queues. Each kind of load has its own queue, consumed by a worker with a suitable pool:
+#   catalogs    long-running producers that stream catalogs, on a prefork pool with about as many
+#               processes as crawls and validations run at once (SWEEP_MAX_CRAWLS and a few more)
+#   urls        network-bound URL inspections (and the dataset tasks that queue them) on an eventlet pool
+#               with high concurrency, e.g. 200 greenlets
+#   validation  CPU-bound validation and snapshot parsing, on a prefork pool with one process per core
+# A worker started without -Q consumes every queue, which is fine for development. See README.md
+CELERY_DEFAULT_QUEUE = 'celery'
+CELERY_QUEUES = (
+    Queue('celery'),
+    Queue('catalogs'),
+    Queue('urls'),
+    Queue('validation'),
+)
+CELERY_ROUTES = {
+    'thezombies.tasks.crawl.crawl_agency_catalog': {'queue': 'catalogs'},
+    'thezombies.tasks.validation.validate_catalog_datasets': {'queue': 'catalogs'},
+    'thezombies.tasks.scheduler.schedule_sweep': {'queue': 'catalogs'},
+    'thezombies.tasks.scheduler.continue_sweep': {'queue': 'catalogs'},
+    'thezombies.tasks.snapshots.remove_old_snapshots': {'queue': 'catalogs'},
+    'thezombies.tasks.columns.export_audit_columns': {'queue': 'catalogs'},
+    'thezombies.tasks.crawl.inspect_catalog_dataset': {'queue': 'urls'},
+    'thezombies.tasks.urls.inspect_url': {'queue': 'urls'},
+    'thezombies.tasks.urls.check_and_correct_url': {'queue': 'urls'},
+    'thezombies.tasks.urls.request_url': {'queue': 'urls'},
+    'thezombies.tasks.urls.get_or_create_inspection': {'queue': 'urls'},
+    # inspect_url is queued in chunks, which run as celery.starmap tasks
+    'celery.starmap': {'queue': 'urls'},
+    'thezombies.tasks.validation.validate_json_object': {'queue': 'validation'},
+    'thezombies.tasks.snapshots.dispatch_snapshot_range': {'queue': 'validation'},
+}
+# Periodic tasks, run by one celery beat (e.g. start one worker with -B)
+CELERYBEAT_SCHEDULE = {
+    # Starts sweep crawls that a missed completion didn't, see thezombies.tasks.scheduler
+    'continue-sweep': {
+        'task': 'thezombies.tasks.scheduler.continue_sweep',
+        'schedule': timedelta(seconds=int(os.getenv('SWEEP_INTERVAL', 60))),
+    },
+    # Deletes expired catalog snapshots, see thezombies.tasks.snapshots
+    'remove-old-snapshots': {
+        'task': 'thezombies.tasks.snapshots.remove_old_snapshots',
+        'schedule': timedelta(days=1),
+    },
+}
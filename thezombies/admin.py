@@ -1,5 +1,6 @@
 from django.contrib import admin
-from thezombies.models import (Agency, Audit, URLInspection, Probe)
+from django.utils.html import format_html, format_html_join
+from thezombies.models import (Agency, Audit, URLInspection, CanonicalURL, Probe, ProbeError, ErrorType)
 
 
 class AgencyAdmin(admin.ModelAdmin):
@@ -8,9 +9,24 @@ class AgencyAdmin(admin.ModelAdmin):
     list_filter = ('agency_type',)
 
 
+class ProbeErrorInline(admin.TabularInline):
+    model = ProbeError
+    fields = ('message',)
+    readonly_fields = ('message',)
+    extra = 0
+    can_delete = False
+
+
 class ProbeAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'probe_type', 'previous', 'created_at')
     list_filter = ('probe_type',)
+    inlines = (ProbeErrorInline,)
+
+
+class ErrorTypeAdmin(admin.ModelAdmin):
+    list_display = ('error_class', 'template', 'created_at')
+    list_filter = ('error_class',)
+    search_fields = ('template',)
 
 
 class AuditAdmin(admin.ModelAdmin):
@@ -20,13 +36,21 @@ class AuditAdmin(admin.ModelAdmin):
     ordering = ('-created_at',)
     date_hierarchy = 'created_at'
     readonly_fields = ('url_inspections_count', 'url_inspections_failure_count', 'url_inspections_404_count',
-                       'url_inspections_html_count', 'created_at', 'updated_at', 'messages')
+                       'url_inspections_html_count', 'created_at', 'updated_at', 'audit_messages', 'error_breakdown',
+                       'checkpoint_position', 'checkpoint_offset', 'checkpoint_at', 'resume_count')
     fieldsets = (
         (None, {
             'fields': (('agency', 'audit_type'), ('created_at', 'updated_at'), 'notes')
         }),
         ('Messages', {
-            'fields': ('messages',)
+            'fields': ('audit_messages',)
+        }),
+        ('Errors', {
+            'fields': ('error_breakdown',)
+        }),
+        ('Checkpoint', {
+            'fields': (('checkpoint_position', 'checkpoint_offset'), ('checkpoint_at', 'resume_count')),
+            'classes': ('collapse',),
         }),
         ('URL Inspections', {
             'fields': ('url_inspections_count', 'url_inspections_failure_count', 'url_inspections_404_count', 'url_inspections_html_count'),
@@ -52,6 +76,16 @@ class AuditAdmin(admin.ModelAdmin):
     def url_inspections_ftp_count(self, obj):
         return self.url_inspections.ftp_urls().count()
 
+    def audit_messages(self, obj):
+        messages = obj.message_list()
+        return format_html_join(u'\n', u'<p>{0}</p>', ((message,) for message in messages)) if messages else u'None'
+    audit_messages.short_description = 'Messages'
+
+    def error_breakdown(self, obj):
+        rows = format_html_join('', u'<tr><td>{0}</td><td>{1}</td><td>{2}</td></tr>',
+                                ((t.error_class, t.template, count) for t, count in obj.error_counts()))
+        return format_html(u'<table>{0}</table>', rows) if rows else u'None'
+
     def display_name(self, obj):
         name = 'Audit for {0}'.format(obj.agency.name)
         if obj.url:
@@ -65,9 +99,32 @@ class URLInspectionAdmin(admin.ModelAdmin):
     search_fields = ('requested_url', 'url')
     exclude = ('content',)
     ordering = ('-created_at',)
-    readonly_fields = ('requested_url', 'url')
+    readonly_fields = ('requested_url', 'url', 'canonical_url', 'reused_from')
+
+
+class CanonicalURLAdmin(admin.ModelAdmin):
+    list_display = ('url', 'host', 'inspected_at')
+    search_fields = ('url', 'host')
+    ordering = ('host', 'url')
+    readonly_fields = ('url', 'host', 'latest_inspection', 'inspected_at', 'inspection_count', 'uptime',
+                       'broken_since', 'flaps')
+
+    def inspection_count(self, obj):
+        return len(obj.get_status_history())
+
+    def uptime(self, obj):
+        uptime = obj.get_status_history().uptime()
+        return '' if uptime is None else '{0:.1%}'.format(uptime)
+
+    def broken_since(self, obj):
+        return obj.get_status_history().broken_since()
+
+    def flaps(self, obj):
+        return obj.get_status_history().flaps()
 
 admin.site.register(Agency, AgencyAdmin)
 admin.site.register(Audit, AuditAdmin)
 admin.site.register(Probe, ProbeAdmin)
+admin.site.register(ErrorType, ErrorTypeAdmin)
 admin.site.register(URLInspection, URLInspectionAdmin)
+admin.site.register(CanonicalURL, CanonicalURLAdmin)
@@ -0,0 +1,127 @@
+"""
+Statistics of crawls, computed from their columnar exports (see thezombies.columnar) with numpy.
+
+Every function takes the dictionary of arrays returned by load_columns, so a report cycle loads each
+audit's file once and runs its aggregates in memory instead of querying PostgreSQL for each.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+# Stored for missing numbers, and as the code of missing text (see thezombies.columnar)
+MISSING = -1
+HTTP, FTP, OTHER = 0, 1, 2
+
+# Columns of the crawl report, in order
+REPORT_STATS = (
+    ('errors', 'Errors'),
+    ('entries_without_urls', 'Entries without URLs'),
+    ('urls_inspected', 'URLs inspected'),
+    ('http_errors', 'HTTP Errors'),
+    ('urls_no_content_type', 'URLs no content-type'),
+    ('ftp_urls', 'FTP URLs'),
+    ('possibly_invalid_urls', 'Possibly Invalid URLs'),
+)
+
+
+def failed(columns):
+    """Whether each inspection failed: no response, or an error status"""
+    status = columns['status_code']
+    return (status == MISSING) | (status >= 400)
+
+
+def crawl_stats(columns):
+    """The counts in the crawl report (see REPORT_STATS)"""
+    status = columns['status_code']
+    responded = status != MISSING
+    return OrderedDict((
+        ('errors', len(columns['error_type_id'])),
+        ('entries_without_urls', int(np.count_nonzero(columns['dataset_url_count'] == 0))),
+        ('urls_inspected', len(status)),
+        ('http_errors', int(np.count_nonzero(status >= 400))),
+        # Successful responses only, as in URLInspectionQuerySet.responses_sans_content_type
+        ('urls_no_content_type', int(np.count_nonzero(responded & (status < 300) &
+                                                      (columns['content_type'] == MISSING)))),
+        ('ftp_urls', int(np.count_nonzero(columns['scheme'] == FTP))),
+        ('possibly_invalid_urls', int(np.count_nonzero(columns['scheme'] == OTHER))),
+    ))
+
+
+def code_counts(codes, vocabulary):
+    """(value, count) for each value of a coded text column, then (None, count) for missing values"""
+    counts = np.bincount(codes[codes != MISSING], minlength=len(vocabulary))
+    return list(zip(vocabulary.tolist(), counts.tolist())) + [(None, int(np.count_nonzero(codes == MISSING)))]
+
+
+def content_type_shares(columns):
+    """(count, share, content type) for each content type, sorted by type, with missing types (None) last"""
+    total = len(columns['content_type'])
+    counts = code_counts(columns['content_type'], columns['content_types'])
+    known = sorted((value, count) for value, count in counts[:-1] if count)
+    return [(count, float(count) / total if total else 0.0, value) for value, count in known + counts[-1:]]
+
+
+def status_class_counts(columns):
+    """Inspections by class of status code ('2xx' etc), and 'none' for those without a response"""
+    status = columns['status_code']
+    counts = np.bincount(status[status != MISSING] // 100, minlength=6)
+    # 1xx to 5xx, and any unusual classes that occurred
+    classes = OrderedDict(('{0}xx'.format(n), int(counts[n])) for n in range(1, len(counts)) if n < 6 or counts[n])
+    classes['none'] = int(np.count_nonzero(status == MISSING))
+    return classes
+
+
+def error_type_counts(columns):
+    """(error type id, count) for the errors of an audit, most frequent first"""
+    ids, counts = np.unique(columns['error_type_id'], return_counts=True)
+    order = np.argsort(-counts, kind='mergesort')
+    return list(zip(ids[order].tolist(), counts[order].tolist()))
+
+
+def failure_rates(columns, by='url_type'):
+    """(value, inspections, failure rate) for each value of a coded column, e.g. url_type or content_type"""
+    codes = columns[by]
+    vocabulary = columns[by + 's'].tolist() + [None]
+    # Missing values go in the last bin
+    bins = np.where(codes == MISSING, len(vocabulary) - 1, codes)
+    totals = np.bincount(bins, minlength=len(vocabulary))
+    failures = np.bincount(bins, weights=failed(columns), minlength=len(vocabulary))
+    return [(value, int(total), float(fails) / int(total)) for value, total, fails in zip(vocabulary, totals, failures)
+            if total]
+
+
+def latency_percentiles(columns, percentiles=(50, 90, 99)):
+    """Percentiles of request latency (seconds), None where no latency was recorded"""
+    latency = columns['latency']
+    latency = latency[~np.isnan(latency)]
+    if not len(latency):
+        return OrderedDict((p, None) for p in percentiles)
+    return OrderedDict(zip(percentiles, np.percentile(latency, percentiles).tolist()))
+
+
+def datasets_with_failures(columns):
+    """Catalog positions of datasets with at least one failed URL"""
+    positions = columns['position'][failed(columns)]
+    return np.unique(positions[positions != MISSING])
+
+
+def trends(audits):
+    """
+    A row of headline figures for each of several audits (dictionaries of columns), oldest first,
+    e.g. the crawls of one agency
+    """
+    rows = []
+    for columns in sorted(audits, key=lambda c: int(c['created_at'])):
+        urls = len(columns['status_code'])
+        stats = crawl_stats(columns)
+        rows.append(OrderedDict((
+            ('audit_id', int(columns['audit_id'])),
+            ('created_at', int(columns['created_at'])),
+            ('urls_inspected', urls),
+            ('failure_rate', float(np.count_nonzero(failed(columns))) / urls if urls else 0.0),
+            ('timeout_rate', float(np.count_nonzero(columns['timeout'])) / urls if urls else 0.0),
+            ('latency_p50', latency_percentiles(columns, (50,))[50]),
+            ('entries_without_urls', stats['entries_without_urls']),
+            ('errors', stats['errors']),
+        )))
+    return rows
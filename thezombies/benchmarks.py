@@ -0,0 +1,467 @@
+"""
+End-to-end benchmarks for catalog crawls and validations.
+
+Builds synthetic data.json catalogs, serves them (and the URLs inside them) from a local
+stand-in for agency web servers, and runs the crawl and validation tasks eagerly in-process.
+See the benchmark_crawl management command.
+"""
+from __future__ import absolute_import
+from distutils.spawn import find_executable
+import json
+import os
+import random
+import resource
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+from thezombies import metrics
+from thezombies.models import Agency, Audit, AuditProgress
+
+BENCHMARK_AGENCY_NAME = u'Benchmark Agency'
+
+# Relative weights of the behaviors of URLs in synthetic catalogs
+DEFAULT_SCENARIO_MIX = (
+    ('ok', 60),
+    ('slow', 8),
+    ('redirect', 10),
+    ('nohead', 5),
+    ('huge', 3),
+    ('notfound', 6),
+    ('timeout', 2),
+    ('tls', 4),
+    ('legacy_tls', 2),
+)
+TLS_SCENARIOS = ('tls', 'legacy_tls')
+
+# Share of datasets generated without any URLs
+NO_URL_RATIO = 0.02
+REDIRECT_HOPS = 3
+HUGE_BODY_SIZE = 50 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_dataset(num, schema, urls):
+    """A dataset object shaped for schema ('DATASET_1.0' or 'DATASET_1.1') linking to urls"""
+    identifier = u'benchmark-{0}'.format(num)
+    title = u'Benchmark dataset {0}'.format(num)
+    if schema == 'DATASET_1.1':
+        dataset = {
+            '@type': 'dcat:Dataset',
+            'title': title,
+            'description': u'Synthetic dataset for benchmarking.',
+            'keyword': ['benchmark', 'synthetic'],
+            'modified': '2014-09-15',
+            'publisher': {'@type': 'org:Organization', 'name': BENCHMARK_AGENCY_NAME},
+            'contactPoint': {'@type': 'vcard:Contact', 'fn': 'Benchmark Contact',
+                             'hasEmail': 'mailto:benchmark@example.com'},
+            'identifier': identifier,
+            'accessLevel': 'public',
+            'bureauCode': ['000:00'],
+            'programCode': ['000:000'],
+        }
+        if urls:
+            dataset['distribution'] = [{'@type': 'dcat:Distribution', 'accessURL': url, 'mediaType': 'text/csv'}
+                                       for url in urls]
+    else:
+        dataset = {
+            'title': title,
+            'description': u'Synthetic dataset for benchmarking.',
+            'keyword': ['benchmark', 'synthetic'],
+            'modified': '2014-09-15',
+            'publisher': BENCHMARK_AGENCY_NAME,
+            'contactPoint': 'Benchmark Contact',
+            'mbox': 'benchmark@example.com',
+            'identifier': identifier,
+            'accessLevel': 'public',
+        }
+        if urls:
+            dataset['accessURL'] = urls[0]
+            dataset['distribution'] = [{'accessURL': url, 'format': 'text/csv'} for url in urls[1:]]
+    return dataset
+
+
+class ScenarioPicker(object):
+    """Deterministically assigns a behavior (and so a URL on the stand-in server) to each link"""
+
+    def __init__(self, server, mix=DEFAULT_SCENARIO_MIX, seed=0):
+        self.server = server
+        self.random = random.Random(seed)
+        self.scenarios = [name for name, weight in mix if server.supports(name)]
+        self.weights = [weight for name, weight in mix if server.supports(name)]
+        self.total = float(sum(self.weights))
+
+    def pick(self):
+        point = self.random.random() * self.total
+        for name, weight in zip(self.scenarios, self.weights):
+            point -= weight
+            if point < 0:
+                return name
+        return self.scenarios[-1]
+
+    def urls_for(self, num, count):
+        if self.random.random() < NO_URL_RATIO:
+            return []
+        return [self.server.url_for(self.pick(), u'{0}-{1}'.format(num, i)) for i in range(count)]
+
+
+def write_catalog(path, size, schema, picker, urls_per_dataset=3):
+    """Write a synthetic catalog of size datasets to path, without holding it in memory"""
+    with open(path, 'w') as catalog:
+        if schema == 'DATASET_1.1':
+            catalog.write('{"conformsTo": "https://project-open-data.cio.gov/v1.1/schema", "dataset": [\n')
+        else:
+            catalog.write('[\n')
+        for num in range(size):
+            if num:
+                catalog.write(',\n')
+            dataset = synthetic_dataset(num, schema, picker.urls_for(num, urls_per_dataset))
+            catalog.write(json.dumps(dataset))
+        catalog.write('\n]}\n' if schema == 'DATASET_1.1' else '\n]\n')
+    return path
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """Serves the catalog at /data.json and URLs shaped like /<scenario>/<id>"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'AgencyStandIn/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def send_body(self, status, body=b'', content_type='text/plain', head=False, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_stream(self, length, chunks, content_type, head):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        if not head:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+
+    def respond(self, head):
+        settings = self.server.stand_in
+        if self.path == '/data.json':
+            catalog_path = settings.catalog_path
+            return self.send_stream(os.path.getsize(catalog_path), read_chunks(catalog_path),
+                                    'application/json', head)
+
+        parts = self.path.strip('/').split('/')
+        scenario = parts[0]
+        if scenario == 'slow':
+            time.sleep(settings.slow_delay)
+        elif scenario == 'timeout':
+            time.sleep(settings.timeout_delay)
+        elif scenario == 'redirect' and len(parts) == 3:
+            hops = int(parts[1])
+            location = '/redirect/{0}/{1}'.format(hops - 1, parts[2]) if hops > 1 else '/ok/{0}'.format(parts[2])
+            return self.send_body(302, head=head, headers={'Location': location})
+        elif scenario == 'nohead' and head:
+            return self.send_body(405, b'Method Not Allowed', head=head)
+        elif scenario == 'notfound':
+            return self.send_body(404, b'Not Found', head=head)
+        elif scenario == 'huge':
+            zeros = b'\0' * CHUNK_SIZE
+            chunks = (zeros for _ in range(HUGE_BODY_SIZE // CHUNK_SIZE))
+            return self.send_stream(HUGE_BODY_SIZE, chunks, 'application/octet-stream', head)
+        self.send_body(200, b'benchmark,value\n1,2\n', 'text/csv', head)
+
+
+def read_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class AgencyStandIn(object):
+    """
+    Local HTTP(S) servers standing in for agency hosts.
+    HTTPS servers (one with a self-signed certificate, one limited to TLSv1) need the openssl executable.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, slow_delay=1.0, timeout_delay=10.0):
+        self.host = host
+        self.port = port
+        self.slow_delay = slow_delay
+        self.timeout_delay = timeout_delay
+        self.catalog_path = None
+        self.servers = {}
+        self.workdir = tempfile.mkdtemp(prefix='thezombies-bench-')
+
+    def _make_server(self, port, ssl_version=None, certfile=None):
+        server = ThreadingHTTPServer((self.host, port), StandInRequestHandler)
+        server.stand_in = self
+        if certfile:
+            server.socket = ssl.wrap_socket(server.socket, certfile=certfile, server_side=True,
+                                            ssl_version=ssl_version)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def _make_certificate(self):
+        if not find_executable('openssl'):
+            return None
+        keyfile = os.path.join(self.workdir, 'key.pem')
+        certfile = os.path.join(self.workdir, 'cert.pem')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                                   '-subj', '/CN={0}'.format(self.host), '-keyout', keyfile, '-out', certfile],
+                                  stdout=devnull, stderr=devnull)
+        combined = os.path.join(self.workdir, 'combined.pem')
+        with open(combined, 'w') as out:
+            out.write(open(keyfile).read())
+            out.write(open(certfile).read())
+        return combined
+
+    def start(self):
+        self.servers['http'] = self._make_server(self.port)
+        certfile = self._make_certificate()
+        if certfile:
+            self.servers['tls'] = self._make_server(0, ssl.PROTOCOL_SSLv23, certfile)
+            self.servers['legacy_tls'] = self._make_server(0, ssl.PROTOCOL_TLSv1, certfile)
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def supports(self, scenario):
+        return scenario not in TLS_SCENARIOS or scenario in self.servers
+
+    @property
+    def base_url(self):
+        return 'http://{0}:{1}/'.format(self.host, self.servers['http'].server_address[1])
+
+    def url_for(self, scenario, ident):
+        if scenario in TLS_SCENARIOS:
+            return 'https://{0}:{1}/ok/{2}'.format(self.host, self.servers[scenario].server_address[1], ident)
+        if scenario == 'redirect':
+            return '{0}redirect/{1}/{2}'.format(self.base_url, REDIRECT_HOPS, ident)
+        return '{0}{1}/{2}'.format(self.base_url, scenario, ident)
+
+    def catalog(self, size, schema, urls_per_dataset=3, seed=0, mix=DEFAULT_SCENARIO_MIX):
+        """Write a catalog and serve it at /data.json"""
+        path = os.path.join(self.workdir, 'data-{0}-{1}.json'.format(schema, size))
+        write_catalog(path, size, schema, ScenarioPicker(self, mix, seed), urls_per_dataset)
+        self.catalog_path = path
+        return path
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run on a connection, as a context manager. Uses connection.execute_wrapper (Django 2.0+)
+    where there is one, so queries aren't kept. Otherwise CaptureQueriesContext, which on Django 1.8 to 1.11 can
+    only count up to connection.queries_limit
+    """
+
+    def __init__(self, conn=None):
+        self.connection = conn or connection
+        self.count = 0
+        self.context = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        if hasattr(self.connection, 'execute_wrapper'):
+            self.context = self.connection.execute_wrapper(self)
+        else:
+            self.context = CaptureQueriesContext(self.connection)
+        self.context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.__exit__(exc_type, exc_value, traceback)
+        if isinstance(self.context, CaptureQueriesContext):
+            if exc_type is None:
+                self.count = len(self.context)
+            # Don't hold on to every query of the run
+            reset_queries()
+
+
+def latency_stats(prefix, latencies):
+    """Percentiles and maximum of latencies (seconds), keyed like '<prefix>_p50'"""
+    return {
+        prefix + '_p50': percentile(latencies, 50),
+        prefix + '_p90': percentile(latencies, 90),
+        prefix + '_p99': percentile(latencies, 99),
+        prefix + '_max': max(latencies) if latencies else None,
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def benchmark_agency(stand_in):
+    agency, created = Agency.objects.get_or_create(name=BENCHMARK_AGENCY_NAME,
+                                                   defaults={'url': stand_in.base_url,
+                                                             'agency_type': Agency.OTHER})
+    if agency.url != stand_in.base_url:
+        agency.url = stand_in.base_url
+        agency.save()
+    return agency
+
+
+def run_benchmark(stand_in, mode, schema):
+    """
+    Run a crawl ('crawl') or validation ('validate') of the catalog served by stand_in.
+    Tasks must be set to run eagerly. Returns a dictionary of measurements.
+    """
+    from thezombies.tasks import crawl_agency_catalog, validate_catalog_datasets
+
+    agency = benchmark_agency(stand_in)
+    # Requesting a URL and validating an object take very different times, so they're reported apart
+    latencies = {'url_request_seconds': [], 'validation_seconds': []}
+
+    def record_latency(name, value):
+        if name in latencies:
+            latencies[name].append(value)
+
+    metrics.add_listener(record_latency)
+    start = time.time()
+    try:
+        with QueryCounter() as queries:
+            if mode == 'crawl':
+                crawl_agency_catalog.delay(agency.id, agency.data_json_url, schema=schema)
+            else:
+                validate_catalog_datasets.delay(agency.id, schema=schema)
+    finally:
+        elapsed = time.time() - start
+        metrics.remove_listener(record_latency)
+
+    audit = Audit.objects.filter(agency=agency).latest()
+    progress = AuditProgress.objects.filter(audit=audit).first()
+    datasets = progress.datasets_done if progress else 0
+    urls = progress.urls_done if progress else 0
+    result = {
+        'mode': mode,
+        'schema': schema,
+        'audit_id': audit.id,
+        'datasets': datasets,
+        'urls': urls,
+        'urls_failed': progress.urls_failed if progress else 0,
+        'seconds': elapsed,
+        'datasets_per_second': datasets / elapsed if elapsed else 0.0,
+        'urls_per_second': urls / elapsed if elapsed else 0.0,
+        # ru_maxrss is in kilobytes on Linux. This is the peak for the whole process so far.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'queries': queries.count,
+        'queries_per_url': float(queries.count) / urls if urls else None,
+        'queries_per_dataset': float(queries.count) / datasets if datasets else None,
+    }
+    result.update(latency_stats('url_latency', latencies['url_request_seconds']))
+    result.update(latency_stats('validation_latency', latencies['validation_seconds']))
+    return result
+
+
+# Run in a new interpreter by benchmark_startup, so nothing is imported or cached yet
+STARTUP_PROBE_SCRIPT = '''
+import json, sys, time
+start = time.time()
+import django
+django.setup()
+from thezombies.benchmarks import startup_probe
+print(json.dumps(startup_probe(start, *json.loads(sys.argv[1]))))
+'''
+
+
+def first_task(schema):
+    """What a worker child does before its first validation: get the validator and use it"""
+    from thezombies.tasks import validation
+    from thezombies.tasks.schemas import get_validator
+    validator = get_validator(schema)
+    validator.is_valid(synthetic_dataset(0, schema, [u'http://127.0.0.1/benchmark']))
+    return validation
+
+
+def startup_probe(start, preload, schema, children):
+    """
+    Start a worker the way the main worker process does (from start, when the interpreter started),
+    fork children and time each one's first task. Returns a dictionary of measurements
+    """
+    from thezombies.celery import app
+    from thezombies import startup
+
+    app.loader.import_default_modules()
+    setup_seconds = time.time() - start
+    preload_seconds = startup.preload() if preload else 0.0
+    ready_seconds = time.time() - start
+    first_task_seconds = []
+    for num in range(children):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            child_start = time.time()
+            first_task(schema)
+            os.write(write_fd, repr(time.time() - child_start).encode('ascii'))
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as reader:
+            first_task_seconds.append(float(reader.read() or 'nan'))
+        os.waitpid(pid, 0)
+    return {
+        'setup_seconds': setup_seconds,
+        'preload_seconds': preload_seconds,
+        'ready_seconds': ready_seconds,
+        'first_task_p50': percentile(first_task_seconds, 50),
+        'first_task_max': max(first_task_seconds) if first_task_seconds else None,
+        'child_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    }
+
+
+def benchmark_startup(preload, schema, children=4):
+    """Measure a cold worker start in a new interpreter, with or without WORKER_PRELOAD's preloading"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_PROBE_SCRIPT,
+                                      json.dumps([preload, schema, children])], env=env)
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result.update({'preload': preload, 'schema': schema, 'children': children})
+    return result
@@ -16,6 +16,14 @@ app = Celery('thezombies', task_cls='django_atomic_celery:PostTransactionTask')
 app.config_from_object('celeryconfig')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Sampled task profiling, if enabled with TASK_PROFILE_RATE
+from thezombies import profiling
+profiling.connect()
+
+# Schemas and validators loaded before the pool forks, if enabled with WORKER_PRELOAD
+from thezombies import startup
+startup.connect()
+
 
 @app.task(bind=True)
 def debug_task(self):
@@ -0,0 +1,183 @@
+"""
+Columnar snapshots of completed crawls, for analysis outside PostgreSQL.
+
+An audit's URL inspections, dataset probes and errors are written to a NumPy .npz file of flat arrays:
+one element per inspection (status code, content type, latency, URL type, scheme, and the position of
+its dataset in the catalog), per dataset (position, number of URLs) and per error (error type id, probe id).
+Text columns are stored as integer codes into a vocabulary array, with -1 for missing values. Rows are read
+with server-side cursors, like exports, and a file is loaded whole with load_columns.
+See thezombies.analytics for statistics computed from them.
+"""
+from array import array
+from django.conf import settings
+import calendar
+import os
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from thezombies.exports import stream_sql
+from thezombies.models import Audit, Probe, ProbeError, ResponseContent, URLInspection
+
+COLUMNAR_EXPORT_DIR = getattr(settings, 'COLUMNAR_EXPORT_DIR', '')
+
+SCHEMES = ('http', 'ftp', 'other')
+# Stored for missing numbers, and as the code of missing text
+MISSING = -1
+
+INSPECTION_COLUMNS_SQL = """
+    SELECT i.id, i.probe_id, previous.result -> 'object_position', p.initial -> 'url_type',
+        CASE WHEN i.requested_url LIKE 'http%%' THEN 0 WHEN i.requested_url LIKE 'ftp%%' THEN 1 ELSE 2 END,
+        i.status_code, i.timeout, c.content_type, p.result -> 'latency'
+    FROM {inspection} i
+        INNER JOIN {probe} p ON p.id = i.probe_id
+        LEFT OUTER JOIN {probe} previous ON previous.id = p.previous_id
+        LEFT OUTER JOIN {content} c ON c.id = i.content_id
+    WHERE p.audit_id = %s AND i.parent_id IS NULL
+    ORDER BY i.id
+"""
+
+DATASET_COLUMNS_SQL = """
+    SELECT id, result -> 'object_position', result -> 'unique_url_count'
+    FROM {probe} WHERE audit_id = %s AND probe_type = %s
+    ORDER BY id
+"""
+
+ERROR_COLUMNS_SQL = """
+    SELECT error_type_id, probe_id FROM {error} WHERE audit_id = %s ORDER BY id
+"""
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError(u'Columnar exports need numpy (pip install numpy)')
+
+
+def columns_path(audit_id, directory=None):
+    return os.path.join(directory or COLUMNAR_EXPORT_DIR, 'audit-{0}.npz'.format(audit_id))
+
+
+def table_names():
+    return {'inspection': URLInspection._meta.db_table, 'probe': Probe._meta.db_table,
+            'content': ResponseContent._meta.db_table, 'error': ProbeError._meta.db_table}
+
+
+def to_int(value, default=MISSING):
+    """An integer from an hstore value (a string), or default"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class Vocabulary(object):
+    """Integer codes for the distinct values of a text column, in order of appearance"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        if value is None:
+            return MISSING
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+    def to_array(self):
+        return np.array(self.values, dtype='U') if self.values else np.zeros(0, dtype='U1')
+
+
+def read_columns(audit):
+    """The columns of an audit, as a dictionary of numpy arrays"""
+    require_numpy()
+    tables = table_names()
+    url_types, content_types = Vocabulary(), Vocabulary()
+    inspection_id, probe_id, position, url_type = array('l'), array('l'), array('l'), array('l')
+    scheme, status_code, timeout, content_type, latency = array('b'), array('h'), array('b'), array('l'), array('d')
+    for row in stream_sql(INSPECTION_COLUMNS_SQL.format(**tables), [audit.id]):
+        inspection_id.append(row[0])
+        probe_id.append(row[1] or 0)
+        position.append(to_int(row[2]))
+        url_type.append(url_types.code(row[3]))
+        scheme.append(row[4])
+        status_code.append(MISSING if row[5] is None else row[5])
+        timeout.append(1 if row[6] else 0)
+        content_type.append(content_types.code(row[7]))
+        latency.append(to_float(row[8]))
+
+    dataset_probe_id, dataset_position, dataset_url_count = array('l'), array('l'), array('l')
+    for row in stream_sql(DATASET_COLUMNS_SQL.format(**tables), [audit.id, Probe.JSON_PROBE]):
+        dataset_probe_id.append(row[0])
+        dataset_position.append(to_int(row[1]))
+        # Datasets without URLs don't record a count
+        dataset_url_count.append(to_int(row[2], 0))
+
+    error_type_id, error_probe_id = array('l'), array('l')
+    for row in stream_sql(ERROR_COLUMNS_SQL.format(**tables), [audit.id]):
+        error_type_id.append(row[0])
+        error_probe_id.append(row[1])
+
+    return {
+        'audit_id': np.array(audit.id, dtype=np.int64),
+        'agency_id': np.array(audit.agency_id, dtype=np.int64),
+        'created_at': np.array(calendar.timegm(audit.created_at.utctimetuple()), dtype=np.int64),
+        'inspection_id': np.array(inspection_id, dtype=np.int64),
+        'probe_id': np.array(probe_id, dtype=np.int64),
+        'position': np.array(position, dtype=np.int32),
+        'url_type': np.array(url_type, dtype=np.int32),
+        'url_types': url_types.to_array(),
+        'scheme': np.array(scheme, dtype=np.int8),
+        'schemes': np.array(SCHEMES, dtype='U'),
+        'status_code': np.array(status_code, dtype=np.int16),
+        'timeout': np.array(timeout, dtype=np.bool_),
+        'content_type': np.array(content_type, dtype=np.int32),
+        'content_types': content_types.to_array(),
+        'latency': np.array(latency, dtype=np.float32),
+        'dataset_probe_id': np.array(dataset_probe_id, dtype=np.int64),
+        'dataset_position': np.array(dataset_position, dtype=np.int32),
+        'dataset_url_count': np.array(dataset_url_count, dtype=np.int32),
+        'error_type_id': np.array(error_type_id, dtype=np.int32),
+        'error_probe_id': np.array(error_probe_id, dtype=np.int64),
+    }
+
+
+def write_columns(columns, path):
+    """Write columns to path, by way of a temporary file so a partial file is never read"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    return path
+
+
+def export_columns(audit, directory=None):
+    """Write the columns of an audit (an Audit or its id). Returns the path written"""
+    if not isinstance(audit, Audit):
+        audit = Audit.objects.get(id=audit)
+    return write_columns(read_columns(audit), columns_path(audit.id, directory))
+
+
+def load_columns(path):
+    """The columns in a file written by export_columns, as a dictionary of numpy arrays"""
+    require_numpy()
+    with np.load(path, allow_pickle=False) as data:
+        return dict((name, data[name]) for name in data.files)
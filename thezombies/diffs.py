@@ -0,0 +1,107 @@
+"""
+Differences in URL health between two crawls of an agency's catalog.
+
+The latest inspection of each URL in both audits (requested_urls_distinct) is compared in a single
+query, a full outer join on requested_url, so neither audit is loaded into memory. Differences
+are streamed from a server-side cursor.
+"""
+from collections import namedtuple
+from django.db import connection
+
+from thezombies.exports import stream_sql
+from thezombies.models import Audit, URLInspection
+
+ADDED = 'added'
+REMOVED = 'removed'
+NEWLY_FAILING = 'newly_failing'
+NEWLY_FIXED = 'newly_fixed'
+CONTENT_TYPE_CHANGED = 'content_type_changed'
+
+# Kinds of difference. A URL is reported under the first that applies
+CHANGES = (ADDED, REMOVED, NEWLY_FAILING, NEWLY_FIXED, CONTENT_TYPE_CHANGED)
+
+AuditDiffRow = namedtuple('AuditDiffRow', ('change', 'url', 'old_status_code', 'new_status_code',
+                                           'old_content_type', 'new_content_type'))
+
+# An inspection failed if there was no response (e.g. a timeout) or an error status
+FAILING_SQL = '({0}.status_code IS NULL OR {0}.status_code >= 400)'
+
+DIFF_SQL = """
+    WITH old AS ({old}), new AS ({new})
+    SELECT change, url, old_status_code, new_status_code, old_content_type, new_content_type FROM (
+        SELECT CASE
+                WHEN old.requested_url IS NULL THEN '{added}'
+                WHEN new.requested_url IS NULL THEN '{removed}'
+                WHEN NOT {old_failing} AND {new_failing} THEN '{newly_failing}'
+                WHEN {old_failing} AND NOT {new_failing} THEN '{newly_fixed}'
+                WHEN old.content_type IS DISTINCT FROM new.content_type THEN '{content_type_changed}'
+            END AS change,
+            COALESCE(new.requested_url, old.requested_url) AS url,
+            old.status_code AS old_status_code, new.status_code AS new_status_code,
+            old.content_type AS old_content_type, new.content_type AS new_content_type
+        FROM old FULL OUTER JOIN new ON old.requested_url = new.requested_url
+    ) diff
+    WHERE change IS NOT NULL{where}
+"""
+
+
+def latest_inspections(audit):
+    """Latest inspection (requested URL, status code, content type) of each URL requested by a crawl"""
+    queryset = URLInspection.objects.filter(probe__audit=audit).initial_urls_distinct()
+    return queryset.values('requested_url', 'status_code', 'content__content_type')
+
+
+def check_audits(old_audit, new_audit):
+    for audit in (old_audit, new_audit):
+        if audit.audit_type != Audit.DATA_CATALOG_CRAWL:
+            raise ValueError(u'Audit {0} is not a catalog crawl'.format(audit.id))
+    if old_audit.agency_id != new_audit.agency_id:
+        raise ValueError(u'Audits {0} and {1} are for different agencies'.format(old_audit.id, new_audit.id))
+
+
+def diff_sql(old_audit, new_audit, changes=None, select=None, order_by='url'):
+    """The SQL and parameters comparing two audits, optionally limited to some kinds of changes"""
+    check_audits(old_audit, new_audit)
+    old_sql, old_params = latest_inspections(old_audit).query.sql_with_params()
+    new_sql, new_params = latest_inspections(new_audit).query.sql_with_params()
+    params = list(old_params) + list(new_params)
+    where = ''
+    if changes:
+        unknown = set(changes) - set(CHANGES)
+        if unknown:
+            raise ValueError(u'Unknown changes {0}'.format(', '.join(sorted(unknown))))
+        where = ' AND change = ANY(%s)'
+        params.append(list(changes))
+    sql = DIFF_SQL.format(old=old_sql, new=new_sql, where=where,
+                          old_failing=FAILING_SQL.format('old'), new_failing=FAILING_SQL.format('new'),
+                          added=ADDED, removed=REMOVED, newly_failing=NEWLY_FAILING, newly_fixed=NEWLY_FIXED,
+                          content_type_changed=CONTENT_TYPE_CHANGED)
+    if select:
+        sql = 'SELECT {0} FROM ({1}) diff_rows'.format(select, sql)
+    if order_by:
+        sql = '{0} ORDER BY {1}'.format(sql, order_by)
+    return sql, params
+
+
+def diff_audits(old_audit, new_audit, changes=None):
+    """
+    An iterator of AuditDiffRows for URLs whose health differs between two crawls of the same agency,
+    ordered by URL. Raises ValueError if the audits can't be compared
+    """
+    sql, params = diff_sql(old_audit, new_audit, changes)
+    return (AuditDiffRow(*row) for row in stream_sql(sql, params))
+
+
+def diff_summary(old_audit, new_audit):
+    """Number of URLs with each kind of change between two crawls, as a dictionary"""
+    sql, params = diff_sql(old_audit, new_audit, select='change, COUNT(*)', order_by=None)
+    with connection.cursor() as cursor:
+        cursor.execute('{0} GROUP BY change'.format(sql), params)
+        counts = dict(cursor.fetchall())
+    return dict((change, counts.get(change, 0)) for change in CHANGES)
+
+
+def previous_crawl(audit):
+    """The agency's last crawl before audit, or None"""
+    return Audit.objects.filter(agency_id=audit.agency_id, audit_type=Audit.DATA_CATALOG_CRAWL,
+                                created_at__lt=audit.created_at).order_by('-created_at').first()
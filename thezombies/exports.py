@@ -0,0 +1,202 @@
+"""
+Streaming exports of an audit's URL inspections, probes and errors as CSV or NDJSON.
+
+Rows are read with a server-side (named) cursor, a batch at a time, and written to the
+response as they are read, so exporting a large audit doesn't load it into memory.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from collections import OrderedDict
+from decimal import Decimal
+import csv
+import datetime
+import uuid
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from thezombies.models import URLInspection, Probe, ProbeError, ErrorType
+
+EXPORT_BATCH_SIZE = getattr(settings, 'EXPORT_BATCH_SIZE', 2000)
+
+# Filters that can be applied to inspections, named after URLInspectionQuerySet methods
+INSPECTION_FILTERS = ('all_errors', 'server_errors', 'client_errors', 'not_found', 'html_content',
+                      'initial_urls', 'http_urls', 'ftp_urls', 'suspicious_urls', 'sans_responses')
+
+
+def inspection_rows(audit):
+    return URLInspection.objects.filter(probe__audit=audit)
+
+
+def probe_rows(audit):
+    return Probe.objects.filter(audit=audit)
+
+
+def error_rows(audit):
+    return ProbeError.objects.filter(audit=audit)
+
+
+def error_message(row):
+    """Render a ProbeError row (with its type's class and template) into its message"""
+    error_type = ErrorType(error_class=row['error_class'], template=row.pop('template'))
+    row['message'] = error_type.render(row['params'])
+    return row
+
+
+class Export(object):
+    """
+    An export of an audit's rows.
+
+    :param get_queryset: Function returning the queryset for an audit
+    :param fields: (column, field) pairs read from the queryset
+    :param finish_row: Optional function that finishes a row (a dictionary of columns) before it is written
+    :param columns: Columns written, the columns in fields by default
+    """
+
+    def __init__(self, get_queryset, fields, finish_row=None, columns=None):
+        self.get_queryset = get_queryset
+        self.fields = fields
+        self.finish_row = finish_row
+        self.columns = columns or [name for name, field in fields]
+
+
+EXPORTS = {
+    'inspections': Export(inspection_rows, (
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('requested_url', 'requested_url'),
+        ('url', 'url'),
+        ('status_code', 'status_code'),
+        ('reason', 'reason'),
+        ('content_type', 'content__content_type'),
+        ('encoding', 'encoding'),
+        ('timeout', 'timeout'),
+        ('probe_id', 'probe_id'),
+        ('parent_id', 'parent_id'),
+        ('reused_from_id', 'reused_from_id'),
+    )),
+    'probes': Export(probe_rows, (
+        ('id', 'id'),
+        ('created_at', 'created_at'),
+        ('probe_type', 'probe_type'),
+        ('previous_id', 'previous_id'),
+        ('initial', 'initial'),
+        ('result', 'result'),
+    )),
+    'errors': Export(error_rows, (
+        ('id', 'id'),
+        ('probe_id', 'probe_id'),
+        ('error_class', 'error_type__error_class'),
+        ('template', 'error_type__template'),
+        ('params', 'params'),
+    ), error_message, columns=('id', 'probe_id', 'error_class', 'message', 'params')),
+}
+
+
+def export_queryset(export, audit, filters=()):
+    """
+    The queryset for an export of audit, with URLInspectionQuerySet filters (names from
+    INSPECTION_FILTERS) applied. Raises ValueError for unknown exports or filters
+    """
+    if export not in EXPORTS:
+        raise ValueError(u'Unknown export {0}'.format(export))
+    if filters and export != 'inspections':
+        raise ValueError(u'Filters only apply to inspections')
+    queryset = EXPORTS[export].get_queryset(audit)
+    for name in filters:
+        if name not in INSPECTION_FILTERS:
+            raise ValueError(u'Unknown filter {0}'.format(name))
+        queryset = getattr(queryset, name)()
+    return queryset.order_by('id')
+
+
+def stream_sql(sql, params, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the rows of a query, read with a server-side cursor.
+    Must be iterated on the thread that owns the database connection
+    """
+    with transaction.atomic():
+        # Named cursors only live inside a transaction
+        connection.ensure_connection()
+        cursor = connection.connection.cursor(name='export_{0}'.format(uuid.uuid4().hex))
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+
+def stream_rows(queryset, fields, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the values of fields for each row of queryset, read with a server-side cursor"""
+    sql, params = queryset.values_list(*fields).query.sql_with_params()
+    return stream_sql(sql, params, batch_size)
+
+
+def json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(u'{0!r} is not JSON serializable'.format(value))
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, default=json_default, sort_keys=True)
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    elif not isinstance(value, type(u'')):
+        value = u'{0}'.format(value)
+    return value.encode('utf-8') if str is bytes else value
+
+
+class LineBuffer(object):
+    """File-like object for csv.writer whose write returns the line instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(columns, rows):
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow([csv_value(column) for column in columns])
+    for row in rows:
+        yield writer.writerow([csv_value(row.get(column)) for column in columns])
+
+
+def iter_ndjson(columns, rows):
+    for row in rows:
+        yield json.dumps(OrderedDict((column, row.get(column)) for column in columns), default=json_default) + '\n'
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
+
+
+def export_audit(export, audit, export_format, filters=()):
+    """
+    Returns (content type, iterator of chunks) for an export of audit in export_format ('csv' or 'ndjson').
+    Raises ValueError for unknown exports, formats or filters
+    """
+    if export_format not in FORMATS:
+        raise ValueError(u'Unknown format {0}'.format(export_format))
+    queryset = export_queryset(export, audit, filters)
+    spec = EXPORTS[export]
+    names = [name for name, field in spec.fields]
+    rows = (dict(zip(names, values)) for values in stream_rows(queryset, [field for name, field in spec.fields]))
+    if spec.finish_row:
+        rows = (spec.finish_row(row) for row in rows)
+    write_rows, content_type = FORMATS[export_format]
+    return content_type, write_rows(spec.columns, rows)
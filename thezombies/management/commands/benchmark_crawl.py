@@ -0,0 +1,86 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.benchmarks import AgencyStandIn, run_benchmark
+
+MODES = ('crawl', 'validate')
+SCHEMAS = ('DATASET_1.0', 'DATASET_1.1')
+
+REPORT_FIELDS = (
+    ('Datasets', 'datasets', '{0}'),
+    ('URLs', 'urls', '{0}'),
+    ('URLs failed', 'urls_failed', '{0}'),
+    ('Seconds', 'seconds', '{0:.2f}'),
+    ('Datasets/sec', 'datasets_per_second', '{0:.2f}'),
+    ('URLs/sec', 'urls_per_second', '{0:.2f}'),
+    ('URL request p50 (s)', 'url_latency_p50', '{0:.4f}'),
+    ('URL request p90 (s)', 'url_latency_p90', '{0:.4f}'),
+    ('URL request p99 (s)', 'url_latency_p99', '{0:.4f}'),
+    ('URL request max (s)', 'url_latency_max', '{0:.4f}'),
+    ('Validation p50 (s)', 'validation_latency_p50', '{0:.4f}'),
+    ('Validation p90 (s)', 'validation_latency_p90', '{0:.4f}'),
+    ('Validation p99 (s)', 'validation_latency_p99', '{0:.4f}'),
+    ('Validation max (s)', 'validation_latency_max', '{0:.4f}'),
+    ('Peak RSS (MB)', 'peak_rss_mb', '{0:.1f}'),
+    ('DB queries', 'queries', '{0}'),
+    ('DB queries/URL', 'queries_per_url', '{0:.2f}'),
+    ('DB queries/dataset', 'queries_per_dataset', '{0:.2f}'),
+)
+
+
+class Command(BaseCommand):
+    help = ('Crawl and validate synthetic catalogs served from a local stand-in for agency servers, '
+            'running tasks eagerly in this process. Creates audits in the configured database, '
+            'so point it at a scratch database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', default='1000',
+                    help='Comma separated numbers of datasets per catalog, e.g. 1000,10000,100000'),
+        make_option('--schema', default='DATASET_1.0', choices=SCHEMAS,
+                    help='Shape of the synthetic catalogs'),
+        make_option('--mode', default='both', choices=MODES + ('both',),
+                    help='Run crawls, validations or both'),
+        make_option('--host', default='127.0.0.1'),
+        make_option('--port', type='int', default=0, help='Port for the stand-in server. Default is any free port'),
+        make_option('--urls-per-dataset', type='int', default=3),
+        make_option('--seed', type='int', default=0),
+        make_option('--request-timeout', type='float', default=5.0,
+                    help='Replaces REQUEST_TIMEOUT so that timeouts are quick'),
+        make_option('--slow-delay', type='float', default=1.0,
+                    help='Seconds the stand-in waits before answering a slow URL'),
+    )
+
+    def handle(self, *args, **options):
+        from thezombies.celery import app
+        from thezombies.tasks import urls
+
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of numbers')
+        modes = MODES if options['mode'] == 'both' else (options['mode'],)
+
+        app.conf.CELERY_ALWAYS_EAGER = True
+        urls.REQUEST_TIMEOUT = options['request_timeout']
+
+        stand_in = AgencyStandIn(host=options['host'], port=options['port'],
+                                 slow_delay=options['slow_delay'],
+                                 timeout_delay=options['request_timeout'] + 1).start()
+        if 'tls' not in stand_in.servers:
+            self.stderr.write('openssl not found, TLS scenarios are disabled')
+        try:
+            for size in sizes:
+                self.stdout.write('Writing {0} catalog with {1} datasets'.format(options['schema'], size))
+                stand_in.catalog(size, options['schema'], options['urls_per_dataset'], options['seed'])
+                for mode in modes:
+                    self.stdout.write('Running {0}...'.format(mode))
+                    self.report(run_benchmark(stand_in, mode, options['schema']))
+        finally:
+            stand_in.stop()
+
+    def report(self, result):
+        self.stdout.write('{mode} of {schema} catalog (audit {audit_id})'.format(**result))
+        for label, key, template in REPORT_FIELDS:
+            value = result.get(key, None)
+            self.stdout.write('  {0:<20} {1}'.format(label, template.format(value) if value is not None else 'n/a'))
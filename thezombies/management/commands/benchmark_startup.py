@@ -0,0 +1,41 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from thezombies.benchmarks import benchmark_startup, percentile
+
+SCHEMAS = ('DATASET_1.0', 'DATASET_1.1')
+
+REPORT_FIELDS = (
+    ('Setup (s)', 'setup_seconds', '{0:.3f}'),
+    ('Preload (s)', 'preload_seconds', '{0:.3f}'),
+    ('Ready (s)', 'ready_seconds', '{0:.3f}'),
+    ('First task p50 (s)', 'first_task_p50', '{0:.4f}'),
+    ('First task max (s)', 'first_task_max', '{0:.4f}'),
+    ('Child peak RSS (MB)', 'child_peak_rss_mb', '{0:.1f}'),
+)
+
+
+class Command(BaseCommand):
+    help = ('Time a cold worker start in a new interpreter, with and without WORKER_PRELOAD: setting up Django '
+            'and the task modules, preloading, and the first validation in each forked child.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--schema', default='DATASET_1.0', choices=SCHEMAS, help='Schema the first task validates'),
+        make_option('--children', type='int', default=4, help='Children forked, as by a prefork pool'),
+        make_option('--runs', type='int', default=3, help='Starts measured in each mode. Medians are reported'),
+    )
+
+    def handle(self, *args, **options):
+        for preload in (False, True):
+            self.stdout.write('Starting workers {0} preloading...'.format('with' if preload else 'without'))
+            results = [benchmark_startup(preload, options['schema'], options['children'])
+                       for run in range(options['runs'])]
+            self.report(preload, results)
+
+    def report(self, preload, results):
+        self.stdout.write('{0} ({1} runs, {2} children)'.format(
+            'WORKER_PRELOAD' if preload else 'Default', len(results), results[0]['children']))
+        for label, key, template in REPORT_FIELDS:
+            value = percentile([result[key] for result in results if result.get(key) is not None], 50)
+            self.stdout.write('  {0:<20} {1}'.format(label, template.format(value) if value is not None else 'n/a'))
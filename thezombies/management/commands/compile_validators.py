@@ -0,0 +1,73 @@
+from optparse import make_option
+from contextlib import closing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from jsonschema import Draft4Validator
+
+from thezombies.tasks.jsonstream import CatalogItemStream
+from thezombies.tasks.schemas import JSON_SCHEMAS, COMPILED_SCHEMA_DIR, compile_validator, load_schema
+from thezombies.tasks.urls import open_streaming_response
+from thezombies.tasks.utils import ResultDict
+from thezombies.tasks.validation import SCHEMA_ERROR_LIMIT, get_schema_prefix
+
+
+def formatted_errors(validator, instance):
+    """Errors as validate_json_object records them"""
+    result = ResultDict()
+    if not validator.is_valid(instance):
+        for count, error in enumerate(validator.iter_errors(instance)):
+            if count == SCHEMA_ERROR_LIMIT:
+                break
+            result.add_error(error)
+    return result.errors
+
+
+class Command(BaseCommand):
+    args = '[schema name ...]'
+    help = ('Compile JSON_SCHEMAS entries into specialized validators (cached in COMPILED_SCHEMA_DIR). '
+            'With --verify, check they report the same errors as jsonschema for every item in a catalog.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', default=False, help='Regenerate cached validators'),
+        make_option('--verify', default=None, help='Path or URL of a catalog to compare against jsonschema'),
+    )
+
+    def handle(self, *args, **options):
+        schema_names = args or sorted(JSON_SCHEMAS.keys())
+        for schema_name in schema_names:
+            if schema_name not in JSON_SCHEMAS:
+                raise CommandError('Unknown schema {0}'.format(schema_name))
+            validator = compile_validator(schema_name, use_cache=not options['force'])
+            if validator is None:
+                raise CommandError('Unable to load schema {0}'.format(schema_name))
+            self.stdout.write('Compiled {0} into {1}'.format(schema_name, COMPILED_SCHEMA_DIR or 'memory'))
+            if options['verify']:
+                self.verify(schema_name, validator, options['verify'])
+
+    def verify(self, schema_name, compiled, location):
+        reference = Draft4Validator(load_schema(schema_name))
+        items = mismatches = 0
+        timings = {'jsonschema': 0.0, 'compiled': 0.0}
+        if location.startswith(('http://', 'https://')):
+            catalog = open_streaming_response('GET', location)
+            stream = catalog.raw
+        else:
+            catalog = stream = open(location, 'rb')
+        with closing(catalog):
+            for position, item in CatalogItemStream(stream, get_schema_prefix(schema_name)):
+                results = {}
+                for name, validator in (('jsonschema', reference), ('compiled', compiled)):
+                    start = time.time()
+                    results[name] = formatted_errors(validator, item)
+                    timings[name] += time.time() - start
+                items += 1
+                if results['jsonschema'] != results['compiled']:
+                    mismatches += 1
+                    self.stderr.write('Item {0} differs:\n  jsonschema: {1}\n  compiled: {2}'.format(
+                        position, results['jsonschema'], results['compiled']))
+
+        self.stdout.write('{0}: {1} items, {2} mismatches. jsonschema {3:.3f}s, compiled {4:.3f}s'.format(
+            schema_name, items, mismatches, timings['jsonschema'], timings['compiled']))
+        if mismatches:
+            raise CommandError('Compiled validator for {0} disagrees with jsonschema'.format(schema_name))
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.models import Agency
+from thezombies.tasks import schedule_sweep
+
+
+class Command(BaseCommand):
+    help = ('Queue a sweep that crawls the catalogs of every agency (or those chosen), '
+            'smallest catalogs first, a few at a time.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--agency', action='append', dest='agencies', default=[],
+                    help='Slug of an agency to crawl. Can be repeated'),
+        make_option('--agency-type', choices=[choice for choice, label in Agency.AGENCY_TYPE_CHOICES],
+                    help='Only crawl agencies of this type'),
+        make_option('--schema', default='DATASET_1.0'),
+    )
+
+    def handle(self, *args, **options):
+        agencies = Agency.objects.all()
+        if options['agencies']:
+            agencies = agencies.filter(slug__in=options['agencies'])
+        if options['agency_type']:
+            agencies = agencies.filter(agency_type=options['agency_type'])
+        agency_ids = list(agencies.values_list('id', flat=True))
+        if not agency_ids:
+            raise CommandError('No agencies match')
+
+        result = schedule_sweep.delay(agency_ids, schema=options['schema'])
+        self.stdout.write('Queued a sweep of {0} agencies (task {1})'.format(len(agency_ids), result.id))
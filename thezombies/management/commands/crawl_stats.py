@@ -0,0 +1,76 @@
+from optparse import make_option
+from datetime import datetime
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.columnar import load_columns, columns_path, COLUMNAR_EXPORT_DIR
+from thezombies.models import Agency, Audit
+
+
+class Command(BaseCommand):
+    args = '[audit id ...]'
+    help = ('Crawl report statistics computed from columnar exports (see export_columns), and how they changed '
+            'across several crawls.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', default=COLUMNAR_EXPORT_DIR, help='Directory of the exports (COLUMNAR_EXPORT_DIR)'),
+        make_option('--agency', help='Every exported crawl of the agency with this slug'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            from thezombies import analytics
+        except ImportError as e:
+            raise CommandError(e)
+        directory = options['dir']
+        audit_ids = list(args)
+        if options['agency']:
+            agency = Agency.objects.filter(slug=options['agency']).first()
+            if agency is None:
+                raise CommandError('No agency {0}'.format(options['agency']))
+            audit_ids.extend(Audit.objects.filter(agency=agency, audit_type=Audit.DATA_CATALOG_CRAWL)
+                             .order_by('id').values_list('id', flat=True))
+        if not audit_ids:
+            raise CommandError('Give audit ids or --agency')
+
+        audits = []
+        for audit_id in audit_ids:
+            path = columns_path(audit_id, directory)
+            if os.path.exists(path):
+                audits.append(load_columns(path))
+            elif not options['agency']:
+                raise CommandError('No export of audit {0} in {1}'.format(audit_id, directory or '.'))
+
+        for columns in audits:
+            self.write_report(analytics, columns)
+        if len(audits) > 1:
+            self.write_trends(analytics.trends(audits))
+
+    def write_table(self, headings, rows):
+        self.stdout.write(u'| {0} |'.format(u' | '.join(headings)))
+        self.stdout.write(u'| {0} |'.format(u' | '.join(u'-' * len(heading) for heading in headings)))
+        for row in rows:
+            self.stdout.write(u'| {0} |'.format(u' | '.join(u'{0}'.format(value) for value in row)))
+        self.stdout.write('')
+
+    def write_report(self, analytics, columns):
+        stats = analytics.crawl_stats(columns)
+        self.stdout.write('## Audit {0}\n'.format(int(columns['audit_id'])))
+        self.write_table([heading for name, heading in analytics.REPORT_STATS],
+                         [[stats[name] for name, heading in analytics.REPORT_STATS]])
+        self.stdout.write('### Content Types\n')
+        self.write_table(('Number', 'Pct', 'Type'),
+                         [(count, '{0:.2%}'.format(share), content_type or 'None/Unknown')
+                          for count, share, content_type in analytics.content_type_shares(columns)])
+
+    def write_trends(self, rows):
+        self.stdout.write('## Trends\n')
+        self.write_table(('Audit', 'Created', 'URLs inspected', 'Failing', 'Timeouts', 'Median latency (s)',
+                          'Entries without URLs', 'Errors'),
+                         [(row['audit_id'], datetime.utcfromtimestamp(row['created_at']).strftime('%Y-%m-%d %H:%M'),
+                           row['urls_inspected'], '{0:.2%}'.format(row['failure_rate']),
+                           '{0:.2%}'.format(row['timeout_rate']),
+                           '' if row['latency_p50'] is None else '{0:.3f}'.format(row['latency_p50']),
+                           row['entries_without_urls'], row['errors'])
+                          for row in rows])
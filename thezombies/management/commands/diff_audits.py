@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.diffs import diff_audits, diff_summary, previous_crawl, CHANGES, AuditDiffRow
+from thezombies.exports import FORMATS
+from thezombies.models import Audit
+
+
+class Command(BaseCommand):
+    args = '[old audit id] <new audit id>'
+    help = ('Compare two crawls of an agency: URLs that were added or removed, started or stopped failing, '
+            'or changed content type. Compares with the previous crawl if only one audit is given.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--change', action='append', dest='changes', default=[], choices=CHANGES,
+                    help='Only list this kind of change. Can be repeated'),
+        make_option('--format', default='csv', choices=sorted(FORMATS.keys())),
+        make_option('--summary', action='store_true', default=False, help='Only count the changes'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) not in (1, 2):
+            raise CommandError('Give one or two audit ids')
+        audits = []
+        for audit_id in args:
+            try:
+                audits.append(Audit.objects.get(id=audit_id))
+            except (Audit.DoesNotExist, ValueError):
+                raise CommandError('No audit {0}'.format(audit_id))
+        if len(audits) == 1:
+            previous = previous_crawl(audits[0])
+            if previous is None:
+                raise CommandError('No crawl before audit {0}'.format(audits[0].id))
+            audits.insert(0, previous)
+        old_audit, new_audit = audits
+
+        try:
+            if options['summary']:
+                summary = diff_summary(old_audit, new_audit)
+                for change in CHANGES:
+                    self.stdout.write('{0}: {1}'.format(change, summary[change]))
+                return
+            rows = (row._asdict() for row in diff_audits(old_audit, new_audit, options['changes']))
+        except ValueError as e:
+            raise CommandError(e)
+        write_rows, content_type = FORMATS[options['format']]
+        for chunk in write_rows(AuditDiffRow._fields, rows):
+            self.stdout.write(chunk, ending='')
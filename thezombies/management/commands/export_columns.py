@@ -0,0 +1,40 @@
+from optparse import make_option
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.columnar import export_columns, columns_path, COLUMNAR_EXPORT_DIR
+from thezombies.models import Audit
+
+
+class Command(BaseCommand):
+    args = '[audit id ...]'
+    help = ('Write columnar exports (NumPy .npz files) of crawls: those given, or every completed crawl '
+            'that hasn\'t been exported yet.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', default=COLUMNAR_EXPORT_DIR, help='Directory to write to (COLUMNAR_EXPORT_DIR)'),
+    )
+
+    def handle(self, *args, **options):
+        directory = options['dir']
+        if not directory:
+            raise CommandError('Set COLUMNAR_EXPORT_DIR or give --dir')
+        if args:
+            audits = []
+            for audit_id in args:
+                try:
+                    audits.append(Audit.objects.get(id=audit_id))
+                except (Audit.DoesNotExist, ValueError):
+                    raise CommandError('No audit {0}'.format(audit_id))
+        else:
+            audits = [audit for audit in Audit.objects.filter(audit_type=Audit.DATA_CATALOG_CRAWL,
+                                                              progress__completed_at__isnull=False).order_by('id')
+                      if not os.path.exists(columns_path(audit.id, directory))]
+
+        try:
+            for audit in audits:
+                self.stdout.write('Audit {0} ({1}): {2}'.format(audit.id, audit.agency, export_columns(audit, directory)))
+        except ImportError as e:
+            raise CommandError(e)
+        self.stdout.write('Exported {0} audits'.format(len(audits)))
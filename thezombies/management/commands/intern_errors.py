@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from thezombies.models import Probe, ProbeError
+
+
+class Command(BaseCommand):
+    help = ('Move errors stored as text in Probe.errors into ProbeErrors that refer to interned ErrorTypes, '
+            'emptying Probe.errors. Runs in batches and can be stopped and run again.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000, help='Probes moved per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        probe_count = error_count = 0
+        while True:
+            probes = list(Probe.objects.filter(id__gt=last_id, errors__len__gt=0)
+                                       .order_by('id').only('id', 'audit', 'errors')[:batch_size])
+            if not probes:
+                break
+            with transaction.atomic():
+                for probe in probes:
+                    error_count += len(ProbeError.objects.record(probe, probe.errors))
+                Probe.objects.filter(id__in=[probe.id for probe in probes]).update(errors=[])
+            probe_count += len(probes)
+            last_id = probes[-1].id
+            self.stdout.write('Moved {0} errors from {1} probes'.format(error_count, probe_count))
+        self.stdout.write('Done. Moved {0} errors from {1} probes'.format(error_count, probe_count))
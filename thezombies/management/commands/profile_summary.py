@@ -0,0 +1,47 @@
+from optparse import make_option
+import os
+import pstats
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.profiling import TASK_PROFILE_DIR, PROFILE_EXTENSION
+
+
+class Command(BaseCommand):
+    help = ('Merge sampled task profiles (see thezombies.profiling) into one pstats file per task '
+            'and print the most expensive functions.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dir', default=TASK_PROFILE_DIR, help='Directory profiles were written to'),
+        make_option('--task', default=None, help='Only summarize tasks whose name contains this'),
+        make_option('--sort', default='cumulative', help='pstats sort key, e.g. cumulative, tottime, calls'),
+        make_option('--limit', type='int', default=25, help='Number of functions to print per task'),
+    )
+
+    def handle(self, *args, **options):
+        profile_dir = options['dir']
+        if not os.path.isdir(profile_dir):
+            raise CommandError('No profiles found in {0}'.format(profile_dir))
+
+        for task_name in sorted(os.listdir(profile_dir)):
+            task_dir = os.path.join(profile_dir, task_name)
+            if not os.path.isdir(task_dir) or (options['task'] and options['task'] not in task_name):
+                continue
+            files = [os.path.join(task_dir, f) for f in sorted(os.listdir(task_dir)) if f.endswith(PROFILE_EXTENSION)]
+            if not files:
+                continue
+            output = StringIO()
+            stats = pstats.Stats(files[0], stream=output)
+            for filename in files[1:]:
+                stats.add(filename)
+            summary_path = os.path.join(profile_dir, '{0}.pstats'.format(task_name))
+            stats.dump_stats(summary_path)
+
+            self.stdout.write('{0}: {1} profiles merged into {2}'.format(task_name, len(files), summary_path))
+            stats.sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(output.getvalue())
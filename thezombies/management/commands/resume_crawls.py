@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from thezombies.models import Audit, AuditProgress
+from thezombies.tasks.crawl import resume_crawl
+from thezombies.tasks.progress import stopped_crawls, new_lease_token, claim_lease, hand_over_lease
+
+
+class Command(BaseCommand):
+    args = '[audit id ...]'
+    help = ('Resume catalog crawls from their checkpoints: those given, or every crawl that stopped before '
+            'dispatching its whole catalog (e.g. after a deploy or a worker was killed).')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False, help='List the crawls without resuming them'),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            audits = []
+            for audit_id in args:
+                audit = Audit.objects.filter(id=audit_id, audit_type=Audit.DATA_CATALOG_CRAWL).first()
+                if audit is None:
+                    raise CommandError('No crawl audit {0}'.format(audit_id))
+                if AuditProgress.objects.filter(audit=audit, dispatch_complete=True).exists():
+                    raise CommandError('Crawl {0} has dispatched its whole catalog'.format(audit_id))
+                audits.append(audit)
+        else:
+            audits = [progress.audit for progress in stopped_crawls()]
+
+        resumed = 0
+        for audit in audits:
+            if not options['dry_run']:
+                # Claiming the lease first means the crawl is only resumed once, even if it is being resumed elsewhere
+                if not claim_lease(audit.id, new_lease_token()):
+                    self.stdout.write('Audit {0} ({1}): still running, skipped'.format(audit.id, audit.agency))
+                    continue
+                resume_crawl(audit, lease_token=hand_over_lease(audit.id))
+            self.stdout.write('Audit {0} ({1}): checkpoint at object {2}, byte {3}'.format(
+                audit.id, audit.agency, audit.checkpoint_position or 0, audit.checkpoint_offset or 0))
+            resumed += 1
+        self.stdout.write('{0} {1} crawls'.format('Found' if options['dry_run'] else 'Resumed', resumed))
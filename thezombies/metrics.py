@@ -0,0 +1,148 @@
+"""
+Timing histograms for the hot paths of tasks.
+
+Observations are aggregated in each process and added to hashes in Redis every METRICS_FLUSH_INTERVAL
+seconds, at the end of every task, and when the worker process shuts down, so histograms from every worker
+can be served together in the Prometheus text format.
+"""
+from __future__ import absolute_import
+from bisect import bisect_left
+from celery.signals import task_postrun, worker_process_shutdown
+from contextlib import contextmanager
+import time
+
+from django.conf import settings
+
+from thezombies.utils import get_redis
+
+import logging
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = getattr(settings, 'METRICS_ENABLED', True)
+METRICS_FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)  # seconds
+METRICS_KEY_PREFIX = 'thezombies:metrics'
+METRICS_NAMESPACE = 'thezombies'
+
+# Upper bounds (seconds) of histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 180.0)
+
+HISTOGRAMS = {
+    'http_dns_seconds': 'Time resolving a host name for an HTTP connection',
+    'http_connect_seconds': 'Time establishing a TCP connection',
+    'http_tls_seconds': 'Time for a TLS handshake',
+    'http_ttfb_seconds': 'Time from sending a request to receiving response headers',
+    'url_request_seconds': 'Total time to request a URL, including redirects',
+    'url_db_write_seconds': 'Time writing the probe and inspection for a URL',
+    'catalog_object_parse_seconds': 'Time to read and parse one object from a streamed catalog',
+    'validation_seconds': 'Time validating one object against a JSON schema',
+}
+
+_pending = {}
+_last_flush = time.time()
+_listeners = []
+
+
+def add_listener(listener):
+    """Call listener(name, value) for every observation made in this process"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def observe(name, value):
+    """Record a value (in seconds) in a histogram"""
+    global _last_flush
+    for listener in _listeners:
+        listener(name, value)
+    if not METRICS_ENABLED:
+        return
+    hist = _pending.get(name, None)
+    if hist is None:
+        hist = _pending[name] = {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+    hist['buckets'][bisect_left(BUCKETS, value)] += 1
+    hist['sum'] += value
+    hist['count'] += 1
+    if time.time() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+@contextmanager
+def timer(name):
+    """Context manager recording the time spent in its block"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start)
+
+
+def timed_iter(iterable, name):
+    """Wrap an iterator, recording the time taken to produce each item"""
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.time() - start)
+        yield item
+
+
+def histogram_key(name):
+    return '{0}:{1}'.format(METRICS_KEY_PREFIX, name)
+
+
+def flush():
+    """Add observations aggregated in this process to the totals in Redis"""
+    global _pending, _last_flush
+    pending, _pending = _pending, {}
+    _last_flush = time.time()
+    if not pending:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for name, hist in pending.items():
+            key = histogram_key(name)
+            for index, count in enumerate(hist['buckets']):
+                if count:
+                    pipe.hincrby(key, 'bucket:{0}'.format(index), count)
+            pipe.hincrbyfloat(key, 'sum', hist['sum'])
+            pipe.hincrby(key, 'count', hist['count'])
+        pipe.execute()
+    except Exception as e:
+        # Metrics should never break a task
+        logger.warn(u'Unable to flush metrics: {0!r}'.format(e))
+
+
+def flush_after(sender=None, **kwargs):
+    flush()
+
+
+# Add observations when each task ends and when a worker process shuts down, rather than waiting for the next one
+task_postrun.connect(flush_after, weak=False)
+worker_process_shutdown.connect(flush_after, weak=False)
+
+
+def render_prometheus():
+    """Histograms from Redis in the Prometheus text exposition format"""
+    lines = []
+    pipe = get_redis().pipeline(transaction=False)
+    names = sorted(HISTOGRAMS.keys())
+    for name in names:
+        pipe.hgetall(histogram_key(name))
+    for name, values in zip(names, pipe.execute()):
+        values = {k.decode('utf-8') if isinstance(k, bytes) else k: v for k, v in values.items()}
+        metric = '{0}_{1}'.format(METRICS_NAMESPACE, name)
+        lines.append('# HELP {0} {1}'.format(metric, HISTOGRAMS[name]))
+        lines.append('# TYPE {0} histogram'.format(metric))
+        cumulative = 0
+        for index, bound in enumerate(BUCKETS + ('+Inf',)):
+            cumulative += int(values.get('bucket:{0}'.format(index), 0))
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, bound, cumulative))
+        lines.append('{0}_sum {1}'.format(metric, float(values.get('sum', 0))))
+        lines.append('{0}_count {1}'.format(metric, int(values.get('count', 0))))
+    return '\n'.join(lines) + '\n'
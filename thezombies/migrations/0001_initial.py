@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import thezombies.models
+import django_hstore.fields
+import djorm_pgarray.fields
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Agency',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('agency_type', models.CharField(default=b'O', max_length=1, choices=[(b'C', b'Cabinet'), (b'I', b'Independent'), (b'S', b'Sub-Agency'), (b'O', b'Other/Unknown')])),
+                ('slug', models.SlugField(unique=True, max_length=120)),
+                ('url', models.URLField(unique=True)),
+                ('parent', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to='thezombies.Agency', null=True)),
+            ],
+            options={
+                'ordering': ('agency_type', 'name'),
+                'verbose_name_plural': 'agencies',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Audit',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('audit_type', models.CharField(default='ADT', max_length=3, choices=[('ADT', 'Generic Audit'), ('DCV', 'Data Catalog Validation'), ('DCC', 'Data Catalog Crawl')])),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('notes', models.TextField(help_text=b'You can record basic (unformatted text) notes here.', blank=True)),
+                ('messages', djorm_pgarray.fields.TextArrayField(default=thezombies.models.list_default, editable=False, dbtype='text', help_text=b'Stores messages generated when audit was run.')),
+                ('agency', models.ForeignKey(to='thezombies.Agency')),
+            ],
+            options={
+                'ordering': ('-created_at',),
+                'get_latest_by': 'created_at',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Probe',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('probe_type', models.PositiveSmallIntegerField(default=0, choices=[(0, b'Generic Probe'), (1, b'URL Probe'), (2, b'JSON Probe'), (3, b'Validation Probe')])),
+                ('initial', django_hstore.fields.DictionaryField(default=thezombies.models.dictionary_default, null=True, blank=True)),
+                ('result', django_hstore.fields.DictionaryField(default=thezombies.models.dictionary_default, null=True, blank=True)),
+                ('errors', djorm_pgarray.fields.TextArrayField(default=thezombies.models.list_default, dbtype='text')),
+                ('audit', models.ForeignKey(blank=True, to='thezombies.Audit', null=True)),
+                ('previous', models.ForeignKey(related_name='next', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='thezombies.Probe', null=True)),
+            ],
+            options={
+                'ordering': ('-created_at',),
+                'get_latest_by': 'created_at',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ResponseContent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('binary', models.BinaryField(null=True, blank=True)),
+                ('content_type', models.CharField(max_length=120, null=True, blank=True)),
+                ('length', models.IntegerField(null=True, editable=False, blank=True)),
+            ],
+            options={
+                'verbose_name': 'ResponseContent',
+                'verbose_name_plural': 'ResponsesContents',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='URLInspection',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('url', models.TextField(null=True, blank=True)),
+                ('requested_url', models.TextField()),
+                ('encoding', models.CharField(max_length=120, null=True, blank=True)),
+                ('apparent_encoding', models.CharField(max_length=120, null=True, blank=True)),
+                ('history', django_hstore.fields.ReferencesField(null=True, blank=True)),
+                ('status_code', models.IntegerField(max_length=3, null=True, blank=True)),
+                ('reason', models.CharField(help_text=b'Textual reason of responded HTTP Status, e.g. "Not Found" or "OK".', max_length=80, null=True, blank=True)),
+                ('headers', django_hstore.fields.DictionaryField(default=thezombies.models.dictionary_default)),
+                ('timeout', models.BooleanField(default=False)),
+                ('content', models.OneToOneField(related_name='content_for', null=True, editable=False, to='thezombies.ResponseContent')),
+                ('parent', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to='thezombies.URLInspection', null=True)),
+                ('probe', models.ForeignKey(related_name='url_inspections', blank=True, to='thezombies.Probe', null=True)),
+            ],
+            options={
+                'ordering': ('-created_at', 'requested_url'),
+                'get_latest_by': 'created_at',
+                'verbose_name': 'URL Inspection',
+                'verbose_name_plural': 'URL Inspections',
+            },
+            bases=(models.Model,),
+        ),
+    ]
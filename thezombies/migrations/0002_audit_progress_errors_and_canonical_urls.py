@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import djorm_pgarray.fields
+import thezombies.models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thezombies', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('message', models.TextField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('audit', models.ForeignKey(related_name='message_set', to='thezombies.Audit')),
+            ],
+            options={
+                'ordering': ('created_at', 'id'),
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='AuditProgress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('datasets_dispatched', models.PositiveIntegerField(default=0)),
+                ('datasets_done', models.PositiveIntegerField(default=0)),
+                ('urls_dispatched', models.PositiveIntegerField(default=0)),
+                ('urls_done', models.PositiveIntegerField(default=0, help_text=b'URLs inspected, including failures.')),
+                ('urls_failed', models.PositiveIntegerField(default=0)),
+                ('dispatch_complete', models.BooleanField(default=False, help_text=b'Every object in the catalog has been dispatched.')),
+                ('completed_at', models.DateTimeField(null=True, blank=True)),
+                ('audit', models.OneToOneField(related_name='progress', to='thezombies.Audit')),
+            ],
+            options={
+                'verbose_name_plural': 'audit progress',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='CanonicalURL',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('url', models.TextField()),
+                ('url_hash', models.CharField(unique=True, max_length=40, editable=False)),
+                ('host', models.CharField(max_length=255, db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('inspected_at', models.DateTimeField(null=True, blank=True)),
+                ('status_history', models.BinaryField(null=True, blank=True)),
+                ('latest_inspection', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='thezombies.URLInspection', null=True)),
+            ],
+            options={
+                'verbose_name': 'Canonical URL',
+                'verbose_name_plural': 'Canonical URLs',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ErrorType',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('error_class', models.CharField(db_index=True, max_length=100, blank=True)),
+                ('template', models.TextField()),
+                ('digest', models.CharField(unique=True, max_length=40, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='ProbeError',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('params', djorm_pgarray.fields.TextArrayField(default=thezombies.models.list_default, dbtype='text')),
+                ('audit', models.ForeignKey(to='thezombies.Audit', blank=True, null=True, db_index=False)),
+                ('error_type', models.ForeignKey(to='thezombies.ErrorType')),
+                ('probe', models.ForeignKey(related_name='error_set', to='thezombies.Probe')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='probeerror',
+            index_together=set([('audit', 'error_type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='auditmessage',
+            index_together=set([('audit', 'created_at')]),
+        ),
+        migrations.AddField(
+            model_name='audit',
+            name='catalog_validator',
+            field=models.CharField(help_text=b'ETag or Last-Modified of the catalog, to resume reading it.', max_length=255, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='audit',
+            name='checkpoint_at',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='audit',
+            name='checkpoint_offset',
+            field=models.BigIntegerField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='audit',
+            name='checkpoint_position',
+            field=models.PositiveIntegerField(null=True, editable=False, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='audit',
+            name='resume_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='urlinspection',
+            name='canonical_url',
+            field=models.ForeignKey(related_name='inspections', blank=True, to='thezombies.CanonicalURL', null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='urlinspection',
+            name='reused_from',
+            field=models.ForeignKey(related_name='reuses', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='thezombies.URLInspection', null=True),
+            preserve_default=True,
+        ),
+    ]
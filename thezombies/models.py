@@ -1,18 +1,32 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
 from requests import Response
+from psycopg2 import Binary
+import calendar
+import hashlib
+import re
+import struct
+import threading
 from attrdict import AttrDict
 
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.db import models, connection, transaction, DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+from django_atomic_signals.signals import post_enter_atomic_block, post_exit_atomic_block
+from django.db.models import Q, F, Count
+from django.utils import timezone
 from django_hstore import hstore
 from django_hstore.query import HStoreQuerySet
 from djorm_pgarray.fields import TextArrayField
 from django.utils.text import slugify
 from django.core.urlresolvers import reverse
 
+from thezombies.utils import canonical_url
+
 try:
-    from urllib.parse import urljoin
+    from urllib.parse import urljoin, urlsplit
 except ImportError:
-    from urlparse import urljoin
+    from urlparse import urljoin, urlsplit
 
 
 def list_default():
@@ -26,6 +40,53 @@ def dictionary_default():
 http_urls_q = Q(requested_url__startswith='http')
 ftp_urls_q = Q(requested_url__startswith='ftp')
 
+# Changes between working and failing after which a URL is considered to be flapping
+URL_FLAPPING_THRESHOLD = getattr(settings, 'URL_FLAPPING_THRESHOLD', 3)
+
+# Guard against runaway recursion should a chain of probes ever loop back on itself
+PROBE_CHAIN_MAX_DEPTH = 64
+
+# Walk from a set of probes up through Probe.previous. depth is 0 for the starting probes.
+PROBE_ANCESTORS_CTE = """
+    WITH RECURSIVE probe_chain(id, previous_id, origin_id, depth) AS (
+        SELECT id, previous_id, id, 0 FROM {table} WHERE id = ANY(%s::integer[])
+      UNION ALL
+        SELECT p.id, p.previous_id, c.origin_id, c.depth + 1
+        FROM {table} p INNER JOIN probe_chain c ON p.id = c.previous_id
+        WHERE c.depth < %s
+    )
+"""
+
+# Walk from a set of probes down through Probe.next. depth is 0 for the starting probes.
+PROBE_DESCENDANTS_CTE = """
+    WITH RECURSIVE probe_chain(id, previous_id, origin_id, depth) AS (
+        SELECT id, previous_id, id, 0 FROM {table} WHERE id = ANY(%s::integer[])
+      UNION ALL
+        SELECT p.id, p.previous_id, c.origin_id, c.depth + 1
+        FROM {table} p INNER JOIN probe_chain c ON p.previous_id = c.id
+        WHERE c.depth < %s
+    )
+"""
+
+# Walk up from each probe to its nearest ancestor of a root type (or the start of its chain, where the type is
+# NULL or there is no such ancestor), then back down to every probe descending from that root.
+PROBE_TREES_CTE = """
+    WITH RECURSIVE probe_up(id, previous_id, probe_type, depth) AS (
+        SELECT id, previous_id, probe_type, 0 FROM {table} WHERE id = ANY(%s::integer[])
+      UNION ALL
+        SELECT p.id, p.previous_id, p.probe_type, u.depth + 1
+        FROM {table} p INNER JOIN probe_up u ON p.id = u.previous_id
+        WHERE u.depth < %s AND u.probe_type IS DISTINCT FROM %s
+    ),
+    probe_chain(id, previous_id, origin_id, depth) AS (
+        SELECT DISTINCT id, previous_id, id, 0 FROM probe_up WHERE previous_id IS NULL OR probe_type = %s
+      UNION ALL
+        SELECT p.id, p.previous_id, c.origin_id, c.depth + 1
+        FROM {table} p INNER JOIN probe_chain c ON p.previous_id = c.id
+        WHERE c.depth < %s
+    )
+"""
+
 
 class URLInspectionQuerySet(HStoreQuerySet):
 
@@ -85,6 +146,12 @@ class URLInspectionQuerySet(HStoreQuerySet):
     def sans_responses_distinct(self):
         return self.sans_responses().requested_urls_distinct()
 
+    def with_error_counts(self):
+        """Add error_count, the number of errors recorded for each inspection's probe, in the same query"""
+        error_count_sql = 'SELECT COUNT(*) FROM {error} WHERE {error}.probe_id = {inspection}.probe_id'.format(
+            error=ProbeError._meta.db_table, inspection=self.model._meta.db_table)
+        return self.extra(select={'error_count': error_count_sql})
+
 
 class URLInspectionManager(hstore.HStoreManager):
 
@@ -103,24 +170,44 @@ class URLInspectionManager(hstore.HStoreManager):
             if save_content:
                 content.binary = resp.content
                 content.save()
+            requested_url = resp.history[0].url if len(resp.history) > 0 else resp.request.url
             obj = self.create(content=content, url=resp.url, status_code=resp.status_code,
-                              encoding=resp.encoding, reason=resp.reason)
-            obj.requested_url = resp.history[0].url if len(resp.history) > 0 else resp.request.url
-            obj.headers = dict(resp.headers)
+                              encoding=resp.encoding, reason=resp.reason,
+                              requested_url=requested_url, headers=dict(resp.headers))
             # TODO: defer detection of apparent encoding. A task, perhaps
             # if save_content:
             #     obj.apparent_encoding = resp.apparent_encoding
-            for n, hist in enumerate(resp.history):
-                histobj = self.create(requested_url=hist.request.url, url=hist.url,
-                                      status_code=hist.status_code, encoding=hist.encoding, parent=obj)
-                histobj.headers = dict(hist.headers)
-                histobj.save()
-                obj.history[str(n)] = histobj
+            if resp.history:
+                # Write the redirect history in bulk, then look up the ids to reference them
+                history = [self.model(requested_url=hist.request.url, url=hist.url, status_code=hist.status_code,
+                                      encoding=hist.encoding, reason=hist.reason, parent=obj,
+                                      headers=dict(hist.headers))
+                           for hist in resp.history]
+                self.bulk_create(history)
+                history_ids = self.filter(parent=obj).order_by('id').values_list('id', flat=True)
+                for n, (histobj, hist_id) in enumerate(zip(history, history_ids)):
+                    histobj.pk = hist_id
+                    obj.history[str(n)] = histobj
 
             return obj
         else:
             raise TypeError(u'create_from_response expects a requests.Response object or a compatible dictionary')
 
+    def reuse(self, inspection, **fields):
+        """
+        Record a stored inspection again (e.g. for another audit) without requesting its URL.
+        The copy refers to the original in reused_from, which keeps the redirect history and content
+        """
+        content = None
+        if inspection.content_id:
+            content = ResponseContent.objects.create(content_type=inspection.content.content_type)
+        values = dict(content=content, url=inspection.url, requested_url=inspection.requested_url,
+                      encoding=inspection.encoding, status_code=inspection.status_code, reason=inspection.reason,
+                      headers=dict(inspection.headers or {}), timeout=inspection.timeout,
+                      canonical_url_id=inspection.canonical_url_id, reused_from=inspection)
+        values.update(fields)
+        return self.create(**values)
+
 
 class ProbeQuerySet(HStoreQuerySet):
 
@@ -148,6 +235,63 @@ class ProbeQuerySet(HStoreQuerySet):
     def validation_probes(self):
         return self.filter(probe_type=Probe.VALIDATION_PROBE)
 
+    def _chain_filter(self, cte, probe_ids, include_self, params):
+        """Restrict queryset to probes found by a recursive CTE, in a single query"""
+        table = self.model._meta.db_table
+        where = u'"{table}"."id" IN ({cte} SELECT id FROM probe_chain{exclude})'.format(
+            table=table, cte=cte.format(table=table), exclude=u'' if include_self else u' WHERE depth > 0')
+        return self.extra(where=[where], params=[list(probe_ids)] + params)
+
+    def ancestors(self, probe_ids, include_self=False):
+        """Probes reachable from probe_ids by following Probe.previous"""
+        return self._chain_filter(PROBE_ANCESTORS_CTE, probe_ids, include_self, [PROBE_CHAIN_MAX_DEPTH])
+
+    def descendants(self, probe_ids, include_self=False):
+        """Probes reachable from probe_ids by following Probe.next"""
+        return self._chain_filter(PROBE_DESCENDANTS_CTE, probe_ids, include_self, [PROBE_CHAIN_MAX_DEPTH])
+
+    @staticmethod
+    def tree_params(root_type):
+        return [PROBE_CHAIN_MAX_DEPTH, root_type, root_type, PROBE_CHAIN_MAX_DEPTH]
+
+    def trees(self, probe_ids, root_type=None):
+        """
+        Every probe in the trees that contain probe_ids. A tree starts at the nearest ancestor of type root_type
+        (e.g. a dataset's JSON_PROBE), or at the start of the chain if root_type is None or there is no such
+        ancestor. In a crawl, the start of every chain is the audit's probe, so its tree is the whole audit
+        """
+        return self._chain_filter(PROBE_TREES_CTE, probe_ids, True, self.tree_params(root_type))
+
+    def chain_probes(self, cte, probe_ids, params):
+        """
+        Run a recursive CTE and return a RawQuerySet of probes annotated with chain_origin_id and chain_depth,
+        ordered by origin and depth. The filters of this queryset apply to the probes returned
+        (the walk itself still passes through probes they exclude), its ordering doesn't
+        """
+        table = self.model._meta.db_table
+        where, where_params = u'', []
+        if self.query.where:
+            subquery, where_params = self.values('id').order_by().query.sql_with_params()
+            where = u' WHERE {table}.id IN ({subquery})'.format(table=table, subquery=subquery)
+        sql = u"""{cte}
+            SELECT {table}.*, probe_chain.origin_id AS chain_origin_id, probe_chain.depth AS chain_depth
+            FROM {table} INNER JOIN probe_chain ON {table}.id = probe_chain.id{where}
+            ORDER BY probe_chain.origin_id, probe_chain.depth""".format(table=table, cte=cte.format(table=table),
+                                                                        where=where)
+        return self.model.objects.raw(sql, [list(probe_ids)] + list(params) + list(where_params))
+
+    def tree_map(self, probe_ids, root_type=None):
+        """
+        Resolve the trees for many probes in one query (see trees, e.g. root_type=Probe.JSON_PROBE for the
+        dataset that produced each URL probe).
+        Returns a dictionary mapping each root probe id to a list of probes in its tree, ordered by depth
+        """
+        trees = {}
+        probes = self.chain_probes(PROBE_TREES_CTE, probe_ids, self.tree_params(root_type))
+        for probe in probes:
+            trees.setdefault(probe.chain_origin_id, []).append(probe)
+        return trees
+
 
 class Probe(models.Model):
     """A component of an Audit that takes some initial data and
@@ -172,6 +316,8 @@ class Probe(models.Model):
     previous = models.ForeignKey('self', related_name='next', blank=True, null=True, on_delete=models.SET_NULL)
     initial = hstore.DictionaryField(blank=True, null=True, default=dictionary_default)
     result = hstore.DictionaryField(blank=True, null=True, default=dictionary_default)
+    # Errors are recorded as ProbeErrors, this holds errors recorded before those existed
+    # until they are moved by the intern_errors command
     errors = TextArrayField(blank=True, null=True, default=list_default)
     audit = models.ForeignKey('Audit', null=True, blank=True)
 
@@ -187,12 +333,28 @@ class Probe(models.Model):
         get_latest_by = 'created_at'
         ordering = ('-created_at',)
 
+    def error_list(self):
+        """Messages for the errors recorded for this probe, see ProbeError"""
+        return [error.message for error in self.error_set.select_related('error_type').order_by('id')]
+
     def error_count(self):
-        return len(self.errors)
+        return self.error_set.count()
 
     def get_absolute_url(self):
         return reverse('probe-detail', kwargs={'pk': str(self.pk)})
 
+    def get_ancestors(self):
+        """Previous probes in this probe's chain, nearest first. Resolved in a single query"""
+        return list(Probe.objects.chain_probes(PROBE_ANCESTORS_CTE, [self.pk], [PROBE_CHAIN_MAX_DEPTH]))[1:]
+
+    def get_descendants(self):
+        """Probes that follow this one in its chain (breadth-first). Resolved in a single query"""
+        return list(Probe.objects.chain_probes(PROBE_DESCENDANTS_CTE, [self.pk], [PROBE_CHAIN_MAX_DEPTH]))[1:]
+
+    def get_chain(self):
+        """Ancestors (root first), this probe, and its descendants"""
+        return list(reversed(self.get_ancestors())) + [self] + self.get_descendants()
+
 
 class Audit(models.Model):
     """An audit on agency, made up of auditables"""
@@ -213,8 +375,16 @@ class Audit(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     notes = models.TextField(blank=True, help_text='You can record basic (unformatted text) notes here.')
+    # Messages from before AuditMessage, see message_list
     messages = TextArrayField(blank=True, null=True, default=list_default, editable=False,
                               help_text='Stores messages generated when audit was run.')
+    # Where a catalog crawl can resume: the position and byte offset of the next object to dispatch
+    checkpoint_position = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    checkpoint_offset = models.BigIntegerField(blank=True, null=True, editable=False)
+    checkpoint_at = models.DateTimeField(blank=True, null=True, editable=False)
+    catalog_validator = models.CharField(max_length=255, blank=True, editable=False,
+                                         help_text='ETag or Last-Modified of the catalog, to resume reading it.')
+    resume_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __repr__(self):
         return u'<Audit({audit_type}): {identifier}>'.format(identifier=self.id,
@@ -235,14 +405,311 @@ class Audit(models.Model):
     # def url_inspections(self):
     #     return URLInspection.objects.filter(probe__in=self.probe_set.all())
 
+    def message_list(self):
+        """Messages generated when the audit ran, in the order they were generated"""
+        return list(self.messages or []) + list(self.message_set.values_list('message', flat=True))
+
     def error_list(self):
-        error_list = []
-        for probe in self.probe_set.filter(errors__len__gt=0).only('errors'):
-            error_list.extend(probe.errors)
-        return error_list
+        return [error.message for error in self.probeerror_set.select_related('error_type').order_by('id')]
 
     def error_count(self):
-        return len(self.error_list())
+        return self.probeerror_set.count()
+
+    def error_counts(self):
+        """(ErrorType, count) for the errors recorded in this audit, most frequent first"""
+        return ProbeError.objects.filter(audit=self).counts_by_type()
+
+    def probe_trees(self, probe_ids, root_type=None):
+        """
+        Bulk retrieval of the probe trees containing probe_ids, limited to this audit. By default a tree
+        starts at the dataset (JSON probe) a probe came from. See ProbeQuerySet.tree_map
+        """
+        probe_ids = self.probe_set.filter(id__in=probe_ids).values_list('id', flat=True)
+        return Probe.objects.filter(audit=self).tree_map(list(probe_ids), root_type or Probe.JSON_PROBE)
+
+
+# Variable parts of error messages, replaced by parameters so messages intern to a few templates
+ERROR_PARAMETER_RE = re.compile(r"""https?://[^\s'"<>)]+|host='[^']*'|0x[0-9a-fA-F]+""")
+ERROR_CLASS_RE = re.compile(r'^[A-Za-z_][\w.]*$')
+
+# (error_class, template) to ErrorType id, for every committed error type this process has seen
+_interned_error_types = {}
+# Error types seen inside atomic blocks, for each level of the blocks this thread is in. They are interned once
+# the outermost block commits, and forgotten if the block they were seen in rolls back
+_uncommitted_error_types = threading.local()
+
+
+def _uncommitted_levels(using):
+    return _uncommitted_error_types.__dict__.setdefault(using or DEFAULT_DB_ALIAS, [])
+
+
+@receiver(post_enter_atomic_block)
+def _enter_atomic_block(sender, using=None, outermost=False, savepoint=True, **kwargs):
+    if not savepoint:
+        return
+    levels = _uncommitted_levels(using)
+    if outermost:
+        levels[:] = []
+    levels.append({})
+
+
+@receiver(post_exit_atomic_block)
+def _exit_atomic_block(sender, using=None, outermost=False, savepoint=True, successful=False, **kwargs):
+    if not savepoint:
+        return
+    levels = _uncommitted_levels(using)
+    if not levels:
+        return
+    seen = levels.pop()
+    if not successful:
+        return
+    if outermost:
+        _interned_error_types.update(seen)
+    elif levels:
+        levels[-1].update(seen)
+
+
+class ErrorTypeQuerySet(models.QuerySet):
+
+    def intern(self, error_class, template):
+        """The id of the ErrorType for error_class and template, created if needed"""
+        key = (error_class, template)
+        if key in _interned_error_types:
+            return _interned_error_types[key]
+        levels = _uncommitted_levels(self.db)
+        for seen in levels:
+            if key in seen:
+                return seen[key]
+        error_type, created = self.get_or_create(digest=ErrorType.make_digest(error_class, template),
+                                                 defaults={'error_class': error_class, 'template': template})
+        # A type created in a transaction that is then rolled back doesn't exist, so the id is only kept
+        # for the rest of the process once the transaction commits
+        if not transaction.get_connection(self.db).in_atomic_block:
+            _interned_error_types[key] = error_type.id
+        elif levels:
+            levels[-1][key] = error_type.id
+        return error_type.id
+
+
+class ErrorType(models.Model):
+    """
+    A kind of error: the class of exception (or other source) and a message template.
+    The message template has %s in place of the variable parts (e.g. URLs) of a message
+    """
+
+    error_class = models.CharField(max_length=100, blank=True, db_index=True)
+    template = models.TextField()
+    digest = models.CharField(max_length=40, unique=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ErrorTypeQuerySet.as_manager()
+
+    def __repr__(self):
+        return u'<ErrorType: {0}>'.format(self.id)
+
+    def __str__(self):
+        return u'{0}: {1}'.format(self.error_class, self.template) if self.error_class else self.template
+
+    @staticmethod
+    def make_digest(error_class, template):
+        return hashlib.sha1(u'{0}\n{1}'.format(error_class, template).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def parse(error):
+        """
+        Split an error string, as made by ResultDict.add_error ("ErrorClass: message"),
+        into its class, message template and the parameters of the template
+        """
+        error_class, separator, message = error.partition(u': ')
+        if not separator or not ERROR_CLASS_RE.match(error_class):
+            error_class, message = u'', error
+        params = ERROR_PARAMETER_RE.findall(message)
+        template = ERROR_PARAMETER_RE.sub(u'%s', message.replace(u'%', u'%%'))
+        return error_class, template, params
+
+    def render(self, params=()):
+        message = self.template % tuple(params or ())
+        return u'{0}: {1}'.format(self.error_class, message) if self.error_class else message
+
+
+class ProbeErrorQuerySet(models.QuerySet):
+
+    def record(self, probe, errors):
+        """Record error strings (as made by ResultDict.add_error) for a probe in one query"""
+        records = []
+        for error in errors:
+            error_class, template, params = ErrorType.parse(error)
+            records.append(ProbeError(probe_id=probe.id, audit_id=probe.audit_id, params=params,
+                                      error_type_id=ErrorType.objects.intern(error_class, template)))
+        if records:
+            self.bulk_create(records)
+        return records
+
+    def copy_to(self, probe):
+        """Record these errors again for another probe, e.g. one that reused a recent URL inspection"""
+        records = [ProbeError(probe_id=probe.id, audit_id=probe.audit_id, error_type=error.error_type,
+                              params=error.params)
+                   for error in self.select_related('error_type').order_by('id')]
+        if records:
+            self.bulk_create(records)
+        return records
+
+    def counts_by_type(self):
+        """
+        (ErrorType, count) for these errors, most frequent first.
+        Filtered by audit, this is answered from the (audit, error_type) index
+        """
+        counts = list(self.order_by().values_list('error_type').annotate(count=Count('error_type')).order_by('-count'))
+        error_types = ErrorType.objects.in_bulk([error_type_id for error_type_id, count in counts])
+        return [(error_types[error_type_id], count) for error_type_id, count in counts]
+
+
+class ProbeError(models.Model):
+    """An error recorded by a probe, referring to its interned ErrorType"""
+
+    probe = models.ForeignKey('Probe', related_name='error_set')
+    # Copied from the probe, and indexed with error_type for per-audit counts
+    audit = models.ForeignKey('Audit', null=True, blank=True, db_index=False)
+    error_type = models.ForeignKey('ErrorType')
+    params = TextArrayField(blank=True, null=True, default=list_default)
+
+    objects = ProbeErrorQuerySet.as_manager()
+
+    class Meta:
+        index_together = (('audit', 'error_type'),)
+
+    def __repr__(self):
+        return u'<ProbeError: {0}>'.format(self.id)
+
+    def __str__(self):
+        return self.message
+
+    @property
+    def message(self):
+        return self.error_type.render(self.params)
+
+
+class AuditMessage(models.Model):
+    """
+    A message generated while an audit ran. Appended as rows (see thezombies.tasks.auditlog)
+    so that workers don't all lock and rewrite the audit to add one
+    """
+
+    audit = models.ForeignKey('Audit', related_name='message_set')
+    message = models.TextField()
+    # When the message was generated, which can be a little before it was written
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('created_at', 'id')
+        index_together = (('audit', 'created_at'),)
+
+    def __repr__(self):
+        return u'<AuditMessage: {0}>'.format(self.id)
+
+    def __str__(self):
+        return self.message
+
+
+class AuditProgressQuerySet(models.QuerySet):
+
+    def increment(self, audit_id, **counters):
+        """Atomically add to an audit's counters, e.g. increment(audit_id, urls_done=1)"""
+        values = {name: F(name) + count for name, count in counters.items() if count}
+        if not values:
+            return 0
+        return self.filter(audit_id=audit_id).update(**values)
+
+    def finished(self):
+        """Progress where dispatching is over and everything dispatched is done"""
+        return self.filter(dispatch_complete=True,
+                           datasets_done__gte=F('datasets_dispatched'),
+                           urls_done__gte=F('urls_dispatched'))
+
+    def running(self, stale_after=None):
+        """Progress of audits that haven't completed, ignoring those older than stale_after (a timedelta)"""
+        running = self.filter(completed_at__isnull=True)
+        if stale_after:
+            running = running.filter(created_at__gte=timezone.now() - stale_after)
+        return running
+
+    def mark_completed(self, audit_id):
+        """
+        Record completion of an audit if all of its work is done.
+        Returns True only for the one caller that marked the audit complete.
+        """
+        updated = self.finished().filter(audit_id=audit_id, completed_at__isnull=True).update(completed_at=timezone.now())
+        return updated == 1
+
+
+class AuditProgress(models.Model):
+    """Counters for the work dispatched and finished for an audit. Updated atomically by tasks"""
+
+    # Window (seconds) used to calculate the current rate of URL inspections
+    RATE_WINDOW = 60
+
+    audit = models.OneToOneField('Audit', related_name='progress')
+    created_at = models.DateTimeField(auto_now_add=True)
+    datasets_dispatched = models.PositiveIntegerField(default=0)
+    datasets_done = models.PositiveIntegerField(default=0)
+    urls_dispatched = models.PositiveIntegerField(default=0)
+    urls_done = models.PositiveIntegerField(default=0, help_text='URLs inspected, including failures.')
+    urls_failed = models.PositiveIntegerField(default=0)
+    dispatch_complete = models.BooleanField(default=False, help_text='Every object in the catalog has been dispatched.')
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    objects = AuditProgressQuerySet.as_manager()
+
+    class Meta:
+        verbose_name_plural = 'audit progress'
+
+    def __repr__(self):
+        return u'<AuditProgress: {0}>'.format(self.audit_id)
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def is_complete(self):
+        return self.completed_at is not None
+
+    @property
+    def urls_remaining(self):
+        return max(self.urls_dispatched - self.urls_done, 0)
+
+    @property
+    def datasets_remaining(self):
+        return max(self.datasets_dispatched - self.datasets_done, 0)
+
+    @property
+    def in_flight(self):
+        """Dispatched tasks (datasets and URLs) that haven't finished"""
+        return self.datasets_remaining + self.urls_remaining
+
+    def elapsed_seconds(self):
+        end = self.completed_at or timezone.now()
+        return (end - self.created_at).total_seconds()
+
+    def urls_per_second(self):
+        """URL inspections finished per second over the last RATE_WINDOW seconds"""
+        if self.is_complete:
+            elapsed = self.elapsed_seconds()
+            return self.urls_done / elapsed if elapsed else 0.0
+        since = timezone.now() - timedelta(seconds=self.RATE_WINDOW)
+        recent = Probe.objects.url_probes().filter(audit_id=self.audit_id, updated_at__gte=since).count()
+        return float(recent) / self.RATE_WINDOW
+
+    def eta_seconds(self):
+        """
+        Estimated seconds until URLs dispatched so far are inspected.
+        None if there is no current rate to estimate from
+        """
+        if self.is_complete:
+            return 0
+        rate = self.urls_per_second()
+        if not rate:
+            return None
+        return self.urls_remaining / rate
 
 
 class ResponseContent(models.Model):
@@ -268,6 +735,173 @@ class ResponseContent(models.Model):
         return self.__repr__()
 
 
+class CanonicalURLQuerySet(models.QuerySet):
+
+    def for_url(self, url):
+        """The CanonicalURL for url, created if needed. None if url isn't an http(s) or ftp URL"""
+        url = canonical_url(url)
+        if url is None:
+            return None
+        obj, created = self.select_related('latest_inspection__content').get_or_create(
+            url_hash=CanonicalURL.make_hash(url), defaults={'url': url, 'host': urlsplit(url).hostname})
+        return obj
+
+    def fresh(self, ttl):
+        """URLs inspected in the last ttl seconds"""
+        return self.filter(inspected_at__gte=timezone.now() - timedelta(seconds=ttl))
+
+    def for_audit(self, audit):
+        """URLs inspected by an audit"""
+        return self.filter(inspections__probe__audit=audit).distinct()
+
+    def status_histories(self):
+        """Iterate over (url, StatusHistory) without loading the URLs' other fields"""
+        for url, data in self.values_list('url', 'status_history').iterator():
+            yield url, StatusHistory(data)
+
+    def append_status(self, canonical_url_id, inspection, latency=None):
+        """
+        Make inspection the latest for a URL, and add it to the URL's status history.
+        The entry is appended in the database, so concurrent inspections don't overwrite each other
+        """
+        entry = StatusHistory.pack(inspection.created_at, inspection.status_code, latency, inspection.timeout)
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {0} SET latest_inspection_id = %s, inspected_at = %s, '
+                           'status_history = COALESCE(status_history, %s) || %s WHERE id = %s'.format(
+                               connection.ops.quote_name(self.model._meta.db_table)),
+                           [inspection.id, inspection.created_at, Binary(b''), Binary(entry), canonical_url_id])
+
+
+StatusEntry = namedtuple('StatusEntry', ('inspected_at', 'status_code', 'latency', 'timeout'))
+StatusRun = namedtuple('StatusRun', ('ok', 'start', 'end', 'count'))
+
+
+class StatusHistory(object):
+    """
+    A URL's inspections as packed fixed-size entries: time (epoch seconds), status code, latency (milliseconds)
+    and flags. Entries are in the order they were recorded
+    """
+
+    ENTRY = struct.Struct('<IhIB')
+    NO_STATUS = -1
+    NO_LATENCY = 0xFFFFFFFF
+    TIMEOUT = 1
+
+    def __init__(self, data=None):
+        self.data = bytes(data or b'')
+
+    def __len__(self):
+        return len(self.data) // self.ENTRY.size
+
+    def __iter__(self):
+        size = self.ENTRY.size
+        for offset in range(0, len(self) * size, size):
+            seconds, status, latency, flags = self.ENTRY.unpack_from(self.data, offset)
+            yield StatusEntry(datetime.fromtimestamp(seconds, timezone.utc),
+                              None if status == self.NO_STATUS else status,
+                              None if latency == self.NO_LATENCY else latency / 1000.0,
+                              bool(flags & self.TIMEOUT))
+
+    @classmethod
+    def pack(cls, inspected_at, status_code, latency=None, timeout=False):
+        seconds = calendar.timegm(inspected_at.utctimetuple())
+        status = cls.NO_STATUS if status_code is None else status_code
+        latency = cls.NO_LATENCY if latency is None else min(int(latency * 1000), cls.NO_LATENCY - 1)
+        return cls.ENTRY.pack(seconds, status, latency, cls.TIMEOUT if timeout else 0)
+
+    @staticmethod
+    def is_ok(entry):
+        return entry.status_code is not None and entry.status_code < 400
+
+    def entries(self, since=None):
+        return [entry for entry in self if since is None or entry.inspected_at >= since]
+
+    def runs(self, since=None):
+        """StatusRuns: consecutive entries that were all working or all failing"""
+        runs = []
+        for entry in self.entries(since):
+            ok = self.is_ok(entry)
+            if runs and runs[-1].ok == ok:
+                runs[-1] = runs[-1]._replace(end=entry.inspected_at, count=runs[-1].count + 1)
+            else:
+                runs.append(StatusRun(ok, entry.inspected_at, entry.inspected_at, 1))
+        return runs
+
+    def uptime(self, since=None):
+        """Fraction of inspections that got a working response, or None if there are none"""
+        entries = self.entries(since)
+        if not entries:
+            return None
+        return sum(1 for entry in entries if self.is_ok(entry)) / float(len(entries))
+
+    def broken_since(self):
+        """When the URL started failing, if its latest inspection failed. Otherwise None"""
+        runs = self.runs()
+        return runs[-1].start if runs and not runs[-1].ok else None
+
+    def first_broken(self, since=None):
+        """When the URL first failed, or None if it never has"""
+        for entry in self.entries(since):
+            if not self.is_ok(entry):
+                return entry.inspected_at
+        return None
+
+    def flaps(self, since=None):
+        """Number of times the URL changed between working and failing"""
+        return max(len(self.runs(since)) - 1, 0)
+
+    def is_flapping(self, since=None, threshold=None):
+        return self.flaps(since) >= (threshold or URL_FLAPPING_THRESHOLD)
+
+
+class CanonicalURL(models.Model):
+    """
+    A URL in canonical form (see thezombies.utils.canonical_url), shared by every audit and agency
+    that links to it. Refers to its latest inspection, so a recent result can be reused instead of
+    requesting the URL again
+    """
+
+    url = models.TextField()
+    url_hash = models.CharField(max_length=40, unique=True, editable=False)
+    host = models.CharField(max_length=255, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    latest_inspection = models.ForeignKey('URLInspection', null=True, blank=True, related_name='+',
+                                          on_delete=models.SET_NULL)
+    inspected_at = models.DateTimeField(blank=True, null=True)
+    # Packed entries for every inspection of this URL, see StatusHistory
+    status_history = models.BinaryField(blank=True, null=True, editable=False)
+
+    objects = CanonicalURLQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Canonical URL'
+        verbose_name_plural = 'Canonical URLs'
+
+    def __repr__(self):
+        return u'<CanonicalURL: {0}>'.format(self.url)
+
+    def __str__(self):
+        return self.url
+
+    @staticmethod
+    def make_hash(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def fresh_inspection(self, ttl):
+        """The latest inspection if it is less than ttl seconds old, otherwise None"""
+        if self.latest_inspection_id and self.inspected_at and ttl and \
+                self.inspected_at >= timezone.now() - timedelta(seconds=ttl):
+            return self.latest_inspection
+        return None
+
+    def inspected(self, inspection, latency=None):
+        """Make inspection the latest one for this URL, and add it to the status history"""
+        CanonicalURL.objects.append_status(self.id, inspection, latency)
+
+    def get_status_history(self):
+        return StatusHistory(self.status_history)
+
+
 class URLInspection(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     url = models.TextField(blank=True, null=True)  # We may get (and want to store) really long or invalid urls, so...
@@ -282,6 +916,9 @@ class URLInspection(models.Model):
     headers = hstore.DictionaryField(default=dictionary_default)
     timeout = models.BooleanField(default=False)
     probe = models.ForeignKey('Probe', null=True, blank=True, related_name='url_inspections')
+    canonical_url = models.ForeignKey('CanonicalURL', null=True, blank=True, related_name='inspections')
+    # Set when this inspection copies a recent inspection of the same URL instead of requesting it
+    reused_from = models.ForeignKey('self', null=True, blank=True, related_name='reuses', on_delete=models.SET_NULL)
 
     objects = URLInspectionManager.from_queryset(URLInspectionQuerySet)()
 
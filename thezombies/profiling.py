@@ -0,0 +1,66 @@
+"""
+Opt-in sampled profiling of Celery tasks.
+
+Set TASK_PROFILE_RATE (setting or environment variable) to the fraction of task executions to profile.
+Profiles of tasks in PROFILED_TASK_MODULES are written with cProfile to TASK_PROFILE_DIR/<task name>/
+and can be merged with the profile_summary management command.
+
+cProfile follows a thread, not a greenlet, so with the eventlet pool a profile also includes
+whatever other greenlets ran while the task waited on I/O. Only one task is profiled at a time per process.
+"""
+from __future__ import absolute_import
+import cProfile
+import os
+import random
+import time
+
+from celery.signals import task_prerun, task_postrun
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+TASK_PROFILE_RATE = float(getattr(settings, 'TASK_PROFILE_RATE', 0) or 0)
+TASK_PROFILE_DIR = getattr(settings, 'TASK_PROFILE_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+PROFILED_TASK_MODULES = ('thezombies.tasks.crawl', 'thezombies.tasks.urls', 'thezombies.tasks.validation')
+PROFILE_EXTENSION = '.prof'
+
+_active = {}
+
+
+def should_profile(task):
+    if not TASK_PROFILE_RATE or _active:
+        return False
+    if not task.name.startswith(PROFILED_TASK_MODULES):
+        return False
+    return random.random() < TASK_PROFILE_RATE
+
+
+def start_profile(sender=None, task_id=None, task=None, **kwargs):
+    if task is not None and should_profile(task):
+        profile = cProfile.Profile()
+        _active[task_id] = profile
+        profile.enable()
+
+
+def stop_profile(sender=None, task_id=None, task=None, **kwargs):
+    profile = _active.pop(task_id, None)
+    if profile is None:
+        return
+    profile.disable()
+    task_dir = os.path.join(TASK_PROFILE_DIR, task.name)
+    try:
+        if not os.path.isdir(task_dir):
+            os.makedirs(task_dir)
+        filename = '{0:.0f}-{1}{2}'.format(time.time() * 1000, task_id, PROFILE_EXTENSION)
+        profile.dump_stats(os.path.join(task_dir, filename))
+    except (IOError, OSError) as e:
+        logger.warn(u'Unable to write profile for task {0}: {1!r}'.format(task_id, e))
+
+
+def connect():
+    """Connect profiling to the task signals, if TASK_PROFILE_RATE is set"""
+    if TASK_PROFILE_RATE:
+        task_prerun.connect(start_profile, weak=False)
+        task_postrun.connect(stop_profile, weak=False)
+        logger.info(u'Profiling {0:.1%} of tasks into {1}'.format(TASK_PROFILE_RATE, TASK_PROFILE_DIR))
@@ -114,6 +114,8 @@ MEDIA_URL = os.getenv('MEDIA_URL', '/media/')
 # JSON Schema
 
 SCHEMA_DIR = os.path.join(BASE_DIR, 'schema/')
+# Where validators compiled from JSON_SCHEMAS are cached, see thezombies.tasks.schemas
+COMPILED_SCHEMA_DIR = os.path.join(BASE_DIR, 'schema/compiled/')
 
 JSON_SCHEMAS = {
     'CATALOG_1.0': {
@@ -138,6 +140,108 @@ JSON_SCHEMAS = {
 
 REQUEST_TIMEOUT = 60 * 3
 
+# How long (seconds) redirects are remembered and followed without requesting them again
+
+REDIRECT_CACHE_TTL = 15 * 60
+
+# How long (seconds) an inspection of a URL is reused, by any audit, instead of requesting the URL again
+
+URL_REUSE_TTL = 6 * 60 * 60
+
+# Audit messages are buffered in each worker process and inserted together, at the end of every task or once
+# AUDIT_MESSAGE_BUFFER_SIZE are waiting (see thezombies.tasks.auditlog)
+
+AUDIT_MESSAGE_BUFFER_SIZE = 500
+
+# URL inspections add to their audit's progress counters in each worker process, written together at the end of
+# every task (a chunk of inspections) or once PROGRESS_BUFFER_SIZE are waiting (see thezombies.tasks.progress)
+
+PROGRESS_BUFFER_SIZE = 50
+
+# Fallback to older TLS for hosts that fail the handshake (see thezombies.tasks.tls). The profile that worked for a
+# host is remembered for TLS_PROFILE_TTL seconds, a host where none did for TLS_FAILURE_TTL. TLS_LEGACY_HOSTS start
+# with the legacy profile
+
+TLS_PROFILE_TTL = 24 * 60 * 60
+TLS_FAILURE_TTL = 10 * 60
+TLS_LEGACY_HOSTS = ('www.sba.gov',)
+
+# Changes between working and failing after which a URL's status history counts as flapping
+
+URL_FLAPPING_THRESHOLD = 3
+
+# Recording of HTTP requests and responses to WARC archives, and replay from them (see thezombies.tasks.archive).
+# HTTP_ARCHIVE_MODE is 'record', 'replay' or empty. Replay reads HTTP_ARCHIVE_REPLAY, a list of archive files or
+# directories separated by os.pathsep (all of HTTP_ARCHIVE_DIR by default). Bodies are cut off at HTTP_ARCHIVE_MAX_BODY
+# bytes, or HTTP_ARCHIVE_MAX_STREAM_BODY for streamed responses such as catalogs
+
+HTTP_ARCHIVE_MODE = os.getenv('HTTP_ARCHIVE_MODE', '')
+HTTP_ARCHIVE_DIR = os.getenv('HTTP_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archives'))
+HTTP_ARCHIVE_REPLAY = [path for path in os.getenv('HTTP_ARCHIVE_REPLAY', '').split(os.pathsep) if path]
+HTTP_ARCHIVE_MAX_BODY = 64 * 1024
+HTTP_ARCHIVE_MAX_STREAM_BODY = 512 * 1024 * 1024
+
+# FTP connections kept open per server (servers often limit connections per client),
+# and how long (seconds) an idle connection is reused. Keep FTP_IDLE_TIMEOUT below the servers' own idle
+# timeouts. Reused connections are checked with NOOP, but each one closed by a server costs a round trip
+
+FTP_MAX_CONNECTIONS_PER_HOST = 2
+FTP_IDLE_TIMEOUT = 60
+
+# Crawl scheduling. Dataset and URL tasks in flight across all crawls, crawls a sweep runs at once,
+# and seconds before an incomplete crawl is no longer counted as running. See thezombies.tasks.scheduler
+
+CRAWL_TASK_BUDGET = 2000
+SWEEP_MAX_CRAWLS = 8
+CRAWL_STALE_AFTER = 6 * 60 * 60
+
+# Backpressure. A producer that has its share of tasks in flight (or finds BROKER_QUEUE_HIGH_WATER messages
+# waiting in one of the queues it fills) stops reading its catalog until in-flight tasks are down to
+# DISPATCH_LOW_WATER_RATIO of its share and the queues to BROKER_QUEUE_LOW_WATER. Set BROKER_QUEUE_HIGH_WATER
+# to 0 to ignore the queues
+
+DISPATCH_LOW_WATER_RATIO = 0.5
+BROKER_QUEUE_HIGH_WATER = 10000
+BROKER_QUEUE_LOW_WATER = 5000
+
+# Resumable crawls. Seconds a crawl task dispatches before it checkpoints and continues in a new task (under
+# CELERYD_TASK_TIME_LIMIT), and seconds without word from a crawl before resume_crawls treats it as stopped
+
+CRAWL_SOFT_TIME_LIMIT = 9 * 60
+CRAWL_LEASE_TTL = 5 * 60
+
+# Catalog snapshots. If set, crawls and validations save the catalog here (storage every worker can read),
+# index where its items are, and parse it in ranges of CATALOG_SNAPSHOT_RANGE_SIZE items on many workers.
+# Snapshots are deleted CATALOG_SNAPSHOT_MAX_AGE days after their audits complete. See thezombies.tasks.snapshots
+
+CATALOG_SNAPSHOT_DIR = os.getenv('CATALOG_SNAPSHOT_DIR', '')
+CATALOG_SNAPSHOT_RANGE_SIZE = 1000
+CATALOG_SNAPSHOT_MAX_AGE = 7
+
 # Redis (caching backend)
 
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+
+# Task timing metrics (served at /metrics/ in the Prometheus text format)
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_FLUSH_INTERVAL = 10  # seconds
+
+# Task profiling. Fraction of task executions to profile (0 disables it). See thezombies.profiling
+
+TASK_PROFILE_RATE = float(os.getenv('TASK_PROFILE_RATE', 0))
+TASK_PROFILE_DIR = os.getenv('TASK_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# Startup-optimized workers: import task modules and compile JSON_SCHEMAS validators before the pool forks.
+# See thezombies.startup
+
+WORKER_PRELOAD = os.getenv('WORKER_PRELOAD', 'False') == 'True'
+
+# Audit exports (/audits/<id>/export/<inspections|probes|errors>.<csv|ndjson>). Rows fetched per round trip
+
+EXPORT_BATCH_SIZE = 2000
+
+# Columnar exports of completed crawls, as NumPy .npz files (see thezombies.columnar and thezombies.analytics).
+# Written automatically when a crawl completes if COLUMNAR_EXPORT_DIR is set
+
+COLUMNAR_EXPORT_DIR = os.getenv('COLUMNAR_EXPORT_DIR', '')
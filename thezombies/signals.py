@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent once all work dispatched for an audit has finished. See AuditProgressQuerySet.mark_completed
+audit_completed = Signal(providing_args=['audit'])
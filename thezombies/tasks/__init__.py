@@ -2,3 +2,5 @@ from __future__ import absolute_import
 
 from .crawl import crawl_agency_catalog
 from .validation import validate_catalog_datasets
+from .scheduler import schedule_sweep
+from .columns import export_audit_columns
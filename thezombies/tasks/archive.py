@@ -0,0 +1,394 @@
+"""
+Recording and replay of HTTP traffic.
+
+With HTTP_ARCHIVE_MODE = 'record', each request made through thezombies.tasks.urls.session is written,
+with its response (status, headers and up to HTTP_ARCHIVE_MAX_BODY bytes of body) or the exception it
+raised, to WARC files under HTTP_ARCHIVE_DIR: a directory per audit, and a file per worker process so
+writers never share a file. Every record is a separate gzip member appended to the file, and an index
+line (method, URL, record type, offset and length) is appended to <file>.idx once it is written.
+Streamed responses (catalogs) are recorded as they are read, up to HTTP_ARCHIVE_MAX_STREAM_BODY bytes.
+
+With HTTP_ARCHIVE_MODE = 'replay', requests are answered from the archives in HTTP_ARCHIVE_REPLAY
+(directories or files, HTTP_ARCHIVE_DIR by default) without using the network. Recorded exceptions
+are raised again, and requests that weren't recorded raise ConnectionError.
+
+FTP URLs don't go through the session, so they are neither recorded nor replayed.
+"""
+from __future__ import absolute_import
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from django.conf import settings
+import io
+import os
+import socket
+import tempfile
+import threading
+import uuid
+import zlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.packages.urllib3.response import HTTPResponse
+from requests.structures import CaseInsensitiveDict
+
+from .utils import logger
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+HTTP_ARCHIVE_MODE = getattr(settings, 'HTTP_ARCHIVE_MODE', None) or None
+HTTP_ARCHIVE_DIR = getattr(settings, 'HTTP_ARCHIVE_DIR', None)
+HTTP_ARCHIVE_REPLAY = getattr(settings, 'HTTP_ARCHIVE_REPLAY', None) or ([HTTP_ARCHIVE_DIR] if HTTP_ARCHIVE_DIR else [])
+HTTP_ARCHIVE_MAX_BODY = getattr(settings, 'HTTP_ARCHIVE_MAX_BODY', 64 * 1024)
+HTTP_ARCHIVE_MAX_STREAM_BODY = getattr(settings, 'HTTP_ARCHIVE_MAX_STREAM_BODY', 512 * 1024 * 1024)
+
+ARCHIVE_SUFFIX = '.warc.gz'
+INDEX_SUFFIX = '.idx'
+# Modules whose exceptions are raised again when replaying. Others are replayed as ConnectionError
+REPLAYED_EXCEPTION_MODULES = ('requests.exceptions', 'socket', 'ssl')
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return u'{0}'.format(value).encode('utf-8')
+
+
+def warc_record(record_type, url, block, content_type, record_id=None, **fields):
+    """A WARC/1.0 record. Extra header fields are given as keyword arguments, e.g. WARC_Truncated='length'"""
+    headers = [
+        ('WARC-Type', record_type),
+        ('WARC-Record-ID', record_id or new_record_id()),
+        ('WARC-Date', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('WARC-Target-URI', url),
+    ]
+    headers.extend((name.replace('_', '-'), value) for name, value in sorted(fields.items()) if value)
+    headers.extend([('Content-Type', content_type), ('Content-Length', len(block))])
+    head = b''.join(to_bytes(name) + b': ' + to_bytes(value) + b'\r\n' for name, value in headers)
+    return b'WARC/1.0\r\n' + head + b'\r\n' + block + b'\r\n\r\n'
+
+
+def new_record_id():
+    return '<urn:uuid:{0}>'.format(uuid.uuid4())
+
+
+def header_block(first_line, headers):
+    lines = [to_bytes(first_line)] + [to_bytes(name) + b': ' + to_bytes(value) for name, value in headers.items()]
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+def request_block(request, limit):
+    parts = urlsplit(request.url)
+    target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    body = request.body if isinstance(request.body, (bytes, type(u''))) else b''
+    body = to_bytes(body)
+    return header_block(u'{0} {1} HTTP/1.1'.format(request.method, target), request.headers) + body[:limit]
+
+
+def response_block(response, body):
+    version = '1.0' if getattr(response.raw, 'version', 11) == 10 else '1.1'
+    status_line = u'HTTP/{0} {1} {2}'.format(version, response.status_code, response.reason or '')
+    return header_block(status_line, response.headers) + body
+
+
+def gzip_member(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ArchiveWriter(object):
+    """Appends records to an archive file and its index. One per file per process"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self.path = path
+        self.archive = open(path, 'ab')
+        self.index = open(path + INDEX_SUFFIX, 'ab')
+        self.lock = threading.Lock()
+
+    def write(self, method, url, request, record_type, record):
+        """Write a request record and the record answering it, then index the answer"""
+        with self.lock:
+            self.archive.seek(0, os.SEEK_END)
+            self.archive.write(gzip_member(request))
+            offset = self.archive.tell()
+            member = gzip_member(record)
+            self.archive.write(member)
+            self.archive.flush()
+            self.index.write(to_bytes(u'{0}\t{1}\t{2}\t{3}\t{4}\n'.format(method, url, record_type, offset,
+                                                                           len(member))))
+            self.index.flush()
+
+    def record_response(self, request, response, body, truncated=None):
+        request_id = new_record_id()
+        request_record = warc_record('request', request.url, request_block(request, HTTP_ARCHIVE_MAX_BODY),
+                                     'application/http;msgtype=request', record_id=request_id)
+        if truncated is None and len(body) > HTTP_ARCHIVE_MAX_BODY:
+            body, truncated = body[:HTTP_ARCHIVE_MAX_BODY], 'length'
+        record = warc_record('response', request.url, response_block(response, body),
+                             'application/http;msgtype=response', WARC_Concurrent_To=request_id,
+                             WARC_Truncated=truncated)
+        self.write(request.method, request.url, request_record, 'response', record)
+
+    def record_exception(self, request, error):
+        request_id = new_record_id()
+        request_record = warc_record('request', request.url, request_block(request, HTTP_ARCHIVE_MAX_BODY),
+                                     'application/http;msgtype=request', record_id=request_id)
+        error_class = type(error)
+        payload = json.dumps({'exception': '{0}.{1}'.format(error_class.__module__, error_class.__name__),
+                              'message': u'{0}'.format(error)})
+        record = warc_record('metadata', request.url, to_bytes(payload), 'application/json',
+                             WARC_Concurrent_To=request_id)
+        self.write(request.method, request.url, request_record, 'metadata', record)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+_state = threading.local()
+
+
+def archive_path(audit_id):
+    directory = 'audit-{0}'.format(audit_id) if audit_id else 'unassigned'
+    filename = '{0}-{1}{2}'.format(socket.gethostname(), os.getpid(), ARCHIVE_SUFFIX)
+    return os.path.join(HTTP_ARCHIVE_DIR, directory, filename)
+
+
+def current_writer():
+    """The writer for the audit set by recording_audit, in this process"""
+    path = archive_path(getattr(_state, 'audit_id', None))
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = ArchiveWriter(path)
+        return _writers[path]
+
+
+@contextmanager
+def recording_audit(audit_id):
+    """Requests made in this block (on this thread) are recorded in the archive of audit_id"""
+    previous = getattr(_state, 'audit_id', None)
+    _state.audit_id = audit_id
+    try:
+        yield
+    finally:
+        _state.audit_id = previous
+
+
+class RecordingRaw(object):
+    """Wraps a streamed response's raw (urllib3) response, keeping what is read until the response is done"""
+
+    def __init__(self, raw, on_done, limit=HTTP_ARCHIVE_MAX_STREAM_BODY):
+        self._raw = raw
+        self._on_done = on_done
+        self._limit = limit
+        self._spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self._size = 0
+        self._truncated = None
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def read(self, amt=None, *args, **kwargs):
+        data = self._raw.read(amt, *args, **kwargs)
+        if data and not self._done:
+            room = self._limit - self._size
+            if len(data) > room:
+                self._truncated = 'length'
+            self._spool.write(data[:max(room, 0)])
+            self._size += min(len(data), max(room, 0))
+        if not data or amt is None:
+            self._finish()
+        return data
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        while True:
+            data = self.read(amt, decode_content=decode_content)
+            if not data:
+                break
+            yield data
+
+    def _finish(self, truncated=None):
+        if self._done:
+            return
+        self._done = True
+        self._spool.seek(0)
+        try:
+            self._on_done(self._spool.read(), truncated or self._truncated)
+        except Exception as e:
+            logger.warn(u'Unable to record streamed response: {0!r}'.format(e))
+        finally:
+            self._spool.close()
+
+    def release_conn(self):
+        # Closed before the end of the body, record what was read
+        self._finish('disconnect')
+        return self._raw.release_conn()
+
+    def close(self):
+        self._finish('disconnect')
+        return self._raw.close()
+
+
+class RecordingAdapter(BaseAdapter):
+    """Transport adapter that records what another adapter sends and receives"""
+
+    def __init__(self, adapter):
+        super(RecordingAdapter, self).__init__()
+        self.adapter = adapter
+
+    def send(self, request, stream=False, **kwargs):
+        writer = current_writer()
+        try:
+            response = self.adapter.send(request, stream=stream, **kwargs)
+        except Exception as e:
+            writer.record_exception(request, e)
+            raise
+        if stream:
+            record = partial(writer.record_response, request, response)
+            response.raw = RecordingRaw(response.raw, record)
+        else:
+            writer.record_response(request, response, response.content or b'')
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ArchiveIndex(object):
+    """The records in a set of archives, found through their index files"""
+
+    def __init__(self, paths):
+        self.entries = {}
+        for path in paths:
+            for archive in self.archive_files(path):
+                self.load(archive)
+        logger.info(u'Loaded {0} archived requests from {1}'.format(len(self.entries), ', '.join(paths)))
+
+    def archive_files(self, path):
+        if os.path.isfile(path):
+            return [path]
+        archives = []
+        for directory, dirnames, filenames in os.walk(path):
+            archives.extend(os.path.join(directory, f) for f in sorted(filenames) if f.endswith(ARCHIVE_SUFFIX))
+        return archives
+
+    def load(self, archive):
+        index_path = archive + INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            logger.warn(u'No index for {0}, skipping it'.format(archive))
+            return
+        with io.open(index_path, 'r', encoding='utf-8') as index:
+            for line in index:
+                fields = line.rstrip(u'\n').split(u'\t')
+                if len(fields) != 5:
+                    continue  # A line cut short by a crash
+                method, url, record_type, offset, length = fields
+                # The first recording of a request wins
+                self.entries.setdefault((method, url), (archive, record_type, int(offset), int(length)))
+
+    def find(self, method, url):
+        """(record type, WARC header fields, block) for the recorded answer to a request, or None"""
+        entry = self.entries.get((method, url))
+        if entry is None:
+            return None
+        archive, record_type, offset, length = entry
+        with open(archive, 'rb') as f:
+            f.seek(offset)
+            record = zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+        head, _, rest = record.partition(b'\r\n\r\n')
+        fields = parse_fields(head.split(b'\r\n')[1:])
+        block = rest[:int(fields.get('content-length', len(rest)))]
+        return record_type, fields, block
+
+
+def parse_fields(lines):
+    fields = CaseInsensitiveDict()
+    for line in lines:
+        name, _, value = line.decode('utf-8').partition(u':')
+        fields[name.strip()] = value.strip()
+    return fields
+
+
+def archived_exception(payload, request):
+    """The exception recorded in a metadata record"""
+    info = json.loads(payload.decode('utf-8'))
+    module_name, _, class_name = info.get('exception', '').rpartition('.')
+    message = info.get('message', '')
+    if module_name in REPLAYED_EXCEPTION_MODULES:
+        module = __import__(module_name, fromlist=[class_name])
+        error_class = getattr(module, class_name, None)
+        if isinstance(error_class, type) and issubclass(error_class, requests.exceptions.RequestException):
+            return error_class(message, request=request)
+        if isinstance(error_class, type) and issubclass(error_class, Exception):
+            return error_class(message)
+    return ConnectionError(message, request=request)
+
+
+class ReplayAdapter(HTTPAdapter):
+    """Transport adapter that answers requests from archives instead of the network"""
+
+    def __init__(self, paths):
+        super(ReplayAdapter, self).__init__()
+        self.paths = paths
+        self._index = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def index(self):
+        with self._index_lock:
+            if self._index is None:
+                self._index = ArchiveIndex(self.paths)
+            return self._index
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        found = self.index.find(request.method, request.url)
+        if found is None:
+            raise ConnectionError(u'No archived response for {0} {1}'.format(request.method, request.url),
+                                  request=request)
+        record_type, fields, block = found
+        if record_type != 'response':
+            raise archived_exception(block, request)
+        head, _, body = block.partition(b'\r\n\r\n')
+        lines = head.split(b'\r\n')
+        version, status, reason = (lines[0].decode('latin-1').split(u' ', 2) + [u''])[:3]
+        headers = parse_fields(lines[1:])
+        # The body was recorded decoded, so don't let urllib3 decode it again
+        raw_headers = dict((k, v) for k, v in headers.items() if k.lower() not in ('content-encoding',
+                                                                                  'transfer-encoding'))
+        raw = HTTPResponse(body=io.BytesIO(body), headers=raw_headers, status=int(status), reason=reason,
+                           version=10 if version.endswith('1.0') else 11, preload_content=False)
+        response = self.build_response(request, raw)
+        response.headers = headers
+        return response
+
+
+def install(session):
+    """Set up a session for HTTP_ARCHIVE_MODE: wrap its adapters to record, or replace them to replay"""
+    if HTTP_ARCHIVE_MODE == RECORD:
+        for prefix, adapter in list(session.adapters.items()):
+            session.mount(prefix, RecordingAdapter(adapter))
+        logger.info(u'Recording HTTP requests in {0}'.format(HTTP_ARCHIVE_DIR))
+    elif HTTP_ARCHIVE_MODE == REPLAY:
+        replay = ReplayAdapter(HTTP_ARCHIVE_REPLAY)
+        for prefix in list(session.adapters.keys()):
+            session.mount(prefix, replay)
+    elif HTTP_ARCHIVE_MODE:
+        logger.error(u'Unknown HTTP_ARCHIVE_MODE {0!r}'.format(HTTP_ARCHIVE_MODE))
+    return session
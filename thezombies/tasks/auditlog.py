@@ -0,0 +1,51 @@
+"""
+Append-only audit messages, buffered in each worker process.
+
+log_message adds an AuditMessage to a buffer rather than rewriting the audit's row, so concurrent tasks
+never wait on each other to record a message. The buffer is bulk-inserted when it holds
+AUDIT_MESSAGE_BUFFER_SIZE messages, at the end of every task, and when the worker process shuts down.
+"""
+from __future__ import absolute_import
+from celery.signals import task_postrun, worker_process_shutdown
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .utils import logger
+from thezombies.models import AuditMessage
+
+AUDIT_MESSAGE_BUFFER_SIZE = getattr(settings, 'AUDIT_MESSAGE_BUFFER_SIZE', 500)
+
+_pending = []
+
+
+def log_message(audit_id, message):
+    """Record a message for an audit"""
+    if not audit_id:
+        return
+    _pending.append(AuditMessage(audit_id=audit_id, message=message, created_at=timezone.now()))
+    if len(_pending) >= AUDIT_MESSAGE_BUFFER_SIZE:
+        flush()
+
+
+def flush():
+    """Write the messages buffered in this process. Returns how many were written"""
+    global _pending
+    pending, _pending = _pending, []
+    if not pending:
+        return 0
+    try:
+        AuditMessage.objects.bulk_create(pending)
+    except DatabaseError as e:
+        logger.warn(u'Unable to write {0} audit messages: {1!r}'.format(len(pending), e))
+        return 0
+    return len(pending)
+
+
+def flush_after(sender=None, **kwargs):
+    flush()
+
+
+# Write buffered messages when each task ends and when a worker process shuts down
+task_postrun.connect(flush_after, weak=False)
+worker_process_shutdown.connect(flush_after, weak=False)
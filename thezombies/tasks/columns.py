@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+from django_atomic_celery import task
+
+from .utils import logger, ResultDict
+from thezombies.columnar import export_columns, COLUMNAR_EXPORT_DIR
+from thezombies.models import Audit
+from thezombies.signals import audit_completed
+
+
+@task
+def export_audit_columns(audit_id):
+    """Write the columnar export of a completed audit to COLUMNAR_EXPORT_DIR"""
+    path = export_columns(audit_id)
+    logger.info(u'Exported columns of audit {0} to {1}'.format(audit_id, path))
+    return ResultDict({'audit_id': audit_id, 'path': path})
+
+
+def on_audit_completed(sender, audit=None, **kwargs):
+    if COLUMNAR_EXPORT_DIR and audit is not None and audit.audit_type == Audit.DATA_CATALOG_CRAWL:
+        export_audit_columns.delay(audit.id)
+
+audit_completed.connect(on_audit_completed)
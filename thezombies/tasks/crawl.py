@@ -1,18 +1,36 @@
 from __future__ import absolute_import
+from django.conf import settings
 from django.db import transaction, DatabaseError
+from django.db.models import F
 from django_atomic_celery import task
+from celery.exceptions import SoftTimeLimitExceeded
 
 from contextlib import closing
+import os
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from .validation import get_schema_prefix, ijson
+from .validation import get_schema_prefix
+from .jsonstream import CatalogItemStream, audit_skip_recorder, is_item_prefix
 from .urls import inspect_url, remove_url_fragments, open_streaming_response
-from .utils import logger, ResultDict, COUNTDOWN_MODULO
-from thezombies.models import (Probe, Audit)
+from .utils import logger, ResultDict
+from .auditlog import log_message
+from . import archive
+from .payloads import store_payload, fetch_payload, discard_payload, MissingPayload
+from .snapshots import (CatalogSnapshot, snapshots_enabled, snapshot_path, prepare_snapshot, unfinished_snapshot,
+                        dispatch_ranges)
+from .progress import (start_progress, record_progress, finish_dispatch, wait_for_capacity, PROGRESS_BATCH_SIZE,
+                       mark_dispatched, dispatch_state, save_checkpoint, new_lease_token, claim_lease,
+                       hand_over_lease, lease_renewer, release_lease)
+from thezombies.models import (Probe, ProbeError, Audit)
+from thezombies.metrics import timed_iter
+
+# Seconds a crawl dispatches for before it checkpoints and continues in a new task. Under CELERYD_TASK_TIME_LIMIT.
+# Time limits are only enforced by the prefork pool, which the catalogs queue runs on (see celeryconfig)
+CRAWL_SOFT_TIME_LIMIT = getattr(settings, 'CRAWL_SOFT_TIME_LIMIT', 9 * 60)
 
 
 @task
@@ -20,16 +38,18 @@ def inspect_catalog_dataset(taskarg):
     """Inspect a dataset (json object) from a data catalog (json array) and
     check any included accessURLs, distributions or webServices
 
-    :param taskarg: Dictionary containing the json object to inspect,
-                    an audit id, agency_id and catalog_url
+    :param taskarg: Dictionary containing an audit id and the object_position of a json object
+                    stored with thezombies.tasks.payloads.store_payload, and optionally a prev_probe_id
     """
 
     def make_task(field, dataset, orig_task):
         url = dataset.get(field, None)
         if url:
-            task_dict = ResultDict(orig_task)
-            task_dict['url'] = remove_url_fragments(url)
-            task_dict['url_type'] = field
+            # Only pass along what inspect_url needs, messages are kept small
+            task_dict = {'audit_id': orig_task.get('audit_id', None),
+                         'prev_probe_id': orig_task.get('prev_probe_id', None),
+                         'url': remove_url_fragments(url),
+                         'url_type': field}
             return task_dict
         return None
 
@@ -65,120 +85,316 @@ def inspect_catalog_dataset(taskarg):
 
     dataset = taskarg.pop('dataset', None)  # Pop dataset since we store it in JSON Probe
     audit_id = taskarg.get('audit_id', None)
-    # Create JSON probe and store dataset in probe.initial
-    probe = None
+    object_position = taskarg.get('object_position', None)
+    missing = False
+    if dataset is None and audit_id and object_position is not None:
+        dataset = fetch_payload(audit_id, object_position)
+        # Expired, or discarded by an earlier run of this task
+        missing = dataset is None
+    url_task_count = 0
     try:
-        with transaction.atomic():
-            probe = Probe.objects.create(probe_type=Probe.JSON_PROBE, initial=dataset,
-                                         previous_id=taskarg.get('prev_probe_id', None), audit_id=audit_id)
-            taskarg['prev_probe_id'] = probe.id
-    except DatabaseError as e:
-        logger.exception(e)
+        # Create JSON probe and store dataset in probe.initial
+        probe = None
+        try:
+            with transaction.atomic():
+                probe = Probe.objects.create(probe_type=Probe.JSON_PROBE, initial=dataset,
+                                             previous_id=taskarg.get('prev_probe_id', None), audit_id=audit_id)
+                taskarg['prev_probe_id'] = probe.id
+        except DatabaseError as e:
+            logger.exception(e)
 
-    dataset_title = dataset.get('title', 'No title provided.')
-    all_task_args = []
-    if dataset and isinstance(dataset, dict):
-        # Look for relevant URLs on top-level of object
-        url_fields = ('accessURL', 'webService', 'accessUrl')
-        all_task_args.extend(taskargs_from_dataset(dataset, url_fields, taskarg))
-        # Look for relevant URLs in optional 'distribution' subobject
-        if 'distribution' in dataset:
-            distribution = dataset.get('distribution', None)
-            if distribution:
-                # Sometimes the distribution value is a JSON string (hasn't been reconstituted)
-                if not isinstance(distribution, list):
-                    logger.warn('distribution value not a list, attempting to reconstitute')
-                    distribution = json.loads(distribution)
-                for d in distribution:
-                    logger.info('Checking distribution list')
-                    if isinstance(d, dict):
-                        all_task_args.extend(taskargs_from_dataset(d, url_fields, taskarg, 'd'))
-                    else:
-                        logger.warn('distribution item in dataset appears to be a "{0}", not a dictionary'.format(type(d)))
+        dataset_title = dataset.get('title', 'No title provided.') if isinstance(dataset, dict) else None
+        all_task_args = []
+        probe_errors = []
+        if dataset and isinstance(dataset, dict):
+            # Look for relevant URLs on top-level of object
+            url_fields = ('accessURL', 'webService', 'accessUrl')
+            all_task_args.extend(taskargs_from_dataset(dataset, url_fields, taskarg))
+            # Look for relevant URLs in optional 'distribution' subobject
+            if 'distribution' in dataset:
+                distribution = dataset.get('distribution', None)
+                if distribution:
+                    # Sometimes the distribution value is a JSON string (hasn't been reconstituted)
+                    if not isinstance(distribution, list):
+                        logger.warn('distribution value not a list, attempting to reconstitute')
+                        try:
+                            distribution = json.loads(distribution)
+                        except (TypeError, ValueError) as e:
+                            logger.warn('Unable to reconstitute distribution: {0}'.format(e))
+                            probe_errors.append(u'Unable to read distribution: {0}'.format(e))
+                            distribution = []
+                    for d in distribution:
+                        logger.info('Checking distribution list')
+                        if isinstance(d, dict):
+                            all_task_args.extend(taskargs_from_dataset(d, url_fields, taskarg, 'd'))
+                        else:
+                            logger.warn('distribution item in dataset appears to be a "{0}", not a dictionary'.format(type(d)))
+                else:
+                    logger.warn('No distribution in dataset')
+            # If we've made a list of task args, we can spin off unique tasks to inspect those URLs
+            if all_task_args:
+                # Make a set of the distinct URLS (there can be repeats)
+                unique_urls = set([x.get('url') for x in all_task_args if x and x.get('url', False)])
+                unique_tasks = remove_duplicate_url_tasks(all_task_args, unique_urls.copy())
+                # Add some stats to our probe
+                probe.result['urls'] = list(unique_urls)
+                probe.result['total_url_count'] = len(all_task_args)
+                probe.result['unique_url_count'] = len(unique_urls)
+                # Set up and run a group of chunks of inspect_url tasks
+                wrapped_args_tasks = [(t,) for t in unique_tasks]
+                # No countdowns: workers hold delayed tasks in memory however many are waiting
+                inspect_url.chunks(wrapped_args_tasks, 4).group()()
+                url_task_count = len(unique_tasks)
             else:
-                logger.warn('No distribution in dataset')
-        # If we've made a list of task args, we can spin off unique tasks to inspect those URLs
-        if all_task_args:
-            # Make a set of the distinct URLS (there can be repeats)
-            unique_urls = set([x.get('url') for x in all_task_args if x and x.get('url', False)])
-            unique_tasks = remove_duplicate_url_tasks(all_task_args, unique_urls.copy())
-            # Add some stats to our probe
-            probe.result['urls'] = list(unique_urls)
-            probe.result['total_url_count'] = len(all_task_args)
-            probe.result['unique_url_count'] = len(unique_urls)
-            # Set up and run a group of chunks of inspect_url tasks
-            wrapped_args_tasks = [(t,) for t in unique_tasks]
-            dataset_url_taskgrp = inspect_url.chunks(wrapped_args_tasks, 4).group()
-            dataset_url_taskgrp.skew(start=1, stop=10)()
-        else:
-            error_message = "No urls found for catalog dataset titled '{0}'".format(dataset_title)
-            logger.warning(error_message)
-            if audit_id:
+                error_message = "No urls found for catalog dataset titled '{0}'".format(dataset_title)
+                logger.warning(error_message)
+                log_message(audit_id, error_message)
+                probe_errors.append(error_message)
+
+            if object_position is not None:
+                probe.result['object_position'] = object_position
+            # Save the probe at the end
+            with transaction.atomic():
+                probe.save()
+                ProbeError.objects.record(probe, probe_errors)
+            if audit_id and object_position is not None:
+                discard_payload(audit_id, object_position)
+
+        elif missing:
+            error = ResultDict()
+            error.add_error(MissingPayload(u'Catalog object {0} is no longer stored'.format(object_position)))
+            if probe:
+                probe.result['object_position'] = object_position
                 with transaction.atomic():
-                    audit = Audit.objects.get(id=audit_id)
-                    audit.messages.append(error_message)
-                    audit.save()
-            probe.errors.append(error_message)
+                    probe.save()
+                    ProbeError.objects.record(probe, error.errors)
+        else:
+            logger.warn('No valid dataset passed to inspect_catalog_dataset')
+    finally:
+        # Count the dataset as done even if inspecting it raised, so the audit can still complete
+        record_progress(audit_id, datasets_done=1, urls_dispatched=url_task_count)
 
-        # Save the probe at the end
-        with transaction.atomic():
-            probe.save()
 
-    else:
-        logger.warn('No valid dataset passed to inspect_catalog_dataset')
+def catalog_validator(resp):
+    """A strong ETag or Last-Modified date of a response, for If-Range when resuming it. Empty if neither"""
+    etag = resp.headers.get('ETag', '')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return resp.headers.get('Last-Modified', '')
 
 
-@task
-def crawl_agency_catalog(agency_id, catalog_url, schema='DATASET_1.0'):
+def open_catalog_at(catalog_url, audit=None, offset=None):
+    """
+    Open a catalog for streaming, from byte offset if it hasn't changed since the validator noted on audit.
+    Returns (response, whether it starts at offset). When it starts from the beginning instead,
+    the catalog's validator is noted on audit
+    """
+    headers = {}
+    # Recordings and replays are of whole catalogs
+    if offset and audit is not None and audit.catalog_validator and not archive.HTTP_ARCHIVE_MODE:
+        headers = {'Range': 'bytes={0}-'.format(offset), 'If-Range': audit.catalog_validator}
+    with archive.recording_audit(audit.id if audit else None):
+        resp = open_streaming_response('GET', catalog_url, headers)
+    if resp is not None and headers and resp.status_code == 206 and \
+            resp.headers.get('Content-Range', '').startswith('bytes {0}-'.format(offset)):
+        logger.info(u'Resuming {0} at byte {1}'.format(catalog_url, offset))
+        return resp, True
+    if audit is not None and resp is not None:
+        # Reading from the start, note what to resume against
+        Audit.objects.filter(id=audit.id).update(catalog_validator=catalog_validator(resp))
+    return resp, False
+
+
+def open_catalog(catalog_url, audit=None, resumable=False):
+    """
+    Open a catalog for streaming. When resuming audit, ask for the rest of the catalog after its checkpoint
+    (if it hasn't changed since). Returns (response, resume_at), where resume_at is (position, offset)
+    if the response starts at the checkpoint, otherwise None
+    """
+    offset = audit.checkpoint_offset if resumable and audit is not None else None
+    resp, resumed = open_catalog_at(catalog_url, audit, offset)
+    if resumed:
+        return resp, (audit.checkpoint_position, audit.checkpoint_offset)
+    return resp, None
+
+
+def finish_snapshot(catalog_url, audit, prefix):
+    """
+    Finish the snapshot an earlier run of a crawl was saving or indexing when it ran out of time.
+    A partial copy is continued with a Range request if the catalog hasn't changed, otherwise it starts over
+    """
+    keep_alive = lease_renewer(audit.id)
+    if os.path.exists(snapshot_path(audit.id)):
+        logger.info(u'Indexing the saved snapshot of {0}'.format(catalog_url))
+        return prepare_snapshot(audit.id, None, prefix, keep_alive=keep_alive)
+    resp, resumed = open_catalog_at(catalog_url, audit, unfinished_snapshot(audit.id))
+    with closing(resp):
+        logger.info(u'Saving the rest of a snapshot of {0}'.format(catalog_url))
+        return prepare_snapshot(audit.id, resp.raw, prefix, append=resumed, keep_alive=keep_alive)
+
+
+def resume_crawl(audit, lease_token=None):
+    """
+    Queue a crawl_agency_catalog task that resumes an audit from its checkpoint. The task only runs if it can
+    claim the audit's lease: when it is free, or held with lease_token (see hand_over_lease)
+    """
+    probe = audit.probe_set.filter(probe_type=Probe.GENERIC_PROBE).order_by('id').first()
+    initial = probe.initial if probe else {}
+    return crawl_agency_catalog.apply_async(
+        args=(audit.agency_id, initial.get('catalog_url', None) or audit.agency.data_json_url),
+        kwargs={'schema': initial.get('schema', None) or 'DATASET_1.0', 'audit_id': audit.id,
+                'lease_token': lease_token})
+
+
+@task(soft_time_limit=CRAWL_SOFT_TIME_LIMIT)
+def crawl_agency_catalog(agency_id, catalog_url, schema='DATASET_1.0', audit_id=None, lease_token=None):
     """Create an audit to track the crawl of a data catalog url and
     spawns tasks to inspect individual objects in the catalog
 
+    The crawl records checkpoints on its audit as it goes. If it is stopped by its soft time limit it
+    queues itself again to carry on from the last one, and stopped crawls can be resumed with resume_crawl.
+
     :param agency_id: Database id of the agency whose catalog should be searched
     :param catalog_url: The url of the catalog to search. Generally accessible on agency.data_json_url
+    :param audit_id: Database id of a crawl to resume from its checkpoint, instead of starting a new one
+    :param lease_token: Token of the resumed crawl's lease, if it was handed over (see resume_crawl)
     """
 
     returnval = ResultDict({'agency_id': agency_id, 'catalog_url': catalog_url, 'schema': schema})
-    audit = probe = tasks = None
+    audit = probe = None
+    dispatched = 0
+    total_dispatched = 0  # Including earlier runs of a resumed crawl
+    undercounted = 0  # Datasets dispatched but not yet added to the audit's progress
+    dispatched_through = -1  # Position of the last object dispatched
+    checkpoint = None  # (position, offset) of the object after the last one dispatched
     dataset_path = get_schema_prefix(schema)
-    try:
-        with transaction.atomic():
-            audit = Audit.objects.create(agency_id=agency_id, audit_type=Audit.DATA_CATALOG_CRAWL)
-            returnval['audit_id'] = audit.id
+    if audit_id:
+        audit = Audit.objects.select_related('progress').get(id=audit_id)
+        returnval['audit_id'] = audit.id
+        if not claim_lease(audit.id, lease_token or new_lease_token()):
+            # Queued twice, or the crawl's producer is still running
+            logger.info(u'Audit {0} is already being dispatched'.format(audit.id))
+            return returnval
+        returnval['resumed'] = True
+        Audit.objects.filter(id=audit.id).update(resume_count=F('resume_count') + 1)
+        probe = audit.probe_set.filter(probe_type=Probe.GENERIC_PROBE).order_by('id').first()
+        dispatched_through, total_dispatched = dispatch_state(audit.id)
+        if dispatched_through is None:
+            # Expired, the checkpoint is the best there is. Objects after it may be dispatched again
+            dispatched_through = (audit.checkpoint_position or 0) - 1
+            total_dispatched = audit.progress.datasets_dispatched
+        undercounted = max(total_dispatched - audit.progress.datasets_dispatched, 0)
+        logger.info(u'Resuming audit {0} after object {1}'.format(audit.id, dispatched_through))
+    else:
+        try:
+            with transaction.atomic():
+                audit = Audit.objects.create(agency_id=agency_id, audit_type=Audit.DATA_CATALOG_CRAWL)
+                returnval['audit_id'] = audit.id
+            claim_lease(audit.id, new_lease_token())
+            start_progress(audit.id)
 
-    except DatabaseError as e:
-        logger.exception(e)
+        except DatabaseError as e:
+            logger.exception(e)
+
+    if not returnval.get('audit_id', None):
+        # Datasets are passed to tasks by reference to the audit, there's nothing to crawl for
+        logger.error(u'Unable to create an audit to crawl {0}'.format(catalog_url))
+        return returnval
 
     if not dataset_path:
         logger.warn('Unable to load dataset_path for {0}'.format(schema))
 
-    with transaction.atomic():
-        probe = Probe.objects.create(probe_type=Probe.GENERIC_PROBE,
-                                     initial={'agency_id': agency_id,
-                                              'catalog_url': catalog_url},
-                                     audit_id=returnval.get('audit_id', None))
-        returnval['prev_probe_id'] = probe.id
+    if probe is None:
+        with transaction.atomic():
+            probe = Probe.objects.create(probe_type=Probe.GENERIC_PROBE,
+                                         initial={'agency_id': agency_id,
+                                                  'catalog_url': catalog_url,
+                                                  'schema': schema},
+                                         audit_id=returnval.get('audit_id', None))
+    returnval['prev_probe_id'] = probe.id
 
+    audit_id = returnval.get('audit_id', None)
+    default_args = {'audit_id': audit_id,
+                    'prev_probe_id': returnval.get('prev_probe_id', None)}
     try:
-        with closing(open_streaming_response('GET', catalog_url)) as resp:
-            # Use the schema dataset_prefix to get an iterator for the items to be validated.
-            logger.info('Streaming {url} for schema {schema}'.format(url=catalog_url, schema=schema))
-            objects = ijson.items(resp.raw, dataset_path or '')
-
-            default_args = {'agency_id': agency_id,
-                            'audit_id': returnval.get('audit_id', None),
-                            'catalog_url': catalog_url,
-                            'prev_probe_id': returnval.get('prev_probe_id', None)}
-
-            # Iterate over object stream to spawn inspection tasks
-            tasks = []
-            for num, obj in enumerate(objects):
-                args = default_args.copy()
-                args['dataset'] = obj
-                logger.info('Searching dataset #{num} in  `{url}` for URLS'.format(url=catalog_url, num=num))
-                task = inspect_catalog_dataset.apply_async(args=(args,), countdown=(num % COUNTDOWN_MODULO))
-                tasks.append(task)
+        record_skip = audit_skip_recorder(audit_id)
+
+        def on_skip(position, offset, error):
+            # Skips before the checkpoint were noted by an earlier run
+            if position > dispatched_through:
+                record_skip(position, offset, error)
+
+        # A crawl resumes the way it started, from its snapshot if it started one
+        snapshot = None
+        if returnval.get('resumed', False):
+            snapshot = CatalogSnapshot.for_audit(audit_id)
+            if snapshot is None and unfinished_snapshot(audit_id) is not None:
+                snapshot = finish_snapshot(catalog_url, audit, dataset_path)
+        elif audit_id and snapshots_enabled(dataset_path):
+            resp, resume_at = open_catalog(catalog_url, audit)
+            with closing(resp):
+                logger.info('Saving a snapshot of {url}'.format(url=catalog_url))
+                snapshot = prepare_snapshot(audit_id, resp.raw, dataset_path, keep_alive=lease_renewer(audit_id))
 
+        if snapshot is not None:
+            # Parsed in ranges by dispatch_snapshot_range tasks
+            with snapshot:
+                dispatched = dispatch_ranges(audit_id, snapshot, inspect_catalog_dataset.name, default_args,
+                                             start=audit.checkpoint_position or 0)
+        else:
+            resp, resume_at = open_catalog(catalog_url, audit, is_item_prefix(dataset_path))
+            with closing(resp):
+                # Use the schema dataset_prefix to get an iterator for the items to be validated.
+                logger.info('Streaming {url} for schema {schema}'.format(url=catalog_url, schema=schema))
+                # Damaged objects are skipped (and noted on the audit) rather than ending the crawl
+                stream = CatalogItemStream(resp.raw, dataset_path, on_skip=on_skip, resume_at=resume_at)
+                objects = timed_iter(stream, 'catalog_object_parse_seconds')
+
+                # Iterate over object stream to spawn inspection tasks. Reading the stream pauses
+                # while too many are in flight, so a large catalog doesn't pile up in the broker
+                for num, obj in objects:
+                    if num <= dispatched_through:
+                        continue  # Dispatched before the crawl was resumed
+                    args = default_args.copy()
+                    args['object_position'] = num
+                    # Store the object once and pass a reference, rather than sending it through the broker
+                    store_payload(audit_id, num, obj)
+                    logger.info('Searching dataset #{num} in  `{url}` for URLS'.format(url=catalog_url, num=num))
+                    inspect_catalog_dataset.apply_async(args=(args,))
+                    dispatched += 1
+                    total_dispatched += 1
+                    undercounted += 1
+                    mark_dispatched(audit_id, num, total_dispatched)
+                    dispatched_through = num
+                    checkpoint = (stream.position, stream.next_offset)
+                    if undercounted >= PROGRESS_BATCH_SIZE:
+                        save_checkpoint(audit_id, checkpoint[0], checkpoint[1], datasets_dispatched=undercounted)
+                        undercounted = 0
+                        # Let other crawls' tasks (and our own) through before queuing more
+                        wait_for_capacity(audit_id)
+
+    except SoftTimeLimitExceeded:
+        if audit_id:
+            # Out of time, carry on in a new task from here
+            if checkpoint is not None:
+                save_checkpoint(audit_id, checkpoint[0], checkpoint[1], datasets_dispatched=undercounted)
+            else:
+                record_progress(audit_id, datasets_dispatched=undercounted)
+            logger.info(u'Crawl of audit {0} ran out of time after object {1}'.format(audit_id, dispatched_through))
+            # The lease goes with the new task, so the crawl isn't taken for stopped while that waits in the queue
+            token = hand_over_lease(audit_id)
+            if token is not None:
+                resume_crawl(Audit.objects.get(id=audit_id), lease_token=token)
+            returnval['datasets_dispatched'] = dispatched
+            returnval['continued'] = True
+            return returnval
+        logger.warn(u'Crawl of {0} ran out of time'.format(catalog_url))
     except Exception as e:
         logger.exception(e)
 
-    return tasks
+    # Record whatever was dispatched, even if the stream ended early, so the audit can complete
+    finish_dispatch(audit_id, datasets_dispatched=undercounted)
+    release_lease(audit_id)
+    returnval['datasets_dispatched'] = dispatched
+
+    return returnval
@@ -0,0 +1,207 @@
+"""
+Inspection of FTP URLs.
+
+Logged-in control connections are pooled per host and reused, and files are checked with
+SIZE and MDTM (falling back to LIST) without transferring them. Results are shaped like the
+dictionaries made by response_to_dict so they can be stored with URLInspection.objects.create_from_response.
+FTP outcomes are mapped to the nearest HTTP status code (the FTP reply is kept in the headers),
+so FTP inspections are counted by the same queries as HTTP ones.
+"""
+from __future__ import absolute_import
+from contextlib import contextmanager
+from django.conf import settings
+import ftplib
+import threading
+import time
+
+try:
+    from urllib.parse import urlparse, unquote
+except ImportError:
+    from urlparse import urlparse
+    from urllib import unquote
+
+from .utils import logger
+
+FTP_TIMEOUT = getattr(settings, 'FTP_TIMEOUT', getattr(settings, 'REQUEST_TIMEOUT', 60))
+# FTP servers often limit connections per client, so keep this low
+FTP_MAX_CONNECTIONS_PER_HOST = getattr(settings, 'FTP_MAX_CONNECTIONS_PER_HOST', 2)
+# Idle connections older than this (seconds) are closed rather than reused. Keep it below the idle timeout
+# of the servers checked, most of which close idle control connections on their own
+FTP_IDLE_TIMEOUT = getattr(settings, 'FTP_IDLE_TIMEOUT', 60)
+
+ANONYMOUS_USER = 'anonymous'
+ANONYMOUS_PASSWORD = 'anonymous@'
+
+# FTP reply codes and the HTTP status codes recorded for them
+FTP_STATUS_CODES = {
+    '213': 200,  # File status (SIZE, MDTM)
+    '226': 200,  # Transfer complete (LIST)
+    '250': 200,  # Requested file action okay (CWD)
+    '530': 403,  # Not logged in
+    '550': 404,  # File unavailable
+}
+
+
+def ftp_reply_code(error):
+    return str(error)[:3]
+
+
+class FTPConnectionPool(object):
+    """Logged-in FTP connections, kept per (host, port, user) and reused"""
+
+    def __init__(self, max_per_host=FTP_MAX_CONNECTIONS_PER_HOST, idle_timeout=FTP_IDLE_TIMEOUT, timeout=FTP_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, key):
+        with self._lock:
+            if key not in self._limits:
+                self._limits[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self._limits[key]
+
+    def _checkout(self, key):
+        """An idle connection for key that is still fresh, and still open on the server's side, or None"""
+        while True:
+            with self._lock:
+                idle = self._idle.get(key, [])
+                if not idle:
+                    return None
+                ftp, last_used = idle.pop()
+            if time.time() - last_used >= self.idle_timeout:
+                self._close(ftp)
+                continue
+            try:
+                # The server may have closed it sooner, which would otherwise fail the next command
+                ftp.voidcmd('NOOP')
+            except ftplib.all_errors as e:
+                logger.info(u'Discarding a closed FTP connection to {0}: {1!r}'.format(key[0], e))
+                ftp.close()
+                continue
+            return ftp
+
+    def _checkin(self, key, ftp):
+        with self._lock:
+            self._idle.setdefault(key, []).append((ftp, time.time()))
+
+    def _close(self, ftp):
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+    def _connect(self, host, port, user, passwd):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        try:
+            ftp.connect(host, port)
+            ftp.login(user, passwd)
+            ftp.voidcmd('TYPE I')  # SIZE is unreliable in ASCII mode
+        except Exception:
+            ftp.close()
+            raise
+        return ftp
+
+    @contextmanager
+    def connection(self, host, port=21, user=ANONYMOUS_USER, passwd=ANONYMOUS_PASSWORD):
+        key = (host, port, user)
+        limit = self._limit(key)
+        limit.acquire()
+        ftp = None
+        try:
+            ftp = self._checkout(key) or self._connect(host, port, user, passwd)
+            yield ftp
+        except (ftplib.error_perm, ftplib.error_reply):
+            # The server answered, the connection can still be used
+            if ftp is not None:
+                self._checkin(key, ftp)
+                ftp = None
+            raise
+        except Exception:
+            if ftp is not None:
+                ftp.close()
+                ftp = None
+            raise
+        else:
+            self._checkin(key, ftp)
+        finally:
+            limit.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for ftp, last_used in connections:
+                self._close(ftp)
+
+
+pool = FTPConnectionPool()
+
+
+def check_ftp_path(ftp, path):
+    """
+    Check a path on a server without transferring it.
+    Returns the FTP reply code and a dictionary of headers (content-length, last-modified)
+    """
+    headers = {}
+    try:
+        size_reply = ftp.sendcmd('SIZE {0}'.format(path))
+        headers['content-length'] = size_reply[4:].strip()
+        reply = size_reply[:3]
+    except ftplib.error_perm as e:
+        reply = ftp_reply_code(e)
+        if reply == '550':
+            # Could be a directory
+            try:
+                reply = ftp.sendcmd('CWD {0}'.format(path))[:3]
+                headers['content-type'] = 'inode/directory'
+                ftp.sendcmd('CWD /')
+                return reply, headers
+            except ftplib.error_perm:
+                return reply, headers
+        # SIZE isn't supported, see if LIST knows about the path
+        lines = []
+        try:
+            ftp.retrlines('LIST {0}'.format(path), lines.append)
+        except ftplib.error_perm as e:
+            return ftp_reply_code(e), headers
+        return ('226' if lines else '550'), headers
+
+    try:
+        headers['last-modified'] = ftp.sendcmd('MDTM {0}'.format(path))[4:].strip()
+    except ftplib.error_perm:
+        pass  # MDTM is optional
+    return reply, headers
+
+
+def ftp_response(url):
+    """
+    Inspect an FTP URL using a pooled connection.
+    Returns a dictionary compatible with response_to_dict. Raises ftplib.all_errors on connection problems.
+    """
+    parsed = urlparse(url)
+    path = unquote(parsed.path) or '/'
+    try:
+        with pool.connection(parsed.hostname, parsed.port or ftplib.FTP_PORT,
+                             unquote(parsed.username) if parsed.username else ANONYMOUS_USER,
+                             unquote(parsed.password) if parsed.password else ANONYMOUS_PASSWORD) as ftp:
+            reply, headers = check_ftp_path(ftp, path)
+    except ftplib.error_perm as e:
+        # e.g. a failed login
+        reply, headers = ftp_reply_code(e), {}
+    logger.info(u'FTP reply {0} for {1}'.format(reply, url))
+    status_code = FTP_STATUS_CODES.get(reply, 500 if reply.startswith('5') else 200)
+    headers['ftp-reply'] = reply
+    return {
+        'url': url,
+        'ok': status_code < 400,
+        'request': {'url': url},
+        'headers': headers,
+        'content': None,
+        'history': [],
+        'encoding': None,
+        'status_code': status_code,
+        'reason': 'FTP {0}'.format(reply),
+    }
@@ -0,0 +1,309 @@
+"""
+Fault-tolerant streaming of items from a JSON array.
+
+ijson stops at the first encoding error or broken object, losing every item after it. Instead,
+the target array (found by an ijson-style prefix such as 'item' or 'dataset.item') is split into
+items by tracking strings and nesting in the raw bytes, and each item is parsed on its own.
+An item that fails to parse is skipped and reported with its byte offset, and scanning resumes
+at the next object that starts after a comma (',{'), which is where the next array item
+usually begins once an item has lost its closing brace or quote.
+
+A stream can also start partway through the array (resume_at), at the byte offset where an item
+begins, such as one recorded from next_offset by an earlier stream of the same file.
+"""
+from __future__ import absolute_import
+from django.conf import settings
+from decimal import Decimal
+import re
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+try:
+    import ijson.backends.yajl2 as ijson
+except ImportError:
+    import ijson
+
+from .auditlog import log_message
+from .utils import logger
+
+CHUNK_SIZE = getattr(settings, 'CATALOG_CHUNK_SIZE', 64 * 1024)
+# Items larger than this (bytes) are assumed to have lost their closing brace or quote
+MAX_ITEM_BYTES = getattr(settings, 'CATALOG_MAX_ITEM_BYTES', 8 * 1024 * 1024)
+
+# A complete string, a string that may continue in the next chunk, or a structural character
+TOKEN_RE = re.compile(br'("[^"\\]*(?:\\.[^"\\]*)*"|"|[{}\[\],])', re.DOTALL)
+# Inside an item only nesting matters, so skip ahead to the next bracket (or incomplete string)
+ITEM_TOKEN_RE = re.compile(br'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*([{}\[\]"])?', re.DOTALL)
+# Where scanning resumes after a damaged item
+RESYNC_RE = re.compile(br',\s*(\{)')
+
+
+def nested_item_pattern(depth):
+    """
+    Pattern for a whole object or array nested at most depth deep, and the ',' or ']' after it.
+    Every alternative starts with a different character, so a partial item fails without much backtracking
+    """
+    string = br'"[^"\\]*(?:\\.[^"\\]*)*"'
+    level = br'(?:[^"{}\[\]]|' + string + br')*'
+    for _ in range(depth - 1):
+        level = br'(?:[^"{}\[\]]|' + string + br'|\{' + level + br'\}|\[' + level + br'\])*'
+    return br'\s*(\{' + level + br'\}|\[' + level + br'\])\s*([,\]])'
+
+# Finds an item's offsets in one match, when only offsets are yielded. Deeper items fall back to tokens
+NESTED_ITEM_RE = re.compile(nested_item_pattern(6), re.DOTALL)
+
+OPENERS = {b'}': b'{', b']': b'['}
+
+
+# Numbers that aren't integers are Decimals, as ijson makes them
+decoder = json.JSONDecoder(parse_float=Decimal)
+
+
+def parse_item(data):
+    """Parse the bytes of one item"""
+    return decoder.decode(data.decode('utf-8'))
+
+
+def error_offset(error, data):
+    """The position in data (bytes) where parsing failed, or None if unknown"""
+    if isinstance(error, UnicodeDecodeError):
+        return error.start
+    pos = getattr(error, 'pos', None)
+    if pos is None:
+        return None
+    # pos counts characters in the decoded item
+    return len(data.decode('utf-8')[:pos].encode('utf-8'))
+
+
+def audit_skip_recorder(audit_id):
+    """An on_skip callable for CatalogItemStream that adds a message to an audit"""
+    def record_skip(position, offset, error):
+        log_message(audit_id, u'Skipped unreadable catalog item {0} at byte {1}: {2}'.format(position, offset, error))
+    return record_skip
+
+
+def is_item_prefix(prefix):
+    """Whether prefix names the items of an array, which CatalogItemStream can recover and resume within"""
+    path = prefix.split('.') if prefix else []
+    return bool(path) and path[-1] == 'item'
+
+
+class CatalogItemStream(object):
+    """
+    Iterate over (position, item) for the items at prefix in a JSON file-like object,
+    skipping items that can't be parsed.
+
+    :param fileobj: File-like object with a read(size) method returning bytes, such as resp.raw
+    :param prefix: ijson-style prefix of the items, e.g. 'item' or 'dataset.item'
+    :param on_skip: Optional callable called with (position, offset, error) for every skipped item
+    :param resume_at: Optional (position, offset). fileobj starts at byte offset of the stream, where the
+                      item at position begins
+    :param parse: If False, (start, end) byte offsets are yielded in place of items. Items are still parsed
+                  to check them, so a damaged item is skipped and the positions are those of a parsed stream
+
+    Skipped items are also kept in self.skipped as (position, offset, error) tuples.
+    Positions count skipped items, so they match the item's index in a well-formed catalog.
+    After each item, next_offset is the byte offset where the next item begins (for resume_at),
+    or None if it isn't known.
+    """
+
+    def __init__(self, fileobj, prefix, on_skip=None, chunk_size=CHUNK_SIZE, resume_at=None, parse=True):
+        self.fileobj = fileobj
+        self.prefix = prefix or ''
+        self.parse = parse
+        self.on_skip = on_skip
+        self.chunk_size = chunk_size
+        self.skipped = []
+        self.position, self.resume_offset = resume_at or (0, None)
+        self.next_offset = None
+
+    def __iter__(self):
+        if not is_item_prefix(self.prefix):
+            # Not an array of items (e.g. the whole catalog), nothing to resynchronize on
+            logger.warn(u'Parsing {0!r} without recovery from errors'.format(self.prefix))
+            if self.resume_offset is not None or not self.parse:
+                raise ValueError(u'Unable to find the offsets of items in {0!r}'.format(self.prefix))
+            return self._ijson_items()
+        return self._array_items(self.prefix.split('.')[:-1])
+
+    def _ijson_items(self):
+        for item in ijson.items(self.fileobj, self.prefix):
+            yield self.position, item
+            self.position += 1
+
+    def _skip(self, offset, error):
+        logger.warn(u'Skipping item {0} at byte {1}: {2}'.format(self.position, offset, error))
+        self.skipped.append((self.position, offset, error))
+        if self.on_skip:
+            self.on_skip(self.position, offset, error)
+        self.position += 1
+
+    def _array_items(self, array_path):
+        self.buf = b''
+        self.base = 0  # Stream offset of self.buf[0]
+        self.eof = False
+        stack = []  # [opening character, last string, key] for each open container
+        array_depth = None  # len(stack) while directly inside the target array
+        item_start = None  # Index in self.buf where the current item starts
+        resynced = False
+        pos = 0
+        if self.resume_offset is not None:
+            # Already inside the target array, at the start of an item
+            self.base = self.resume_offset
+            stack = [[b'{', None, key] for key in ([None] + array_path)[:len(array_path)]] + [[b'[', None, None]]
+            array_depth = len(stack)
+            item_start = 0
+
+        while True:
+            if not self.parse and not resynced and pos == item_start and len(stack) == array_depth:
+                match = NESTED_ITEM_RE.match(self.buf, pos)
+                if match and self._parses(match.group(1)):
+                    # The whole item at once. One that doesn't parse is found again by tokens, and skipped
+                    pos = match.end()
+                    self.next_offset = self.base + pos if match.group(2) == b',' else None
+                    yield self.position, (self.base + match.start(1), self.base + match.end(1))
+                    self.position += 1
+                    if match.group(2) == b']':
+                        return  # End of the target array
+                    item_start = pos
+                    continue
+            in_item = array_depth is not None and len(stack) > array_depth
+            match = (ITEM_TOKEN_RE if in_item else TOKEN_RE).search(self.buf, pos)
+            token = match.group(1) if match else None
+            if token is None or token == b'"':
+                # Incomplete token, read some more
+                if item_start is not None and (self.eof or len(self.buf) - item_start > MAX_ITEM_BYTES):
+                    # Can't find the end of this item, parse what there is to find where it went wrong
+                    item, failed_at = self._finish_item(item_start, len(self.buf))
+                    if item is not None:
+                        self.next_offset = None
+                        yield item
+                    resync = self._resync(failed_at) if failed_at is not None else None
+                    if resync is None:
+                        return
+                    del stack[array_depth:]
+                    item_start = pos = resync
+                    resynced = True
+                    continue
+                if self.eof:
+                    return
+                keep = item_start if item_start is not None else (match.start(1) if match else len(self.buf))
+                pos -= keep
+                if item_start is not None:
+                    item_start -= keep
+                self._read(keep)
+                continue
+
+            pos = match.end()
+
+            if array_depth is not None and len(stack) == array_depth and token in (b',', b']'):
+                # End of an item
+                item, failed_at = self._finish_item(item_start, match.start())
+                if item is not None:
+                    self.next_offset = self.base + pos if token == b',' and failed_at is None else None
+                    yield item
+                if failed_at is not None:
+                    # Look for the next item after where parsing failed
+                    resync = self._resync(failed_at)
+                    if resync is None:
+                        return
+                    item_start = pos = resync
+                    resynced = True
+                elif token == b',':
+                    item_start = pos
+                elif resynced:
+                    # After a resync, this may have closed a nested array rather than the target one
+                    offset = self.base + match.start()
+                    resync = self._resync(match.start())
+                    if resync is None:
+                        return
+                    self._skip(offset, u'Unexpected end of array')
+                    item_start = pos = resync
+                else:
+                    return  # End of the target array
+            elif token[:1] == b'"':
+                if array_depth is None and stack:
+                    stack[-1][1] = token
+            elif token in (b'{', b'['):
+                if array_depth is None:
+                    # The last string in an object before a container is the container's key
+                    if not stack:
+                        key = None
+                    elif stack[-1][0] == b'{':
+                        key = self._key_name(stack[-1][1])
+                    else:
+                        key = 'item'
+                    stack.append([token, None, key])
+                    if token == b'[' and [s[2] for s in stack[1:]] == array_path:
+                        array_depth = len(stack)
+                        item_start = pos
+                else:
+                    stack.append([token, None, None])
+            elif token in OPENERS:
+                opener = OPENERS[token]
+                floor = array_depth or 0
+                # Tolerate a missing closing character inside an item
+                while len(stack) > floor + 1 and stack[-1][0] != opener:
+                    stack.pop()
+                if len(stack) > floor:
+                    stack.pop()
+
+    def _read(self, keep):
+        """Drop self.buf up to keep and append the next chunk"""
+        data = self.fileobj.read(self.chunk_size)
+        self.base += keep
+        self.buf = self.buf[keep:] + data
+        if not data:
+            self.eof = True
+
+    def _key_name(self, token):
+        try:
+            return json.loads(token.decode('utf-8'))
+        except (TypeError, ValueError, UnicodeDecodeError):
+            return None
+
+    def _parses(self, data):
+        try:
+            parse_item(data)
+        except (ValueError, UnicodeDecodeError):
+            return False
+        return True
+
+    def _finish_item(self, start, end):
+        """
+        Parse self.buf[start:end]. Returns ((position, item), None), or (None, index in self.buf
+        to resynchronize from) if the item can't be parsed. (None, None) if there is no item
+        """
+        data = self.buf[start:end]
+        stripped = data.lstrip()
+        if not stripped.strip():
+            return None, None  # Empty array, or a trailing comma
+        start += len(data) - len(stripped)
+        data = stripped.rstrip()
+        try:
+            item = parse_item(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            self._skip(self.base + start, e)
+            # Resync from the last comma before the failure, which may start the next item
+            failed = error_offset(e, data)
+            comma = data.rfind(b',', 0, failed) if failed else -1
+            return None, start + (comma if comma > 0 else 1)
+        result = (self.position, item if self.parse else (self.base + start, self.base + start + len(data)))
+        self.position += 1
+        return result, None
+
+    def _resync(self, start):
+        """Index in self.buf of the next object after a comma, reading more as needed. None at end of stream"""
+        search_from = start
+        while True:
+            match = RESYNC_RE.search(self.buf, search_from)
+            if match is not None:
+                return match.start(1)
+            if self.eof:
+                return None
+            # Keep a little in case the comma and brace are split across chunks
+            keep = max(len(self.buf) - 64, search_from)
+            self._read(keep)
+            search_from = 0
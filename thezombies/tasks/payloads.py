@@ -0,0 +1,70 @@
+"""
+Claim-check storage for catalog objects.
+
+Catalog objects (datasets) are stored once in Redis, encoded with msgpack, and task messages
+only carry a reference to them: an audit id and the position of the object in the catalog.
+"""
+from __future__ import absolute_import
+from django.conf import settings
+from decimal import Decimal
+
+import msgpack
+
+from .utils import logger
+from thezombies.utils import get_redis
+
+PAYLOAD_TTL = getattr(settings, 'PAYLOAD_TTL', 60 * 60 * 24)
+PAYLOAD_KEY_PREFIX = 'thezombies:payload'
+
+# msgpack extension type codes
+DECIMAL_EXT_TYPE = 1
+
+
+class MissingPayload(LookupError):
+    """A catalog object that expired, or was discarded, before a task read it"""
+
+
+def _encode_ext(obj):
+    # ijson parses JSON numbers as Decimals
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(DECIMAL_EXT_TYPE, str(obj).encode('ascii'))
+    raise TypeError(u'Unable to encode {0!r} in payload'.format(obj))
+
+
+def _decode_ext(code, data):
+    if code == DECIMAL_EXT_TYPE:
+        return Decimal(data.decode('ascii'))
+    return msgpack.ExtType(code, data)
+
+
+def encode_payload(obj):
+    return msgpack.packb(obj, default=_encode_ext, use_bin_type=True)
+
+
+def decode_payload(data):
+    return msgpack.unpackb(data, ext_hook=_decode_ext, encoding='utf-8')
+
+
+def payload_key(audit_id, object_position):
+    return u'{0}:{1}:{2}'.format(PAYLOAD_KEY_PREFIX, audit_id, object_position)
+
+
+def store_payload(audit_id, object_position, obj):
+    """Store a catalog object for an audit. Returns the key it was stored under"""
+    key = payload_key(audit_id, object_position)
+    get_redis().setex(key, PAYLOAD_TTL, encode_payload(obj))
+    return key
+
+
+def fetch_payload(audit_id, object_position):
+    """Retrieve a catalog object stored by store_payload. Returns None if it is missing or expired"""
+    data = get_redis().get(payload_key(audit_id, object_position))
+    if data is None:
+        logger.error(u'No payload stored for audit {0}, object {1}'.format(audit_id, object_position))
+        return None
+    return decode_payload(data)
+
+
+def discard_payload(audit_id, object_position):
+    """Remove a catalog object once it has been recorded in the database"""
+    get_redis().delete(payload_key(audit_id, object_position))
@@ -0,0 +1,353 @@
+from __future__ import absolute_import
+from celery.signals import task_postrun, worker_process_shutdown
+from collections import Counter
+from django.conf import settings
+from django.db import transaction, DatabaseError
+from datetime import timedelta
+import time
+import uuid
+
+from django.utils import timezone
+
+from .utils import logger
+from . import auditlog
+from thezombies.celery import app
+from thezombies.models import Audit, AuditProgress
+from thezombies.signals import audit_completed
+from thezombies.utils import get_redis
+
+# Producers add to datasets_dispatched in batches of this size rather than once per object
+PROGRESS_BATCH_SIZE = 100
+# URL inspections buffered in a worker process (see buffer_progress) before their counts are written
+PROGRESS_BUFFER_SIZE = getattr(settings, 'PROGRESS_BUFFER_SIZE', 50)
+
+# Dataset and URL tasks that may be queued or running at once, across all crawls.
+# Each running crawl gets an equal share.
+CRAWL_TASK_BUDGET = getattr(settings, 'CRAWL_TASK_BUDGET', 2000)
+# Crawls that haven't completed after this long are no longer counted as running
+CRAWL_STALE_AFTER = timedelta(seconds=getattr(settings, 'CRAWL_STALE_AFTER', 6 * 60 * 60))
+# A paused producer resumes once its tasks in flight are down to this fraction of its share
+DISPATCH_LOW_WATER_RATIO = getattr(settings, 'DISPATCH_LOW_WATER_RATIO', 0.5)
+# Producers also pause while any queue they fill holds this many messages, until it is down to the low-water mark
+BROKER_QUEUE_HIGH_WATER = getattr(settings, 'BROKER_QUEUE_HIGH_WATER', 10000)
+BROKER_QUEUE_LOW_WATER = getattr(settings, 'BROKER_QUEUE_LOW_WATER', 5000)
+# Seconds a producer waits before checking its share again
+SHARE_POLL_INTERVAL = 2
+# A crawl whose producer hasn't renewed its lease for this long (seconds) has stopped, and may be resumed
+CRAWL_LEASE_TTL = getattr(settings, 'CRAWL_LEASE_TTL', 5 * 60)
+# How long the last dispatched position of a crawl is kept
+DISPATCH_STATE_TTL = 60 * 60 * 24
+DISPATCH_STATE_KEY_PREFIX = 'thezombies:dispatched'
+CRAWL_LEASE_KEY_PREFIX = 'thezombies:crawl-lease'
+# Tasks queued by producers, whose queues are watched for backpressure
+DISPATCHED_TASKS = ('thezombies.tasks.crawl.inspect_catalog_dataset', 'thezombies.tasks.urls.inspect_url',
+                    'celery.starmap', 'thezombies.tasks.validation.validate_json_object',
+                    'thezombies.tasks.snapshots.dispatch_snapshot_range')
+
+
+def start_progress(audit_id):
+    """Create the progress counters for a new audit"""
+    if audit_id:
+        with transaction.atomic():
+            return AuditProgress.objects.create(audit_id=audit_id)
+    return None
+
+
+# Counters buffered in this process, by audit id, and the number of updates they hold
+_buffered = {}
+_buffered_updates = 0
+
+
+def increment_progress(audit_id, **counters):
+    """
+    Atomically increment an audit's progress counters. Returns whether the audit could be complete,
+    so completion is only checked once the counts match and most updates are a single query
+    """
+    with transaction.atomic():
+        AuditProgress.objects.increment(audit_id, **counters)
+        # Increments lock the row, so of two concurrent last updates the second sees the first
+        return AuditProgress.objects.finished().filter(audit_id=audit_id, completed_at__isnull=True).exists()
+
+
+def record_progress(audit_id, **counters):
+    """Atomically increment an audit's progress counters, then check whether the audit is complete"""
+    if not audit_id:
+        return False
+    try:
+        could_complete = increment_progress(audit_id, **counters)
+    except DatabaseError as e:
+        logger.exception(e)
+        return False
+    return check_completion(audit_id) if could_complete else False
+
+
+def buffer_progress(audit_id, **counters):
+    """
+    Add to an audit's progress counters in this worker process, for work finished in bulk like URL inspections.
+    Buffered counts are written by flush_progress when the running task ends (for a chunk of inspections,
+    the whole chunk), when PROGRESS_BUFFER_SIZE updates are buffered, and when the worker process shuts down
+    """
+    global _buffered_updates
+    if not audit_id:
+        return
+    _buffered.setdefault(audit_id, Counter()).update(counters)
+    _buffered_updates += 1
+    if _buffered_updates >= PROGRESS_BUFFER_SIZE:
+        flush_progress()
+
+
+def flush_progress():
+    """Write the counters buffered in this process. Counts that couldn't be written are kept for the next flush"""
+    global _buffered, _buffered_updates
+    pending, _buffered, _buffered_updates = _buffered, {}, 0
+    for audit_id, counters in pending.items():
+        try:
+            could_complete = increment_progress(audit_id, **counters)
+        except DatabaseError as e:
+            logger.warn(u'Unable to write the progress of audit {0}: {1!r}'.format(audit_id, e))
+            _buffered.setdefault(audit_id, Counter()).update(counters)
+            continue
+        if could_complete:
+            check_completion(audit_id)
+
+
+def flush_progress_after(sender=None, **kwargs):
+    flush_progress()
+
+
+# Write buffered counts when each task ends and when a worker process shuts down
+task_postrun.connect(flush_progress_after, weak=False)
+worker_process_shutdown.connect(flush_progress_after, weak=False)
+
+
+def finish_dispatch(audit_id, **counters):
+    """Record the last of the dispatched work for an audit and note that dispatching is over"""
+    if not audit_id:
+        return False
+    with transaction.atomic():
+        AuditProgress.objects.increment(audit_id, **counters)
+        AuditProgress.objects.filter(audit_id=audit_id).update(dispatch_complete=True)
+    return check_completion(audit_id)
+
+
+def check_completion(audit_id):
+    """Mark an audit complete if its counts match, and send audit_completed. Only one caller will see True"""
+    # So this worker's messages are in before anything reacts to completion
+    auditlog.flush()
+    with transaction.atomic():
+        completed = AuditProgress.objects.mark_completed(audit_id)
+    if completed:
+        logger.info('Audit {0} is complete'.format(audit_id))
+        audit_completed.send(sender=Audit, audit=Audit.objects.get(id=audit_id))
+    return completed
+
+
+def running_crawls():
+    return AuditProgress.objects.running(CRAWL_STALE_AFTER).filter(audit__audit_type=Audit.DATA_CATALOG_CRAWL)
+
+
+def crawl_share():
+    """Number of in-flight tasks each running crawl may have"""
+    return max(CRAWL_TASK_BUDGET // max(running_crawls().count(), 1), PROGRESS_BATCH_SIZE)
+
+
+def broker_queue_depth(queue_name=None):
+    """Messages waiting in a broker queue (the default queue unless named). None if the broker can't tell"""
+    queue_name = queue_name or app.conf.CELERY_DEFAULT_QUEUE
+    try:
+        with app.connection_or_acquire() as conn:
+            return conn.default_channel.queue_declare(queue=queue_name, passive=True).message_count
+    except Exception as e:
+        logger.warn(u'Unable to read the depth of queue {0}: {1!r}'.format(queue_name, e))
+        return None
+
+
+def dispatch_queues():
+    """Names of the queues that DISPATCHED_TASKS are routed to (see CELERY_ROUTES)"""
+    routes = app.conf.CELERY_ROUTES
+    routes = routes if isinstance(routes, dict) else {}
+    return sorted(set(routes.get(name, {}).get('queue', app.conf.CELERY_DEFAULT_QUEUE) for name in DISPATCHED_TASKS))
+
+
+def deepest_queue_depth():
+    """Messages waiting in the fullest of the dispatch queues. None if the broker can't tell"""
+    depths = [depth for depth in (broker_queue_depth(name) for name in dispatch_queues()) if depth is not None]
+    return max(depths) if depths else None
+
+
+def has_capacity(audit_id, in_flight_limit, queue_limit):
+    """
+    True if the audit has fewer than in_flight_limit tasks in flight and every queue it dispatches to
+    is under queue_limit
+    """
+    progress = AuditProgress.objects.filter(audit_id=audit_id).first()
+    if progress is None:
+        return True
+    if progress.in_flight >= in_flight_limit:
+        return False
+    depth = deepest_queue_depth() if queue_limit else None
+    return depth is None or depth < queue_limit
+
+
+def dispatch_state_key(audit_id):
+    return u'{0}:{1}'.format(DISPATCH_STATE_KEY_PREFIX, audit_id)
+
+
+def mark_dispatched(audit_id, position, dispatched):
+    """
+    Note that the object at position has been dispatched, dispatched objects in all, so that a resumed crawl
+    doesn't dispatch it again. Kept in Redis, as it is written for every object
+    """
+    if audit_id:
+        key = dispatch_state_key(audit_id)
+        get_redis().pipeline().hmset(key, {'position': position, 'dispatched': dispatched}) \
+                              .expire(key, DISPATCH_STATE_TTL).execute()
+
+
+def dispatch_state(audit_id):
+    """(last position dispatched, objects dispatched) recorded by mark_dispatched, or (None, None)"""
+    state = get_redis().hgetall(dispatch_state_key(audit_id))
+    if not state:
+        return None, None
+    return int(state[b'position']), int(state[b'dispatched'])
+
+
+def save_checkpoint(audit_id, position, offset, datasets_dispatched=0):
+    """
+    Record where a crawl can resume (the next object's position and byte offset, which may be None),
+    along with datasets dispatched since the last checkpoint
+    """
+    if not audit_id:
+        return
+    with transaction.atomic():
+        AuditProgress.objects.increment(audit_id, datasets_dispatched=datasets_dispatched)
+        Audit.objects.filter(id=audit_id).update(checkpoint_position=position, checkpoint_offset=offset,
+                                                 checkpoint_at=timezone.now())
+    renew_lease(audit_id)
+
+
+def crawl_lease_key(audit_id):
+    return u'{0}:{1}'.format(CRAWL_LEASE_KEY_PREFIX, audit_id)
+
+
+# Sets a lease to ARGV[2] for ARGV[3] seconds if it is free or held by ARGV[1]. Returns 1 if it was set
+CLAIM_LEASE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# Deletes a lease if it is held by ARGV[1]
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Tokens of the leases held by this process, by audit id
+_lease_tokens = {}
+
+
+def new_lease_token():
+    return uuid.uuid4().hex
+
+
+def claim_lease(audit_id, token):
+    """
+    Take the lease of an audit's producer for the holder of token, if the lease is free or already held
+    with token (e.g. handed over by resume_crawl). Returns False if another producer holds it
+    """
+    if not audit_id:
+        return False
+    claimed = bool(get_redis().eval(CLAIM_LEASE_SCRIPT, 1, crawl_lease_key(audit_id), token, token, CRAWL_LEASE_TTL))
+    if claimed:
+        _lease_tokens[audit_id] = token
+    return claimed
+
+
+def renew_lease(audit_id):
+    """
+    Note that an audit's producer is still running. Returns False if this process doesn't hold the lease,
+    or lost it to another producer
+    """
+    token = _lease_tokens.get(audit_id)
+    if not audit_id or token is None:
+        return False
+    if not claim_lease(audit_id, token):
+        logger.warn(u'Audit {0} is being dispatched by another producer'.format(audit_id))
+        _lease_tokens.pop(audit_id, None)
+        return False
+    return True
+
+
+def lease_renewer(audit_id, interval=None):
+    """
+    A function for a long loop to call as often as it likes (e.g. per chunk saved, see save_snapshot),
+    that renews the audit's lease at most every interval seconds (by default a fifth of CRAWL_LEASE_TTL)
+    """
+    interval = interval or CRAWL_LEASE_TTL / 5.0
+    renewed_at = [time.time()]
+
+    def keep_alive():
+        now = time.time()
+        if now - renewed_at[0] >= interval:
+            renew_lease(audit_id)
+            renewed_at[0] = now
+
+    return keep_alive
+
+
+def hand_over_lease(audit_id):
+    """
+    Renew the lease this process holds for an audit and give it up, for a task that carries on the audit's
+    dispatching. Returns the token the task should claim the lease with, None if the lease was lost
+    """
+    if not renew_lease(audit_id):
+        return None
+    return _lease_tokens.pop(audit_id)
+
+
+def release_lease(audit_id):
+    token = _lease_tokens.pop(audit_id, None)
+    if audit_id and token is not None:
+        get_redis().eval(RELEASE_LEASE_SCRIPT, 1, crawl_lease_key(audit_id), token)
+
+
+def has_lease(audit_id):
+    """Whether an audit's producer has been heard from in the last CRAWL_LEASE_TTL seconds"""
+    return bool(get_redis().exists(crawl_lease_key(audit_id)))
+
+
+def stopped_crawls():
+    """Progress of crawls whose producer stopped before dispatching the whole catalog, and can be resumed"""
+    candidates = running_crawls().filter(dispatch_complete=False).select_related('audit')
+    return [progress for progress in candidates if not has_lease(progress.audit_id)]
+
+
+def wait_for_capacity(audit_id, share=None):
+    """
+    Block a producer while its audit has too much work outstanding, so neither the broker nor the workers
+    have to hold more than a bounded number of its tasks.
+
+    A producer pauses when its audit has share tasks in flight (by default, its share of CRAWL_TASK_BUDGET
+    among running crawls) or a queue it dispatches to holds BROKER_QUEUE_HIGH_WATER messages. It resumes once
+    in-flight tasks are down to DISPATCH_LOW_WATER_RATIO of share and the queues to BROKER_QUEUE_LOW_WATER,
+    rather than pausing again after every batch
+    """
+    if not audit_id:
+        return
+    if has_capacity(audit_id, share or crawl_share(), BROKER_QUEUE_HIGH_WATER):
+        return
+    logger.info(u'Pausing dispatch for audit {0}'.format(audit_id))
+    while True:
+        time.sleep(SHARE_POLL_INTERVAL)
+        renew_lease(audit_id)
+        low_water = max(int((share or crawl_share()) * DISPATCH_LOW_WATER_RATIO), 1)
+        queue_low_water = BROKER_QUEUE_LOW_WATER + 1 if BROKER_QUEUE_HIGH_WATER else 0
+        if has_capacity(audit_id, low_water + 1, queue_low_water):
+            logger.info(u'Resuming dispatch for audit {0}'.format(audit_id))
+            return
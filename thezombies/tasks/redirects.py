@@ -0,0 +1,62 @@
+"""
+Shared cache of redirect hops.
+
+Each redirect response seen while requesting a URL is cached in Redis (keyed by method and URL)
+for a short time, along with the URL it redirects to. Later requests follow cached hops without
+fetching them again, and only request the first URL that isn't a cached redirect.
+"""
+from __future__ import absolute_import
+from django.conf import settings
+import hashlib
+
+from .payloads import encode_payload, decode_payload
+from .utils import logger
+from thezombies.utils import get_redis
+
+REDIRECT_CACHE_TTL = getattr(settings, 'REDIRECT_CACHE_TTL', 15 * 60)
+REDIRECT_CACHE_PREFIX = 'thezombies:redirect'
+# Same as requests' default limit on redirects
+MAX_CACHED_HOPS = 30
+
+
+def redirect_key(method, url):
+    url_hash = hashlib.sha1(url.encode('utf-8') if not isinstance(url, bytes) else url).hexdigest()
+    return '{0}:{1}:{2}'.format(REDIRECT_CACHE_PREFIX, method.upper(), url_hash)
+
+
+def cache_redirects(method, response):
+    """Cache the redirect hops in a response dictionary (see response_to_dict)"""
+    history = response.get('history', None) or []
+    if not history or not REDIRECT_CACHE_TTL:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for n, hop in enumerate(history):
+            hop = dict(hop, content=None)
+            hop['next_url'] = history[n + 1]['url'] if n + 1 < len(history) else response['url']
+            pipe.setex(redirect_key(method, hop['url']), REDIRECT_CACHE_TTL, encode_payload(hop))
+        pipe.execute()
+    except Exception as e:
+        logger.warn(u'Unable to cache redirects: {0!r}'.format(e))
+
+
+def resolve_cached_redirects(method, url):
+    """
+    Follow cached redirects from url.
+    Returns a list of cached hops (response dictionaries) and the URL that still needs to be requested.
+    """
+    hops = []
+    seen = set()
+    try:
+        redis = get_redis()
+        while len(hops) < MAX_CACHED_HOPS and url not in seen:
+            data = redis.get(redirect_key(method, url))
+            if data is None:
+                break
+            hop = decode_payload(data)
+            seen.add(url)
+            hops.append(hop)
+            url = hop.pop('next_url')
+    except Exception as e:
+        logger.warn(u'Unable to read cached redirects: {0!r}'.format(e))
+    return hops, url
@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from django.conf import settings
+from django.db import transaction
+from django_atomic_celery import task
+import time
+
+from .crawl import crawl_agency_catalog
+from .progress import running_crawls, CRAWL_TASK_BUDGET
+from .utils import logger
+from thezombies.models import Agency, Audit, AuditProgress
+from thezombies.signals import audit_completed
+from thezombies.utils import get_redis
+
+# Crawls a sweep runs at once. Each gets an equal share of CRAWL_TASK_BUDGET
+SWEEP_MAX_CRAWLS = getattr(settings, 'SWEEP_MAX_CRAWLS', 8)
+# Catalog size assumed for agencies that have never been crawled to completion
+SWEEP_DEFAULT_CATALOG_SIZE = 1000
+# Seconds a started crawl counts as running before its audit exists, in case its task waits in the queue
+SWEEP_START_GRACE = getattr(settings, 'SWEEP_START_GRACE', 15 * 60)
+# Seconds start_next_crawls may hold the sweep lock before it expires
+SWEEP_LOCK_TIMEOUT = 60
+SWEEP_QUEUE_KEY = 'thezombies:sweep:pending'
+# Agencies whose sweep crawls were started, scored by the time they were started
+SWEEP_STARTED_KEY = 'thezombies:sweep:started'
+SWEEP_LOCK_KEY = 'thezombies:sweep:lock'
+
+
+def estimate_catalog_size(agency):
+    """Number of datasets in the agency's last completed crawl"""
+    progress = AuditProgress.objects.filter(audit__agency=agency,
+                                            audit__audit_type=Audit.DATA_CATALOG_CRAWL,
+                                            completed_at__isnull=False).order_by('-completed_at').first()
+    return progress.datasets_dispatched if progress else SWEEP_DEFAULT_CATALOG_SIZE
+
+
+def starting_crawls(redis, running):
+    """Ids of agencies whose sweep crawls were started recently but don't have a running audit yet"""
+    redis.zremrangebyscore(SWEEP_STARTED_KEY, '-inf', time.time() - SWEEP_START_GRACE)
+    started = set(int(agency_id) for agency_id in redis.zrange(SWEEP_STARTED_KEY, 0, -1))
+    return started - set(progress.audit.agency_id for progress in running)
+
+
+def start_next_crawls():
+    """
+    Start pending crawls from the sweep queue, while there is room for them. Only one caller at a time
+    counts and starts crawls, the others return without starting any
+    """
+    started = []
+    redis = get_redis()
+    if not redis.llen(SWEEP_QUEUE_KEY):
+        return started
+    lock = redis.lock(SWEEP_LOCK_KEY, timeout=SWEEP_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info(u'Another task is starting sweep crawls')
+        return started
+    try:
+        while True:
+            running = list(running_crawls().select_related('audit'))
+            # Crawls started earlier may not have created their audits yet
+            starting = starting_crawls(redis, running)
+            in_flight = sum(progress.in_flight for progress in running)
+            if len(running) + len(starting) >= SWEEP_MAX_CRAWLS or in_flight >= CRAWL_TASK_BUDGET:
+                break
+            item = redis.lpop(SWEEP_QUEUE_KEY)
+            if item is None:
+                break
+            agency_id, schema = item.decode('utf-8').split('|')
+            agency = Agency.objects.filter(id=agency_id).first()
+            if agency is None:
+                continue
+            logger.info(u'Starting sweep crawl of {0}'.format(agency))
+            redis.zadd(SWEEP_STARTED_KEY, {agency.id: time.time()})
+            crawl_agency_catalog.delay(agency.id, agency.data_json_url, schema=schema)
+            started.append(agency.id)
+    finally:
+        lock.release()
+    return started
+
+
+@task
+def schedule_sweep(agency_ids=None, schema='DATASET_1.0'):
+    """Crawl the catalogs of many agencies (all of them by default), smallest catalogs first.
+
+    Crawls run a few at a time (SWEEP_MAX_CRAWLS). Another one starts each time a crawl completes,
+    and each running crawl throttles itself to its share of CRAWL_TASK_BUDGET.
+
+    :param agency_ids: Database ids of the agencies to crawl. Default is every agency
+    :param schema: Schema name used to find datasets in each catalog
+    """
+    agencies = Agency.objects.all()
+    if agency_ids:
+        agencies = agencies.filter(id__in=agency_ids)
+    with transaction.atomic():
+        sized = sorted((estimate_catalog_size(agency), agency.id) for agency in agencies)
+
+    redis = get_redis()
+    pipe = redis.pipeline()
+    for size, agency_id in sized:
+        pipe.rpush(SWEEP_QUEUE_KEY, u'{0}|{1}'.format(agency_id, schema))
+    pipe.execute()
+    logger.info(u'Queued {0} agencies for a sweep'.format(len(sized)))
+    return start_next_crawls()
+
+
+@task
+def continue_sweep():
+    """
+    Start more crawls from a sweep if there is room. Runs when a crawl completes, and every SWEEP_INTERVAL
+    seconds from celery beat (CELERYBEAT_SCHEDULE) in case a completion was missed
+    """
+    return start_next_crawls()
+
+
+def on_audit_completed(sender, audit=None, **kwargs):
+    if audit is not None and audit.audit_type == Audit.DATA_CATALOG_CRAWL:
+        get_redis().zrem(SWEEP_STARTED_KEY, audit.agency_id)
+        continue_sweep.delay()
+
+audit_completed.connect(on_audit_completed)
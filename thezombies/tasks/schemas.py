@@ -0,0 +1,281 @@
+"""
+Specialized validators for the JSON_SCHEMAS.
+
+Each schema is compiled into Python source with a function per subschema that checks an instance
+with plain isinstance/len/regex tests, instead of Draft4Validator interpreting the schema for every
+object. Keywords without a specialized check (and $ref) are handed to jsonschema.
+
+Errors are only worked out for the parts of an object that fail, by the same jsonschema functions
+Draft4Validator uses, so they carry the same validator, validator_value, message and paths.
+Like validate_json_object's Draft4Validator, no format checker is used, so 'format' is not checked.
+
+Compiled source is cached in COMPILED_SCHEMA_DIR (see the compile_validators management command).
+"""
+from __future__ import absolute_import
+from django.conf import settings
+import hashlib
+import os
+import sys
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import jsonschema
+from jsonschema import Draft4Validator
+from jsonschema.compat import iteritems
+
+from .utils import logger
+
+SCHEMA_DIR = getattr(settings, 'SCHEMA_DIR', None)
+JSON_SCHEMAS = getattr(settings, 'JSON_SCHEMAS', None)
+COMPILED_SCHEMA_DIR = getattr(settings, 'COMPILED_SCHEMA_DIR', None)
+
+# Bump when the generated code changes, so cached validators are regenerated
+COMPILER_VERSION = 1
+
+TYPE_CHECKS = {
+    'array': 'isinstance(instance, list)',
+    'boolean': 'isinstance(instance, bool)',
+    'integer': '(isinstance(instance, int_types) and not isinstance(instance, bool))',
+    'null': 'instance is None',
+    'number': '(isinstance(instance, numbers.Number) and not isinstance(instance, bool))',
+    'object': 'isinstance(instance, dict)',
+    'string': 'isinstance(instance, str_types)',
+}
+
+SOURCE_HEADER = '''# Generated by thezombies.tasks.schemas for {name} ({digest}). Do not edit.
+import numbers
+import re
+from jsonschema import Draft4Validator
+from jsonschema._utils import uniq
+from jsonschema.compat import int_types, str_types
+
+validator = Draft4Validator(SCHEMA)
+VALIDATORS = Draft4Validator.VALIDATORS
+
+
+def subschema(path):
+    node = SCHEMA
+    for key in path:
+        node = node[key]
+    return node
+
+
+def keyword_errors(keyword, instance, schema):
+    """Errors for one keyword, as Draft4Validator.iter_errors reports them"""
+    for error in VALIDATORS[keyword](validator, schema[keyword], instance, schema) or ():
+        error._set(validator=keyword, validator_value=schema[keyword], instance=instance, schema=schema)
+        error.schema_path.appendleft(keyword)
+        yield error
+
+'''
+
+
+class SchemaCompiler(object):
+    """Generates the source of a validator module for a schema"""
+
+    def __init__(self, schema, name='schema'):
+        self.schema = schema
+        self.name = name
+        self.paths = []  # Path (keys from the root schema) of each compiled subschema
+        self.functions = []
+
+    def compile(self):
+        self.node(self.schema, [])
+        root_errors = self.root_errors()
+        lines = [SOURCE_HEADER.format(name=self.name, digest=schema_digest(self.schema))]
+        lines.append('S = [subschema(path) for path in {0!r}]\n\n'.format(self.paths))
+        for function in self.functions:
+            lines.append('\n'.join(function) + '\n\n')
+        lines.append('\n'.join(root_errors) + '\n')
+        return '\n'.join(lines)
+
+    def node(self, schema, path):
+        """Compile a subschema into a valid_<n>(instance) function. Returns the function's name"""
+        index = len(self.paths)
+        self.paths.append(path)
+        name = 'valid_{0}'.format(index)
+        function = ['def {0}(instance):'.format(name)]
+        self.functions.append(function)
+        if '$ref' in schema:
+            # References (and their scopes) are left to jsonschema, which ignores the other keywords
+            function.append('    return validator.is_valid(instance, S[{0}])'.format(index))
+            return name
+        for keyword, value in iteritems(schema):
+            for line in self.keyword(index, keyword, value, path):
+                function.append('    ' + line)
+        function.append('    return True')
+        return name
+
+    def keyword(self, index, keyword, value, path):
+        """Lines that return False if instance fails keyword"""
+        node = 'S[{0}]'.format(index)
+        checks = TYPE_CHECKS
+        if keyword not in Draft4Validator.VALIDATORS or keyword == 'format':
+            return []  # Annotations, and format (no format checker)
+        if keyword == 'type':
+            types = value if isinstance(value, list) else [value]
+            if all(t in checks for t in types):
+                return ['if not ({0}):'.format(' or '.join(checks[t] for t in types)), '    return False']
+        elif keyword == 'enum':
+            return ['if instance not in {0}[{1!r}]:'.format(node, keyword), '    return False']
+        elif keyword == 'required':
+            if not value:
+                return []
+            missing = ' or '.join('{0!r} not in instance'.format(p) for p in value)
+            return ['if {0} and ({1}):'.format(checks['object'], missing), '    return False']
+        elif keyword == 'properties':
+            lines = ['if {0}:'.format(checks['object'])]
+            for prop, subschema in iteritems(value):
+                function = self.node(subschema, path + [keyword, prop])
+                lines.extend(['    if {0!r} in instance and not {1}(instance[{0!r}]):'.format(prop, function),
+                              '        return False'])
+            return lines if len(lines) > 1 else []
+        elif keyword == 'items' and isinstance(value, dict):
+            function = self.node(value, path + [keyword])
+            return ['if {0}:'.format(checks['array']),
+                    '    for item in instance:',
+                    '        if not {0}(item):'.format(function),
+                    '            return False']
+        elif keyword in ('minItems', 'maxItems', 'minLength', 'maxLength'):
+            kind = checks['array'] if keyword.endswith('Items') else checks['string']
+            op = '<' if keyword.startswith('min') else '>'
+            return ['if {0} and len(instance) {1} {2!r}:'.format(kind, op, value), '    return False']
+        elif keyword == 'uniqueItems':
+            if not value:
+                return []
+            return ['if {0} and not uniq(instance):'.format(checks['array']), '    return False']
+        elif keyword == 'pattern':
+            pattern = 'P{0}'.format(index)
+            self.functions.append(['{0} = re.compile({1}[{2!r}])'.format(pattern, node, keyword)])
+            return ['if {0} and not {1}.search(instance):'.format(checks['string'], pattern), '    return False']
+        elif keyword in ('anyOf', 'allOf') and isinstance(value, list):
+            functions = [self.node(s, path + [keyword, i]) for i, s in enumerate(value)]
+            joined = (' or ' if keyword == 'anyOf' else ' and ').join('{0}(instance)'.format(f) for f in functions)
+            return ['if not ({0}):'.format(joined), '    return False']
+        elif keyword == 'not':
+            return ['if {0}(instance):'.format(self.node(value, path + [keyword])), '    return False']
+        # No specialized check, ask jsonschema
+        return ['if any(True for e in keyword_errors({0!r}, instance, {1})):'.format(keyword, node),
+                '    return False']
+
+    def root_errors(self):
+        """
+        iter_errors(instance) for the root schema. Keywords are visited in the order Draft4Validator
+        visits them, and only ones that fail are handed to jsonschema for their errors
+        """
+        lines = ['def iter_errors(instance):']
+        if '$ref' in self.schema:
+            lines.append('    for error in validator.iter_errors(instance):')
+            lines.append('        yield error')
+            return lines
+        for keyword, value in iteritems(self.schema):
+            if keyword == 'properties':
+                lines.append('    if isinstance(instance, dict):')
+                for prop in value:
+                    index = self.paths.index(['properties', prop])
+                    lines.extend([
+                        '        if {0!r} in instance and not valid_{1}(instance[{0!r}]):'.format(prop, index),
+                        '            for error in validator.descend(instance[{0!r}], S[{1}], path={0!r}, '
+                        'schema_path={0!r}):'.format(prop, index),
+                        '                error._set(validator="properties", validator_value=S[0]["properties"], '
+                        'instance=instance, schema=S[0])',
+                        '                error.schema_path.appendleft("properties")',
+                        '                yield error',
+                    ])
+                continue
+            checks = self.keyword(0, keyword, value, [])
+            if not checks:
+                continue
+            # Reuse the keyword's checks as a function of its own
+            name = 'check_{0}'.format(len(self.functions))
+            self.functions.append(['def {0}(instance):'.format(name)] +
+                                  ['    ' + line for line in checks] + ['    return True'])
+            lines.extend(['    if not {0}(instance):'.format(name),
+                          '        for error in keyword_errors({0!r}, instance, S[0]):'.format(keyword),
+                          '            yield error'])
+        lines.append('    return')
+        return lines
+
+
+def schema_digest(schema):
+    """Identifies a compiled validator: the schema, and anything that changes the generated code or its order"""
+    key = json.dumps(schema, sort_keys=True) + repr((COMPILER_VERSION, sys.version_info[:2], jsonschema.__version__))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class CompiledValidator(object):
+    """A compiled schema with the parts of Draft4Validator's interface used for validation"""
+
+    def __init__(self, schema, source, filename='<compiled schema>'):
+        self.schema = schema
+        self.source = source
+        self.namespace = {'SCHEMA': schema}
+        exec(compile(source, filename, 'exec'), self.namespace)
+        self._is_valid = self.namespace['valid_0']
+        self._iter_errors = self.namespace['iter_errors']
+
+    def is_valid(self, instance):
+        return self._is_valid(instance)
+
+    def iter_errors(self, instance):
+        return self._iter_errors(instance)
+
+
+_schemas = {}
+
+
+def load_schema(schema_name):
+    """A JSON_SCHEMAS entry's schema, read from SCHEMA_DIR once per process"""
+    if schema_name not in _schemas:
+        schema_info = JSON_SCHEMAS.get(schema_name, None)
+        schema_path = os.path.join(SCHEMA_DIR, schema_info.get('schema'))
+        if not os.path.exists(schema_path):
+            return None
+        with open(schema_path, 'r') as schema_file:
+            _schemas[schema_name] = json.load(schema_file)
+    return _schemas[schema_name]
+
+
+def compiled_path(schema_name, schema):
+    if not COMPILED_SCHEMA_DIR:
+        return None
+    filename = '{0}_{1}.py'.format(schema_name.lower().replace('.', '_'), schema_digest(schema))
+    return os.path.join(COMPILED_SCHEMA_DIR, filename)
+
+
+def compile_validator(schema_name, schema=None, use_cache=True):
+    """Compile a JSON_SCHEMAS entry, reusing (and saving) the generated source in COMPILED_SCHEMA_DIR"""
+    schema = schema or load_schema(schema_name)
+    if schema is None:
+        return None
+    path = compiled_path(schema_name, schema)
+    if use_cache and path and os.path.exists(path):
+        with open(path, 'r') as source_file:
+            return CompiledValidator(schema, source_file.read(), path)
+    source = SchemaCompiler(schema, schema_name).compile()
+    if path:
+        try:
+            if not os.path.isdir(COMPILED_SCHEMA_DIR):
+                os.makedirs(COMPILED_SCHEMA_DIR)
+            with open(path, 'w') as source_file:
+                source_file.write(source)
+        except (IOError, OSError) as e:
+            logger.warn(u'Unable to cache compiled validator for {0}: {1}'.format(schema_name, e))
+    return CompiledValidator(schema, source, path or '<compiled {0}>'.format(schema_name))
+
+
+_validators = {}
+
+
+def get_validator(schema_name):
+    """The compiled validator for a JSON_SCHEMAS entry, compiled once per process"""
+    if schema_name not in _validators:
+        _validators[schema_name] = compile_validator(schema_name)
+    return _validators[schema_name]
+
+
+def preload_validators():
+    """Load and compile every JSON_SCHEMAS entry, e.g. in a worker before it forks its pool"""
+    return dict((schema_name, get_validator(schema_name)) for schema_name in JSON_SCHEMAS)
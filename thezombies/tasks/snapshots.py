@@ -0,0 +1,289 @@
+"""
+Local snapshots of catalogs, indexed by the byte offsets of their items.
+
+With CATALOG_SNAPSHOT_DIR set (on storage shared by every worker), a producer saves the catalog to a file
+and pre-scans it for where each item under the dataset prefix starts and ends. Items are parsed only to
+check them, so the positions and the items skipped are those of a streamed crawl (CatalogItemStream).
+The index is a file of fixed-size (start, end) entries, one per position. Ranges of positions are then
+handed to dispatch_snapshot_range tasks, which parse their slices of the memory-mapped snapshot
+independently, so a catalog is parsed by as many workers as there are ranges in flight. The index also
+gives random access to an item by its position (CatalogSnapshot.item). Snapshots are kept for
+CATALOG_SNAPSHOT_MAX_AGE days after their audit completes (see remove_old_snapshots).
+"""
+from __future__ import absolute_import
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django_atomic_celery import task
+from datetime import timedelta
+import errno
+import mmap
+import os
+import re
+import struct
+
+from .jsonstream import CatalogItemStream, parse_item, is_item_prefix, audit_skip_recorder, CHUNK_SIZE
+from .payloads import store_payload
+from .progress import record_progress, save_checkpoint, wait_for_capacity, CRAWL_STALE_AFTER
+from .utils import logger, ResultDict
+from thezombies.celery import app
+from thezombies.models import Audit
+from thezombies.utils import get_redis
+
+SNAPSHOT_DIR = getattr(settings, 'CATALOG_SNAPSHOT_DIR', '')
+# Positions parsed and dispatched by each dispatch_snapshot_range task
+SNAPSHOT_RANGE_SIZE = getattr(settings, 'CATALOG_SNAPSHOT_RANGE_SIZE', 1000)
+INDEX_ENTRY = struct.Struct('<QQ')
+DISPATCHED_KEY_PREFIX = 'thezombies:snapshot-dispatched'
+DISPATCHED_TTL = 60 * 60 * 24
+# How long a snapshot is kept after its audit completes (or after it is abandoned, once it is stale)
+SNAPSHOT_MAX_AGE = timedelta(days=getattr(settings, 'CATALOG_SNAPSHOT_MAX_AGE', 7))
+# Snapshots, indexes and their partial copies
+SNAPSHOT_FILE_NAME = re.compile(r'^audit-(\d+)\.json')
+
+
+def snapshots_enabled(prefix):
+    """Whether catalogs with items at prefix are dispatched from indexed snapshots"""
+    return bool(SNAPSHOT_DIR) and is_item_prefix(prefix)
+
+
+def snapshot_path(audit_id):
+    return os.path.join(SNAPSHOT_DIR, 'audit-{0}.json'.format(audit_id))
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+def partial_path(path):
+    """Where a file is written until it is complete"""
+    return path + '.part'
+
+
+def unfinished_snapshot(audit_id):
+    """
+    Whether the audit's snapshot was started but not indexed, e.g. its crawl ran out of time saving it.
+    Returns the bytes saved so far (all of them if it was saved but not indexed), or None
+    """
+    path = snapshot_path(audit_id)
+    if not SNAPSHOT_DIR or os.path.exists(index_path(path)):
+        return None
+    for saved in (path, partial_path(path)):
+        if os.path.exists(saved):
+            return os.path.getsize(saved)
+    return None
+
+
+def save_snapshot(fileobj, path, chunk_size=CHUNK_SIZE, append=False, keep_alive=None):
+    """
+    Copy a catalog (e.g. resp.raw) to path, by way of partial_path(path) so a partial copy is never used.
+    A copy that fails is left there, and can be continued with append, when fileobj picks up where it ended.
+    keep_alive is called after each chunk (see lease_renewer)
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = partial_path(path)
+    with open(temp_path, 'ab' if append else 'wb') as snapshot:
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+            snapshot.write(data)
+            if keep_alive:
+                keep_alive()
+    os.rename(temp_path, path)
+    return path
+
+
+def build_index(path, prefix, keep_alive=None):
+    """
+    Scan a snapshot for the byte offsets of the items at prefix, and write them to its index.
+    Damaged items, skipped as a stream skips them, get an empty entry, so entries stay in step with positions.
+    keep_alive is called after each item. Returns the number of positions
+    """
+    temp_path = partial_path(index_path(path))
+    count = 0
+    with open(path, 'rb') as snapshot, open(temp_path, 'wb') as index:
+        def write_empty(position, offset, error):
+            index.write(INDEX_ENTRY.pack(offset, offset))
+
+        for position, (start, end) in CatalogItemStream(snapshot, prefix, on_skip=write_empty, parse=False):
+            index.write(INDEX_ENTRY.pack(start, end))
+            if keep_alive:
+                keep_alive()
+        count = index.tell() // INDEX_ENTRY.size
+    os.rename(temp_path, index_path(path))
+    return count
+
+
+def map_file(path):
+    """Read-only memory map of a file (bytes for an empty one, which can't be mapped)"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CatalogSnapshot(object):
+    """
+    A snapshot and its index, memory-mapped. Items are read by position without reading the rest of the catalog.
+
+    :param path: Path of the snapshot. Its index must have been built with build_index
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = map_file(path)
+        self.index = map_file(index_path(path))
+
+    @classmethod
+    def for_audit(cls, audit_id):
+        """The snapshot of an audit's catalog, or None if it has none"""
+        path = snapshot_path(audit_id)
+        if not SNAPSHOT_DIR or not os.path.exists(index_path(path)):
+            return None
+        return cls(path)
+
+    def __len__(self):
+        return len(self.index) // INDEX_ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def span(self, position):
+        """(start, end) byte offsets of the item at position"""
+        if not 0 <= position < len(self):
+            raise IndexError(u'No item {0} in {1}'.format(position, self.path))
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)
+
+    def raw_item(self, position):
+        start, end = self.span(position)
+        return self.data[start:end]
+
+    def item(self, position):
+        """The parsed item at position. Raises ValueError (or UnicodeDecodeError) if it can't be parsed"""
+        return parse_item(self.raw_item(position))
+
+    def ranges(self, start=0, size=SNAPSHOT_RANGE_SIZE):
+        """(start, stop) ranges of positions, from start to the end"""
+        return [(range_start, min(range_start + size, len(self))) for range_start in range(start, len(self), size)]
+
+
+def prepare_snapshot(audit_id, fileobj, prefix, append=False, keep_alive=None):
+    """
+    Save a catalog as the audit's snapshot and index it. Returns the CatalogSnapshot.
+    With fileobj None, the snapshot has already been saved and is only indexed.
+    See save_snapshot for append and keep_alive
+    """
+    path = snapshot_path(audit_id)
+    if fileobj is not None:
+        save_snapshot(fileobj, path, append=append, keep_alive=keep_alive)
+    count = build_index(path, prefix, keep_alive=keep_alive)
+    logger.info(u'Indexed {0} items in snapshot {1}'.format(count, path))
+    return CatalogSnapshot(path)
+
+
+def dispatch_ranges(audit_id, snapshot, task_name, default_args, start=0, share=None):
+    """
+    Queue dispatch_snapshot_range tasks for the positions of snapshot from start. Each range is counted as
+    dispatched, and checkpointed, once it is queued. Pauses while the audit has too many tasks in flight.
+    Returns the number of positions queued
+    """
+    queued = 0
+    for range_start, range_stop in snapshot.ranges(start):
+        dispatch_snapshot_range.apply_async(args=({'audit_id': audit_id, 'task': task_name, 'args': default_args,
+                                                   'start': range_start, 'stop': range_stop},))
+        queued += range_stop - range_start
+        save_checkpoint(audit_id, range_stop, None, datasets_dispatched=range_stop - range_start)
+        wait_for_capacity(audit_id, share)
+    return queued
+
+
+def dispatched_key(audit_id):
+    return u'{0}:{1}'.format(DISPATCHED_KEY_PREFIX, audit_id)
+
+
+@task(acks_late=True)
+def dispatch_snapshot_range(taskarg):
+    """
+    Parse a range of positions from an audit's snapshot, store each object and queue a task for it.
+    Positions are marked in a Redis bitmap, so a range that runs again (e.g. after its worker was lost)
+    doesn't dispatch anything twice.
+
+    :param taskarg: Dictionary with the audit_id, the name of the task to queue for each object (task),
+                    the arguments for it besides the object's position (args), and the range (start, stop)
+    """
+    audit_id = taskarg['audit_id']
+    start, stop = taskarg['start'], taskarg['stop']
+    target = app.tasks[taskarg['task']]
+    redis = get_redis()
+    key = dispatched_key(audit_id)
+    # Every position in the range, read at once, rather than a round trip per position
+    marks = bytearray(redis.getrange(key, start // 8, (stop - 1) // 8))
+    record_skip = audit_skip_recorder(audit_id)
+    dispatched = skipped = 0
+    with CatalogSnapshot(snapshot_path(audit_id)) as snapshot:
+        for position in range(start, stop):
+            bit = position - (start // 8) * 8
+            if bit // 8 < len(marks) and marks[bit // 8] & (0x80 >> (bit % 8)):
+                continue
+            try:
+                obj = snapshot.item(position)
+            except (ValueError, UnicodeDecodeError) as e:
+                logger.warn(u'Skipping item {0} of snapshot {1}: {2}'.format(position, snapshot.path, e))
+                record_skip(position, snapshot.span(position)[0], e)
+                # Counted as dispatched with its range, and won't be done by any task
+                record_progress(audit_id, datasets_done=1)
+                skipped += 1
+            else:
+                args = dict(taskarg['args'], object_position=position)
+                store_payload(audit_id, position, obj)
+                target.apply_async(args=(args,))
+                dispatched += 1
+            redis.pipeline().setbit(key, position, 1).expire(key, DISPATCHED_TTL).execute()
+    return ResultDict({'audit_id': audit_id, 'start': start, 'stop': stop, 'dispatched': dispatched, 'skipped': skipped})
+
+
+def remove_snapshot(audit_id):
+    """Delete an audit's snapshot and index, complete or not"""
+    path = snapshot_path(audit_id)
+    for name in (path, partial_path(path), index_path(path), partial_path(index_path(path))):
+        try:
+            os.remove(name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    get_redis().delete(dispatched_key(audit_id))
+
+
+@task
+def remove_old_snapshots():
+    """
+    Delete the snapshots of audits that completed more than CATALOG_SNAPSHOT_MAX_AGE days ago, of audits
+    that stopped that long before they went stale, and of audits that no longer exist.
+    Runs daily from celery beat (CELERYBEAT_SCHEDULE)
+    """
+    if not SNAPSHOT_DIR or not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    matches = (SNAPSHOT_FILE_NAME.match(name) for name in os.listdir(SNAPSHOT_DIR))
+    audit_ids = set(int(match.group(1)) for match in matches if match)
+    cutoff = timezone.now() - SNAPSHOT_MAX_AGE
+    audits = Audit.objects.filter(id__in=audit_ids)
+    existing = set(audits.values_list('id', flat=True))
+    expired = set(audits.filter(Q(progress__completed_at__lt=cutoff) |
+                                Q(progress__completed_at__isnull=True, created_at__lt=cutoff - CRAWL_STALE_AFTER))
+                  .values_list('id', flat=True))
+    removed = sorted(expired | (audit_ids - existing))
+    for audit_id in removed:
+        logger.info(u'Removing the snapshot of audit {0}'.format(audit_id))
+        remove_snapshot(audit_id)
+    return removed
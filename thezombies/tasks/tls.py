@@ -0,0 +1,119 @@
+"""
+Per-host fallback between TLS profiles.
+
+Some agency servers only speak old versions of TLS, and fail the handshake with a modern client.
+TLSFallbackAdapter sends HTTPS requests with the first profile in TLS_PROFILES and, when the handshake
+fails, retries once with the next. The profile that worked is cached in Redis for the host (TLS_PROFILE_TTL),
+so later requests, from any worker, use it straight away. A host where every profile failed is remembered
+for a shorter time (TLS_FAILURE_TTL), during which it gets a single attempt per request.
+"""
+from __future__ import absolute_import
+from django.conf import settings
+from requests.exceptions import SSLError
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from .utils import logger, TimedHttpAdapter, InsecureHttpAdapter
+from thezombies.metrics import observe
+from thezombies.utils import get_redis
+
+TLS_PROFILE_TTL = getattr(settings, 'TLS_PROFILE_TTL', 24 * 60 * 60)
+TLS_FAILURE_TTL = getattr(settings, 'TLS_FAILURE_TTL', 10 * 60)
+# Hosts known to need a legacy profile, used before anything is cached for them
+TLS_LEGACY_HOSTS = getattr(settings, 'TLS_LEGACY_HOSTS', ('www.sba.gov',))
+TLS_PROFILE_KEY_PREFIX = 'thezombies:tls-profile'
+
+DEFAULT_PROFILE = 'default'
+LEGACY_PROFILE = 'tlsv1'
+# Cached for hosts where no profile worked
+FAILED = 'failed'
+
+# Phrases in the OpenSSL errors of a failed negotiation, rather than e.g. a certificate problem
+HANDSHAKE_ERRORS = ('handshake failure', 'unsupported protocol', 'wrong version number', 'unknown protocol',
+                    'protocol version', 'no protocols available', 'eof occurred in violation of protocol',
+                    'wrong ssl version', 'version too low')
+
+
+# Profiles in the order they are tried
+TLS_PROFILES = (
+    (DEFAULT_PROFILE, TimedHttpAdapter),
+    (LEGACY_PROFILE, InsecureHttpAdapter),
+)
+
+
+def is_handshake_error(error):
+    message = u'{0}'.format(error).lower()
+    return any(phrase in message for phrase in HANDSHAKE_ERRORS)
+
+
+def profile_key(host):
+    return u'{0}:{1}'.format(TLS_PROFILE_KEY_PREFIX, host)
+
+
+def cached_profile(host):
+    """The TLS profile cached for host, or None"""
+    try:
+        profile = get_redis().get(profile_key(host))
+    except Exception as e:
+        logger.warn(u'Unable to read the TLS profile of {0}: {1!r}'.format(host, e))
+        return None
+    return profile.decode('utf-8') if profile is not None else None
+
+
+def cache_profile(host, profile):
+    ttl = TLS_FAILURE_TTL if profile == FAILED else TLS_PROFILE_TTL
+    try:
+        get_redis().setex(profile_key(host), ttl, profile)
+    except Exception as e:
+        logger.warn(u'Unable to cache the TLS profile of {0}: {1!r}'.format(host, e))
+
+
+class TLSFallbackAdapter(TimedHttpAdapter):
+    """
+    "Transport adapter" for HTTPS that picks a TLS profile per host, falling back to the next profile
+    when a handshake fails. Redirects are sent through the adapter hop by hop, so each host gets its own profile
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.profiles = [(name, adapter_cls(*args, **kwargs)) for name, adapter_cls in TLS_PROFILES]
+        super(TLSFallbackAdapter, self).__init__(*args, **kwargs)
+
+    def initial_profile(self, host):
+        profile = cached_profile(host)
+        if profile is None and host.split(':')[0] in TLS_LEGACY_HOSTS:
+            profile = LEGACY_PROFILE
+        return profile
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).netloc.lower()
+        profile = self.initial_profile(host)
+        names = [name for name, adapter in self.profiles]
+        if profile == FAILED:
+            # Nothing worked recently, don't spend more than one handshake on it
+            return self.profiles[0][1].send(request, **kwargs)
+        # The cached profile first, then the others in case the host has changed
+        start = names.index(profile) if profile in names else 0
+        first_error = None
+        for name, adapter in self.profiles[start:] + self.profiles[:start]:
+            try:
+                response = adapter.send(request, **kwargs)
+            except SSLError as e:
+                if not is_handshake_error(e):
+                    raise
+                first_error = first_error or e
+                logger.info(u'TLS handshake with {0} failed using the {1} profile: {2}'.format(host, name, e))
+                observe('tls_handshake_failures', 1)
+                continue
+            if name != profile and (profile is not None or name != DEFAULT_PROFILE):
+                cache_profile(host, name)
+            return response
+        cache_profile(host, FAILED)
+        raise first_error
+
+    def close(self):
+        for name, adapter in self.profiles:
+            adapter.close()
+        super(TLSFallbackAdapter, self).close()
@@ -5,9 +5,18 @@ from django_atomic_celery import task
 
 import requests
 from requests.exceptions import InvalidURL
+import ftplib
+import socket
+import time
 
-from .utils import (ResultDict, logger, response_to_dict, InsecureHttpAdapter)
-from thezombies.models import URLInspection, Probe
+from .utils import (ResultDict, logger, response_to_dict, TimedHttpAdapter)
+from .progress import buffer_progress
+from .redirects import cache_redirects, resolve_cached_redirects
+from .ftp import ftp_response
+from .tls import TLSFallbackAdapter
+from . import archive
+from thezombies.models import URLInspection, CanonicalURL, Probe, ProbeError
+from thezombies.metrics import timer
 
 try:
     from urllib.parse import urlparse, urlunparse
@@ -16,12 +25,18 @@ except ImportError:
 
 
 REQUEST_TIMEOUT = getattr(settings, 'REQUEST_TIMEOUT', 60)
+# Inspections of a URL younger than this (seconds) are reused rather than requesting it again
+URL_REUSE_TTL = getattr(settings, 'URL_REUSE_TTL', 6 * 60 * 60)
 
 session = requests.Session()
-session.mount('https://www.sba.gov/', InsecureHttpAdapter())
+session.mount('http://', TimedHttpAdapter())
+# Falls back to older TLS for hosts that need it (e.g. www.sba.gov), see tls.py
+session.mount('https://', TLSFallbackAdapter())
+# Record requests to (or replay them from) archives, if HTTP_ARCHIVE_MODE is set
+archive.install(session)
 
 
-def open_streaming_response(method, url):
+def open_streaming_response(method, url, headers=None):
     """
     Open a URL for streaming, making sure to indidate a non-gzip response
     Returns a requests.Response.
@@ -30,7 +45,7 @@ def open_streaming_response(method, url):
     http://docs.python-requests.org/en/latest/user/advanced/#body-content-workflow
     """
     try:
-        req_headers = {'Accept-Encoding': 'identity'}
+        req_headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
         resp = session.request(method.upper(), url, headers=req_headers, stream=True,
                                allow_redirects=True, timeout=REQUEST_TIMEOUT, verify=False)
     except Exception as e:
@@ -90,11 +105,34 @@ def request_url(url, method='GET'):
     corrected_url = checker_result.get('corrected_url', None)
     returnval = ResultDict(checker_result)
     returnval['url_request_attempted'] = False
-    if corrected_url:
+    start = time.time()
+    if corrected_url and urlparse(corrected_url).scheme == 'ftp':
         try:
-            logger.info('Requesting URL: {0}'.format(url))
-            resp = session.request(method.upper(), corrected_url,
-                                   allow_redirects=True, timeout=REQUEST_TIMEOUT, verify=False)
+            logger.info('Inspecting FTP URL: {0}'.format(corrected_url))
+            with timer('url_request_seconds'):
+                returnval['response'] = ftp_response(corrected_url)
+        except socket.timeout as e:
+            returnval.add_error(e)
+            returnval['timeout'] = True
+        except Exception as e:
+            returnval.add_error(e)
+        returnval['url_request_attempted'] = True
+        response = returnval.get('response', None)
+        if response and response['status_code'] >= 400:
+            returnval.add_error(ftplib.error_perm(u'{0} for url: {1}'.format(response['reason'], corrected_url)))
+    elif corrected_url:
+        # Skip past any redirects we've seen recently. Not when recording or replaying, where every hop is requested
+        if archive.HTTP_ARCHIVE_MODE:
+            cached_hops, request_target = [], corrected_url
+        else:
+            cached_hops, request_target = resolve_cached_redirects(method, corrected_url)
+        if cached_hops:
+            returnval['cached_redirects'] = len(cached_hops)
+        try:
+            logger.info('Requesting URL: {0}'.format(request_target))
+            with timer('url_request_seconds'):
+                resp = session.request(method.upper(), request_target,
+                                       allow_redirects=True, timeout=REQUEST_TIMEOUT, verify=False)
         except requests.exceptions.Timeout as e:
             logger.warn('Requesting URL: {0}'.format(url))
             returnval.add_error(e)
@@ -109,9 +147,15 @@ def request_url(url, method='GET'):
             except Exception as e:
                 returnval.add_error(e)
             if isinstance(resp, requests.Response):
-                returnval['response'] = response_to_dict(resp)
+                response = response_to_dict(resp)
+                if not archive.HTTP_ARCHIVE_MODE:
+                    cache_redirects(method, response)
+                response['history'] = cached_hops + response['history']
+                returnval['response'] = response
             else:
                 logger.error('session.request did not return a valid Response object')
+    if returnval['url_request_attempted']:
+        returnval['latency'] = time.time() - start
     logger.info('Returning from request_url')
     return returnval
 
@@ -128,36 +172,63 @@ def inspect_url(taskarg):
     audit_id = taskarg.get('audit_id', None)
     prev_probe_id = taskarg.get('prev_probe_id', None)
     probe = None
-    with transaction.atomic():
-        probe = Probe.objects.create(probe_type=Probe.URL_PROBE,
-                                     initial={'url': url, 'url_type': url_type},
-                                     previous_id=prev_probe_id, audit_id=audit_id)
-    if url:
-        result = request_url(url, 'HEAD')
-        response = result.pop('response', None)
-        returnval.errors.extend(result.errors)
-        probe.errors.extend(result.errors)
+    failed = True
+    try:
         with transaction.atomic():
-            if response is not None:
-                inspection = URLInspection.objects.create_from_response(response, save_content=False)
-                if audit_id:
-                    inspection.audit_id = audit_id
-                inspection.probe = probe
-                inspection.save()
-                returnval['inspection_id'] = inspection.id
-            else:
-                timeout = result.get('timeout', False)
-                probe.result['timeout'] = timeout
-                inspection = URLInspection.objects.create(requested_url=url, timeout=timeout)
-                inspection.probe = probe
-                if audit_id:
-                    inspection.audit_id = audit_id
-                inspection.save()
+            probe = Probe.objects.create(probe_type=Probe.URL_PROBE,
+                                         initial={'url': url, 'url_type': url_type},
+                                         previous_id=prev_probe_id, audit_id=audit_id)
+        canonical = CanonicalURL.objects.for_url(url) if url else None
+        # Recording and replaying need every URL requested
+        previous = canonical.fresh_inspection(URL_REUSE_TTL) if canonical and not archive.HTTP_ARCHIVE_MODE else None
+        if previous is not None and not previous.timeout:
+            # Inspected recently (maybe by another agency's audit), record that result again
+            with timer('url_db_write_seconds'), transaction.atomic():
+                inspection = URLInspection.objects.reuse(previous, probe=probe)
                 returnval['inspection_id'] = inspection.id
-            probe.result.update(result)
-            probe.result['initial_url'] = url
-            probe.result['inspection_id'] = returnval['inspection_id']
-            probe.save()
+                errors = ProbeError.objects.filter(probe_id=previous.probe_id).copy_to(probe)
+                returnval.errors.extend(error.message for error in errors)
+                probe.result['initial_url'] = url
+                probe.result['inspection_id'] = inspection.id
+                probe.result['reused_inspection_id'] = previous.id
+                probe.save()
+            failed = previous.status_code is None or len(returnval.errors) > 0
+        elif url:
+            with archive.recording_audit(audit_id):
+                result = request_url(url, 'HEAD')
+            response = result.pop('response', None)
+            returnval.errors.extend(result.errors)
+            with timer('url_db_write_seconds'), transaction.atomic():
+                if response is not None:
+                    inspection = URLInspection.objects.create_from_response(response, save_content=False)
+                    if audit_id:
+                        inspection.audit_id = audit_id
+                    inspection.probe = probe
+                    inspection.canonical_url = canonical
+                    inspection.save()
+                    returnval['inspection_id'] = inspection.id
+                else:
+                    timeout = result.get('timeout', False)
+                    probe.result['timeout'] = timeout
+                    inspection = URLInspection.objects.create(requested_url=url, timeout=timeout,
+                                                              canonical_url=canonical)
+                    inspection.probe = probe
+                    if audit_id:
+                        inspection.audit_id = audit_id
+                    inspection.save()
+                    returnval['inspection_id'] = inspection.id
+                probe.result.update(result)
+                probe.result['initial_url'] = url
+                probe.result['inspection_id'] = returnval['inspection_id']
+                probe.save()
+                ProbeError.objects.record(probe, result.errors)
+                if canonical:
+                    canonical.inspected(inspection, result.get('latency'))
+            failed = response is None or len(returnval.errors) > 0
+    finally:
+        # Count the URL as done even if inspecting it raised, so the audit can still complete.
+        # Written with the rest of the chunk's counts, rather than one update of the audit's row per URL
+        buffer_progress(audit_id, urls_done=1, urls_failed=(1 if failed else 0))
 
     return returnval
 
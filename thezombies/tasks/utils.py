@@ -7,11 +7,15 @@ from requests.models import Response
 
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.poolmanager import PoolManager
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.connection import HTTPConnection, VerifiedHTTPSConnection
+import socket
 import ssl
+import time
 
-logger = get_task_logger(__name__)
+from thezombies.metrics import observe
 
-COUNTDOWN_MODULO = 21
+logger = get_task_logger(__name__)
 
 
 class ResultDict(dict):
@@ -76,11 +80,102 @@ def error_handler(uuid):
     logger.warn(u'Task {0} raised exception: {1!r}\n{2!r}'.format(uuid, exc, result.traceback))
 
 
-class InsecureHttpAdapter(HTTPAdapter):
+class TimedConnectionMixin(object):
+    """Records DNS, connect time and time to first byte for urllib3 connections in thezombies.metrics"""
+
+    _connect_elapsed = 0.0
+    _request_started = None
+
+    def _resolve(self):
+        """Look the host up on its own, to time it. urllib3 looks it up again, normally from the resolver's cache"""
+        try:
+            socket.getaddrinfo(getattr(self, '_dns_host', self.host), self.port, 0, socket.SOCK_STREAM)
+        except socket.error:
+            pass  # The base _new_conn raises urllib3's own error for it
+
+    def _new_conn(self):
+        start = time.time()
+        self._resolve()
+        resolved = time.time()
+        observe('http_dns_seconds', resolved - start)
+        conn = super(TimedConnectionMixin, self)._new_conn()
+        self._connect_elapsed = time.time() - start
+        observe('http_connect_seconds', time.time() - resolved)
+        return conn
+
+    def request(self, *args, **kwargs):
+        self._request_started = time.time()
+        return super(TimedConnectionMixin, self).request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = super(TimedConnectionMixin, self).getresponse(*args, **kwargs)
+        if self._request_started:
+            observe('http_ttfb_seconds', time.time() - self._request_started)
+            self._request_started = None
+        return response
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, VerifiedHTTPSConnection):
+
+    def connect(self):
+        self._connect_elapsed = 0.0
+        start = time.time()
+        super(TimedHTTPSConnection, self).connect()
+        # connect() resolves the host and opens the socket (see _new_conn), then makes the TLS handshake
+        observe('http_tls_seconds', time.time() - start - self._connect_elapsed)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+TIMED_POOL_CLASSES = {
+    'http': TimedHTTPConnectionPool,
+    'https': TimedHTTPSConnectionPool,
+}
+
+
+class TimedPoolManager(PoolManager):
+    """PoolManager whose connections record timings"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedPoolManager, self).__init__(*args, **kwargs)
+        # urllib3 1.16+ looks pool classes up on the manager, and sets its own in PoolManager.__init__
+        self.pool_classes_by_scheme = TIMED_POOL_CLASSES
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        # request_context is only passed by urllib3 1.16+, earlier versions don't accept it
+        kwargs = {'request_context': request_context} if request_context is not None else {}
+        pool = super(TimedPoolManager, self)._new_pool(scheme, host, port, **kwargs)
+        timed_pool_cls = TIMED_POOL_CLASSES.get(scheme)
+        if timed_pool_cls is not None and not isinstance(pool, timed_pool_cls):
+            # Earlier versions make pools from their module's classes, so swap in the timed connections
+            pool.ConnectionCls = timed_pool_cls.ConnectionCls
+        return pool
+
+
+class TimedHttpAdapter(HTTPAdapter):
+    """"Transport adapter" that records connection timings"""
+
+    def init_poolmanager(self, connections, maxsize, block=False):
+        self.poolmanager = TimedPoolManager(num_pools=connections,
+                                            maxsize=maxsize,
+                                            block=block)
+
+
+class InsecureHttpAdapter(TimedHttpAdapter):
     """"Transport adapter" that allows us to use TLSv1. Such a bad idea, but necessary."""
 
     def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = PoolManager(num_pools=connections,
-                                       maxsize=maxsize,
-                                       block=block,
-                                       ssl_version=ssl.PROTOCOL_TLSv1)
+        self.poolmanager = TimedPoolManager(num_pools=connections,
+                                            maxsize=maxsize,
+                                            block=block,
+                                            ssl_version=ssl.PROTOCOL_TLSv1)
@@ -3,27 +3,23 @@ from django_atomic_celery import task
 from django.conf import settings
 from django.db import transaction, DatabaseError
 from itertools import islice
-import os.path
 from contextlib import closing
-
-try:
-    import simplejson as json
-except ImportError:
-    import json
 from ijson.common import (JSONError, IncompleteJSONError)
-try:
-    import ijson.backends.yajl2 as ijson
-except ImportError:
-    import ijson
-from jsonschema import Draft4Validator
 
-from .utils import logger, ResultDict, COUNTDOWN_MODULO
+from .utils import logger, ResultDict
 from .urls import open_streaming_response
-from thezombies.models import (Probe, Audit, Agency)
+from .schemas import get_validator, load_schema
+from .jsonstream import CatalogItemStream, audit_skip_recorder
+from . import archive
+from .payloads import store_payload, fetch_payload, discard_payload, MissingPayload
+from .snapshots import snapshots_enabled, prepare_snapshot, dispatch_ranges
+from .progress import start_progress, record_progress, finish_dispatch, wait_for_capacity, PROGRESS_BATCH_SIZE, \
+    CRAWL_TASK_BUDGET
+from thezombies.models import (Probe, ProbeError, Audit, Agency)
+from thezombies.metrics import timer, timed_iter
 
 
 SCHEMA_ERROR_LIMIT = 100
-SCHEMA_DIR = getattr(settings, 'SCHEMA_DIR', None)
 JSON_SCHEMAS = getattr(settings, 'JSON_SCHEMAS', None)
 
 DATASET_DESCRIPTIVE_KEYS = ('title', 'identifier', 'publisher', 'accessLevel')
@@ -35,13 +31,7 @@ def get_schema_prefix(schema):
 
 
 def get_schema_object(schema):
-    # Get schema info (schema path, dataset_prefix)
-    schema_info = JSON_SCHEMAS.get(schema, None)
-    schema_path = os.path.join(SCHEMA_DIR, schema_info.get('schema'))
-    if os.path.exists(schema_path):
-        return json.load(open(schema_path, 'r'))
-    else:
-        return None
+    return load_schema(schema)
 
 
 @task
@@ -49,81 +39,98 @@ def validate_json_object(taskarg):
     """
     Validate json data object against a json_schema
     """
-    if isinstance(taskarg, tuple):
+    if isinstance(taskarg, (tuple, list)):
         taskarg = taskarg[0]
     probe = None
     is_valid = False
-    json_object = taskarg.get('json_object', None)
+    json_object = taskarg.pop('json_object', None)
     json_schema_name = taskarg.get('json_schema_name', None)
     audit_id = taskarg.get('audit_id', None)
+    object_position = taskarg.get('object_position', None)
     prev_probe_id = taskarg.get('probe_id', None)
     returnval = ResultDict(taskarg)
-    if json_schema_name:
-        # Generally validate_json_object should run in connectino with an audit
-        if audit_id:
-            logger.info('Validating JSON object for audit {0}'.format(audit_id))
-        else:
-            logger.warning(u'validate_json_object running without an audit_id')
+    if json_object is None and audit_id and object_position is not None:
+        json_object = fetch_payload(audit_id, object_position)
+        if json_object is None:
+            # Expired, or discarded by an earlier run of this task
+            returnval.add_error(MissingPayload(u'Catalog object {0} is no longer stored'.format(object_position)))
+    try:
+        if json_schema_name:
+            # Generally validate_json_object should run in connectino with an audit
+            if audit_id:
+                logger.info('Validating JSON object for audit {0}'.format(audit_id))
+            else:
+                logger.warning(u'validate_json_object running without an audit_id')
 
-        # Create a validation probe to record results of validation attempt
-        try:
-            with transaction.atomic():
-                probe = Probe.objects.create(probe_type=Probe.VALIDATION_PROBE)
-        except DatabaseError as e:
-            returnval.add_error(e)
-            logger.exception(e)
-            logger.error('Error creating JSON probe in validate_json_object')
-        if probe:
-            returnval['probe_id'] = probe.id
-        # May be in a chain of probes, typically when validating an entire catalog, not one entry
-            if prev_probe_id:
-                prev_probe_exists = False
+            # Create a validation probe to record results of validation attempt
+            try:
                 with transaction.atomic():
-                    prev_probe_exists = Probe.objects.filter(id=prev_probe_id).exists()
-                if prev_probe_exists:
-                    probe.previous_id = prev_probe_id
-            if audit_id:
-                probe.audit_id = audit_id
-
-        # Build schema path, load schema json, and create validator
-        schema_object = get_schema_object(json_schema_name)
-        if schema_object:
-            validator = Draft4Validator(schema_object)
-
-            if json_object and validator:
-                try:
-                    is_valid = validator.is_valid(json_object)
-                except (JSONError, IncompleteJSONError) as e:
-                    logger.exception(e)
-                    returnval.add_error(e)
-                if not is_valid:
-                    # Save up to SCHEMA_ERROR_LIMIT errors from schema validation
-                    error_iter = islice(validator.iter_errors(json_object), SCHEMA_ERROR_LIMIT)
-                    for e in error_iter:
-                        returnval.add_error(e)
+                    probe = Probe.objects.create(probe_type=Probe.VALIDATION_PROBE)
+            except DatabaseError as e:
+                returnval.add_error(e)
+                logger.exception(e)
+                logger.error('Error creating JSON probe in validate_json_object')
             if probe:
-                # Record results of validation into probe
-                probe.result['object_position'] = taskarg.get('object_position', None)
-                probe.result['object_identifier'] = json_object.get('identifier', None)
-                probe.result['object_info'] = {key: json_object.get(key, None) for key in DATASET_DESCRIPTIVE_KEYS}
-                probe.result['is_valid_schema_instance'] = is_valid
-                # Record errors and save probe
-                with transaction.atomic():
-                    probe.errors.extend(returnval.errors)
-                    probe.save()
-                    logger.info('Updated JSON probe in validate_json_object')
-
-            returnval['audit_type'] = Audit.DATA_CATALOG_VALIDATION
+                returnval['probe_id'] = probe.id
+            # May be in a chain of probes, typically when validating an entire catalog, not one entry
+                if prev_probe_id:
+                    prev_probe_exists = False
+                    with transaction.atomic():
+                        prev_probe_exists = Probe.objects.filter(id=prev_probe_id).exists()
+                    if prev_probe_exists:
+                        probe.previous_id = prev_probe_id
+                if audit_id:
+                    probe.audit_id = audit_id
+
+            # Compiled once per process, see thezombies.tasks.schemas
+            validator = get_validator(json_schema_name)
+            if validator:
+
+                if json_object:
+                    with timer('validation_seconds'):
+                        try:
+                            is_valid = validator.is_valid(json_object)
+                        except (JSONError, IncompleteJSONError) as e:
+                            logger.exception(e)
+                            returnval.add_error(e)
+                        if not is_valid:
+                            # Save up to SCHEMA_ERROR_LIMIT errors from schema validation
+                            error_iter = islice(validator.iter_errors(json_object), SCHEMA_ERROR_LIMIT)
+                            for e in error_iter:
+                                returnval.add_error(e)
+                if probe:
+                    # Record results of validation into probe
+                    probe.result['object_position'] = taskarg.get('object_position', None)
+                    if json_object:
+                        probe.result['object_identifier'] = json_object.get('identifier', None)
+                        probe.result['object_info'] = {key: json_object.get(key, None)
+                                                       for key in DATASET_DESCRIPTIVE_KEYS}
+                    probe.result['is_valid_schema_instance'] = is_valid
+                    # Record errors and save probe
+                    with transaction.atomic():
+                        probe.save()
+                        ProbeError.objects.record(probe, returnval.errors)
+                        logger.info('Updated JSON probe in validate_json_object')
+                    if audit_id and object_position is not None:
+                        discard_payload(audit_id, object_position)
+
+                returnval['audit_type'] = Audit.DATA_CATALOG_VALIDATION
+            else:
+                logger.error('Unable to fetch JSON schema file to create validator')
         else:
-            logger.error('Unable to fetch JSON schema file to create validator')
-    else:
-        logger.error('No JSON schema name provided. Cannot validate without a schema')
+            logger.error('No JSON schema name provided. Cannot validate without a schema')
+    finally:
+        # Count the object as done even if validating it raised, so the audit can still complete
+        record_progress(audit_id, datasets_done=1)
     return returnval
 
 
 @task
 def validate_catalog_datasets(agency_id, schema='DATASET_1.0'):
-    agency = audit = tasks = resp = None
+    agency = audit = resp = None
+    returnval = ResultDict({'agency_id': agency_id, 'schema': schema})
+    dispatched = 0
+    undercounted = 0  # Objects dispatched but not yet added to the audit's progress
     with transaction.atomic():
         try:
             # Get agency
@@ -138,25 +145,47 @@ def validate_catalog_datasets(agency_id, schema='DATASET_1.0'):
 
     with transaction.atomic():
         audit = Audit.objects.create(agency_id=agency_id, audit_type=Audit.DATA_CATALOG_VALIDATION)
+        returnval['audit_id'] = audit.id
+    start_progress(audit.id)
 
     try:
-        with closing(open_streaming_response('GET', agency.data_json_url)) as resp:
-            # Use the schema dataset_prefix to get an iterator for the items to be validated.
-            objects = ijson.items(resp.raw, schema_info.get('dataset_prefix', ''))
-
-            default_args = {'json_schema_name': schema, 'source_url': agency.data_json_url}
+        with archive.recording_audit(audit.id if audit else None):
+            resp = open_streaming_response('GET', agency.data_json_url)
+        with closing(resp):
+            prefix = schema_info.get('dataset_prefix', '')
+            default_args = {'json_schema_name': schema}
             if audit:
                 default_args.update({'audit_id': audit.id})
 
-            # We're going to spin off async tas
-            tasks = []
-            for num, obj in enumerate(objects):
-                args = default_args.copy()
-                args.update({'json_object': obj, 'object_position': num})
-                task = validate_json_object.apply_async(args=(args,), countdown=(num % COUNTDOWN_MODULO))
-                tasks.append(task)
+            if audit and snapshots_enabled(prefix):
+                # Parsed in ranges by dispatch_snapshot_range tasks
+                with prepare_snapshot(audit.id, resp.raw, prefix) as snapshot:
+                    dispatched = dispatch_ranges(audit.id, snapshot, validate_json_object.name, default_args,
+                                                 share=CRAWL_TASK_BUDGET)
+            else:
+                # Use the schema dataset_prefix to get an iterator for the items to be validated.
+                on_skip = audit_skip_recorder(audit.id if audit else None)
+                objects = timed_iter(CatalogItemStream(resp.raw, prefix, on_skip=on_skip),
+                                     'catalog_object_parse_seconds')
+
+                # We're going to spin off async tasks, passing a reference to each stored object.
+                # Reading the stream pauses while too many are in flight
+                for num, obj in objects:
+                    args = default_args.copy()
+                    args['object_position'] = num
+                    store_payload(audit.id, num, obj)
+                    validate_json_object.apply_async(args=(args,))
+                    dispatched += 1
+                    undercounted += 1
+                    if undercounted == PROGRESS_BATCH_SIZE:
+                        record_progress(audit.id, datasets_dispatched=undercounted)
+                        undercounted = 0
+                        wait_for_capacity(audit.id, CRAWL_TASK_BUDGET)
 
     except Exception as e:
         logger.exception(e)
 
-    return tasks
+    finish_dispatch(audit.id, datasets_dispatched=undercounted)
+    returnval['datasets_dispatched'] = dispatched
+
+    return returnval
@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+from django.test import SimpleTestCase
+import io
+import os
+import shutil
+import tempfile
+
+from thezombies.tasks.jsonstream import CatalogItemStream, parse_item
+from thezombies.tasks.snapshots import build_index, CatalogSnapshot, INDEX_ENTRY, index_path
+
+DAMAGED_CATALOGS = (
+    # Unterminated string
+    (b'{"dataset": [{"a": 1}, {"b": "x}, {"c": 3}, {"d": 4}]}', [(0, {'a': 1}), (2, {'c': 3}), (3, {'d': 4})]),
+    # Missing closing brace
+    (b'{"dataset": [{"a": 1}, {"b": 1, {"c": 3}, {"d": 4}]}', [(0, {'a': 1}), (2, {'c': 3}), (3, {'d': 4})]),
+)
+
+
+class CatalogItemStreamTest(SimpleTestCase):
+
+    def stream(self, data, chunk_size, parse):
+        return list(CatalogItemStream(io.BytesIO(data), 'dataset.item', chunk_size=chunk_size, parse=parse))
+
+    def test_damaged_items_are_skipped_alike_with_and_without_parsing(self):
+        for data, expected in DAMAGED_CATALOGS:
+            for chunk_size in (4, 64 * 1024):
+                self.assertEqual(self.stream(data, chunk_size, True), expected)
+                spans = self.stream(data, chunk_size, False)
+                items = [(position, parse_item(data[start:end])) for position, (start, end) in spans]
+                self.assertEqual(items, expected)
+
+
+class SnapshotIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_damaged_items_get_empty_entries(self):
+        for data, expected in DAMAGED_CATALOGS:
+            path = os.path.join(self.directory, 'audit-1.json')
+            with open(path, 'wb') as snapshot:
+                snapshot.write(data)
+            self.assertEqual(build_index(path, 'dataset.item'), 4)
+            self.assertEqual(os.path.getsize(index_path(path)), 4 * INDEX_ENTRY.size)
+            with CatalogSnapshot(path) as snapshot:
+                self.assertEqual(snapshot.raw_item(1), b'')
+                self.assertEqual([(position, snapshot.item(position)) for position, item in expected], expected)
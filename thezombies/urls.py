@@ -2,7 +2,9 @@ from django.conf.urls import patterns, include, url
 from django.contrib import admin
 
 from thezombies.views import (HomeView, AgencyList, AgencyView, AuditListView, AuditView,
-                              AuditDayArchiveView, AuditMonthArchiveView, AuditYearArchiveView, ProbeView)
+                              AuditDayArchiveView, AuditMonthArchiveView, AuditYearArchiveView, AuditProgressView,
+                              AuditURLListView, AuditExportView, AuditDiffView, AuditDiffExportView, CatalogItemView, ProbeView,
+                              MetricsView)
 
 urlpatterns = patterns('',
     url(r'^$', HomeView.as_view(), name='home'),
@@ -13,8 +15,16 @@ urlpatterns = patterns('',
     url(r'^audits/(?P<year>\d{4})/(?P<month>\d{2})/$', AuditMonthArchiveView.as_view(), name='audits-list-month'),
     url(r'^audits/(?P<year>\d{4})/$', AuditYearArchiveView.as_view(), name='audits-list-year'),
     url(r'^audits/(?P<pk>\d+)/$', AuditView.as_view(), name='audit-detail'),
+    url(r'^audits/(?P<pk>\d+)/progress/$', AuditProgressView.as_view(), name='audit-progress'),
+    url(r'^audits/(?P<pk>\d+)/urls/$', AuditURLListView.as_view(), name='audit-url-list'),
+    url(r'^audits/(?P<pk>\d+)/catalog/(?P<position>\d+)\.json$', CatalogItemView.as_view(), name='audit-catalog-item'),
+    url(r'^audits/(?P<pk>\d+)/export/(?P<export>\w+)\.(?P<format>\w+)$', AuditExportView.as_view(), name='audit-export'),
+    url(r'^audits/diff/(?P<old_pk>\d+)/(?P<new_pk>\d+)/$', AuditDiffView.as_view(), name='audit-diff'),
+    url(r'^audits/diff/(?P<old_pk>\d+)/(?P<new_pk>\d+)\.(?P<format>\w+)$', AuditDiffExportView.as_view(),
+        name='audit-diff-export'),
     url(r'^audits/(?P<audit_type>\w+)/$', AuditListView.as_view(), name='audits-list-filtered'),
     url(r'^probes/(?P<pk>\d+)/$', ProbeView.as_view(), name='probe-detail'),
+    url(r'^metrics/$', MetricsView.as_view(), name='metrics'),
 
     url(r'^admin/', include(admin.site.urls)),
 )
@@ -1,4 +1,15 @@
+from django.conf import settings
 from django.utils import timezone
+import re
+import string
+
+import redis
+
+try:
+    from urllib.parse import urlsplit, urlunsplit, quote
+except ImportError:
+    from urlparse import urlsplit, urlunsplit
+    from urllib import quote
 
 
 DATETIME_FORMATTER = u"{:%Y-%m-%d %I:%M%p %Z}"
@@ -6,3 +17,76 @@ DATETIME_FORMATTER = u"{:%Y-%m-%d %I:%M%p %Z}"
 
 def datetime_string(dt_obj=None):
     return DATETIME_FORMATTER.format(timezone.localtime(dt_obj if dt_obj else timezone.now()))
+
+
+_redis_client = None
+
+
+def get_redis():
+    """Shared connection to the Redis server at settings.REDIS_URL"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.StrictRedis.from_url(settings.REDIS_URL)
+    return _redis_client
+
+
+# Ports that are dropped from canonical URLs
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+# Characters that don't need percent-encoding in a path or query (RFC 3986 unreserved characters,
+# sub-delimiters and the separators allowed in each part)
+PATH_SAFE = "/:@!$&'()*+,;=-._~"
+QUERY_SAFE = PATH_SAFE + '?'
+PERCENT_ENCODED_RE = re.compile(r'%([0-9a-fA-F]{2})')
+UNRESERVED = frozenset(string.ascii_letters + string.digits + '-._~')
+
+
+def _normalize_encoding(part, safe):
+    """Decode percent-encoded unreserved characters, and percent-encode (in upper case) everything else that needs it"""
+    if not isinstance(part, bytes):
+        part = part.encode('utf-8')
+    part = part.decode('latin-1')
+
+    # split() alternates text and the hex digits of escapes
+    normalized = []
+    for n, chunk in enumerate(PERCENT_ENCODED_RE.split(part)):
+        if n % 2:
+            char = chr(int(chunk, 16))
+            normalized.append(char if char in UNRESERVED else '%' + chunk.upper())
+        else:
+            normalized.append(quote(chunk.encode('latin-1'), safe=safe))
+    return ''.join(normalized)
+
+
+def canonical_url(url):
+    """
+    The canonical form of a URL, used to recognize the same URL across audits and agencies:
+    scheme and host in lower case, default ports, passwords and fragments dropped, an empty path made '/',
+    and percent-encoding normalized. URLs without a scheme are taken to be http, as check_and_correct_url does.
+    Returns None for URLs that can't be inspected (no host, or not an http(s) or ftp URL)
+    """
+    if not url:
+        return None
+    url = url.strip()
+    parts = urlsplit(url)
+    if not parts.scheme:
+        parts = urlsplit(u'http://{0}'.format(url))
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return None
+    try:
+        host = parts.hostname
+        port = parts.port
+    except ValueError:
+        return None  # Invalid port
+    if not host:
+        return None
+    host = host.rstrip('.')
+    netloc = u'[{0}]'.format(host) if ':' in host else host
+    if port and port != DEFAULT_PORTS[scheme]:
+        netloc = u'{0}:{1}'.format(netloc, port)
+    # Passwords are not kept (canonical URLs are hashed and stored), the user name still tells URLs apart
+    if parts.username:
+        netloc = u'{0}@{1}'.format(parts.netloc.rpartition('@')[0].partition(':')[0], netloc)
+    path = _normalize_encoding(parts.path, PATH_SAFE) or '/'
+    query = _normalize_encoding(parts.query, QUERY_SAFE)
+    return urlunsplit((scheme, netloc, path, query, ''))
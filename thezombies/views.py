@@ -1,11 +1,16 @@
-from django.shortcuts import get_object_or_404
-from django.http import Http404
+from django.shortcuts import get_object_or_404, render
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.generic import View
 from django.views.generic import ListView, DetailView
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.base import RedirectView
 from django.views.generic.dates import DayArchiveView, MonthArchiveView, YearArchiveView
 
-from thezombies.models import (Agency, Audit, Probe, URLInspection)
+from thezombies.models import (Agency, Audit, AuditProgress, Probe, URLInspection)
+from thezombies.metrics import render_prometheus
+from thezombies.exports import export_audit, FORMATS
+from thezombies.diffs import diff_audits, diff_summary, previous_crawl, CHANGES, AuditDiffRow
+from thezombies.tasks.snapshots import CatalogSnapshot
 
 
 class HomeView(RedirectView):
@@ -96,6 +101,8 @@ class AuditView(SingleObjectMixin, ListView):
     def get_context_data(self, **kwargs):
         context = super(AuditView, self).get_context_data(**kwargs)
         context['audit'] = self.object
+        if self.object.audit_type == Audit.DATA_CATALOG_CRAWL:
+            context['previous_crawl'] = previous_crawl(self.object)
         return context
 
     def get_queryset(self):
@@ -111,6 +118,126 @@ class AuditView(SingleObjectMixin, ListView):
         return template_names
 
 
+class AuditURLListView(SingleObjectMixin, ListView):
+    """The URLs inspected for an audit"""
+    paginate_by = 50
+    template_name = 'audit_url_list.html'
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object(queryset=Audit.objects.all())
+        return super(AuditURLListView, self).get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(AuditURLListView, self).get_context_data(**kwargs)
+        context['audit'] = self.object
+        return context
+
+    def get_queryset(self):
+        # Error counts come with the page of inspections, rather than a query for each row
+        return URLInspection.objects.filter(probe__audit=self.object).initial_urls() \
+            .select_related('content').defer('content__binary').with_error_counts().order_by('id')
+
+
+class AuditProgressView(DetailView):
+    model = Audit
+    context_object_name = 'audit'
+    template_name = 'audit_progress.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(AuditProgressView, self).get_context_data(**kwargs)
+        progress = AuditProgress.objects.filter(audit=self.object).first()
+        context['progress'] = progress
+        if progress:
+            context['urls_per_second'] = progress.urls_per_second()
+            context['eta_seconds'] = progress.eta_seconds()
+        return context
+
+
+class AuditExportView(View):
+    """
+    Stream an audit's inspections, probes or errors as CSV or NDJSON.
+    Inspections can be filtered with ?filter=<URLInspectionQuerySet method>, e.g. ?filter=all_errors
+    """
+
+    def get(self, request, *args, **kwargs):
+        audit = get_object_or_404(Audit, pk=kwargs['pk'])
+        export, export_format = kwargs['export'], kwargs['format']
+        try:
+            content_type, chunks = export_audit(export, audit, export_format, request.GET.getlist('filter'))
+        except ValueError as e:
+            return HttpResponseBadRequest(u'{0}'.format(e))
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="audit-{0}-{1}.{2}"'.format(audit.pk, export,
+                                                                                         export_format)
+        return response
+
+
+class AuditDiffMixin(object):
+
+    def get_audits(self):
+        old_audit = get_object_or_404(Audit, pk=self.kwargs['old_pk'])
+        new_audit = get_object_or_404(Audit, pk=self.kwargs['new_pk'])
+        return old_audit, new_audit
+
+
+class AuditDiffView(AuditDiffMixin, View):
+    """Counts of URLs that changed between two crawls of an agency, with links to download them"""
+
+    def get(self, request, *args, **kwargs):
+        old_audit, new_audit = self.get_audits()
+        try:
+            summary = diff_summary(old_audit, new_audit)
+        except ValueError as e:
+            return HttpResponseBadRequest(u'{0}'.format(e))
+        context = {'old_audit': old_audit, 'new_audit': new_audit, 'agency': new_audit.agency,
+                   'changes': [(change, change.replace('_', ' ').capitalize(), summary[change]) for change in CHANGES],
+                   'formats': sorted(FORMATS.keys())}
+        return render(request, 'audit_diff.html', context)
+
+
+class AuditDiffExportView(AuditDiffMixin, View):
+    """Stream URLs that changed between two crawls as CSV or NDJSON. Limit to some changes with ?change=newly_failing"""
+
+    def get(self, request, *args, **kwargs):
+        old_audit, new_audit = self.get_audits()
+        export_format = kwargs['format']
+        if export_format not in FORMATS:
+            return HttpResponseBadRequest(u'Unknown format {0}'.format(export_format))
+        changes = request.GET.getlist('change')
+        try:
+            rows = (row._asdict() for row in diff_audits(old_audit, new_audit, changes))
+        except ValueError as e:
+            return HttpResponseBadRequest(u'{0}'.format(e))
+        write_rows, content_type = FORMATS[export_format]
+        response = StreamingHttpResponse(write_rows(AuditDiffRow._fields, rows), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="audit-diff-{0}-{1}.{2}"'.format(
+            old_audit.pk, new_audit.pk, export_format)
+        return response
+
+
+class CatalogItemView(View):
+    """An item of an audit's catalog, as it was when crawled, read by position from the audit's snapshot"""
+
+    def get(self, request, *args, **kwargs):
+        audit = get_object_or_404(Audit, pk=kwargs['pk'])
+        snapshot = CatalogSnapshot.for_audit(audit.pk)
+        if snapshot is None:
+            raise Http404(u'No snapshot of the catalog for audit {0}'.format(audit.pk))
+        with snapshot:
+            try:
+                data = snapshot.raw_item(int(kwargs['position']))
+            except IndexError as e:
+                raise Http404(u'{0}'.format(e))
+        return HttpResponse(data, content_type='application/json')
+
+
 class ProbeView(DetailView):
     model = Probe
     template_name = "probe_detail.html"
+
+
+class MetricsView(View):
+    """Task timing histograms in the Prometheus text format"""
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4')